@@ -0,0 +1,95 @@
+"""Compare the vectorized lineup flattening of get_combined_data against the previous per-match loop.
+
+Runs on synthetic frames shaped like the result of get_all_match_data and get_player_lineups, no database is needed.
+Run it from the repository root, db_conn does not need to be installed:
+
+    PYTHONPATH=. python benchmarks/bench_combined_data.py --matches 10000 --players 18
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from db_conn.query.sc_soccer.complex import flatten_player_lineups
+
+
+def legacy_join_player_lineup(lineups, matches):
+    """The implementation get_combined_data used before the vectorized rewrite."""
+    df_list = []
+
+    match_grp = lineups.groupby('match_id')
+    for match_id, e_match_grp in match_grp:
+        fixed_e_match_grp = e_match_grp.drop('match_id', axis=1)
+        new_cols = []
+        team_grp = fixed_e_match_grp.groupby('team_id')
+        for team_id, e_team_grp in team_grp:
+            fixed_e_team_grp = e_team_grp.drop('team_id', axis=1)
+            matches_filtered = matches[matches['match_id'] == match_id]
+            if matches_filtered['home_team_id'].iloc[0] == team_id:
+                prefix = 'home'
+            else:
+                prefix = 'away'
+            rows = len(fixed_e_team_grp.index)
+            cols = fixed_e_team_grp.keys()
+            for i in range(0, rows):
+                for col in cols:
+                    new_cols.append(prefix + '_' + col + '_' + str(i))
+
+        values_df = fixed_e_match_grp.drop('team_id', axis=1)
+        values_list = values_df.values.flatten()
+        new_df = pd.DataFrame([values_list], columns=new_cols)
+        new_df['match_id'] = match_id
+        df_list.append(new_df)
+
+    return pd.concat(df_list)
+
+
+def make_frames(num_matches, num_players):
+    rng = np.random.default_rng(0)
+    match_ids = np.arange(num_matches)
+    # The home team id is the smaller one, so the legacy loop produces aligned columns as well
+    matches = pd.DataFrame({'match_id': match_ids, 'home_team_id': match_ids % 100,
+                            'away_team_id': match_ids % 100 + 100})
+    rows = num_matches * 2 * num_players
+    lineups = pd.DataFrame({
+        'match_id': np.repeat(match_ids, 2 * num_players),
+        'team_id': np.repeat(np.stack([matches['home_team_id'], matches['away_team_id']], axis=1).ravel(),
+                             num_players),
+        'sc_player_id': rng.integers(0, 50000, rows),
+        'player_position_long': 'Midfielder',
+        'player_position_short': 'M',
+        'sc_rating': rng.random(rows) * 10,
+        'substitute': np.tile(np.arange(num_players) >= 11, num_matches * 2),
+    })
+    return lineups, matches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--matches', type=int, default=10000)
+    parser.add_argument('--players', type=int, default=18)
+    parser.add_argument('--skip-legacy', action='store_true')
+    args = parser.parse_args()
+
+    lineups, matches = make_frames(args.matches, args.players)
+
+    start = time.perf_counter()
+    fast = flatten_player_lineups(lineups, matches)
+    fast_time = time.perf_counter() - start
+    print("vectorized: %.3fs shape=%s" % (fast_time, fast.shape))
+
+    if not args.skip_legacy:
+        start = time.perf_counter()
+        slow = legacy_join_player_lineup(lineups, matches)
+        slow_time = time.perf_counter() - start
+        print("legacy:     %.3fs shape=%s" % (slow_time, slow.shape))
+        print("speedup:    %.1fx" % (slow_time / fast_time))
+
+        slow = slow.set_index('match_id').sort_index()
+        fast = fast.set_index('match_id').sort_index()[slow.columns]
+        assert (slow.astype(str).values == fast.astype(object).astype(str).values).all(), "Results differ"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Compare sql_query against the COPY based sql_query_copy on wide match exports.
+
+Run from the repository root, db_conn does not need to be installed. Uses the same environment variables as
+the test suite, e.g.:
+
+    SSH_ADDRESS=... SSH_USERNAME=... SSH_PASSWORD=... DB_USERNAME=... DB_PASSWORD=... DB_NAME=sc_soccer \
+        PYTHONPATH=. python benchmarks/bench_sql_query.py --limit 20000 --repeat 3
+"""
+import argparse
+import os
+import time
+
+import db_conn as conn
+
+SSH_CONFIGURATION = {
+    'ssh_address_or_host': (os.environ.get('SSH_ADDRESS'), 22),
+    'ssh_username': os.environ.get('SSH_USERNAME'),
+    'ssh_password': os.environ.get('SSH_PASSWORD'),
+    'remote_bind_address': ('127.0.0.1', 5432),
+    'local_bind_address': ('127.0.0.1', 8080),
+}
+
+DB_CONFIGURATION = {
+    'db_username': os.environ.get('DB_USERNAME'),
+    'db_password': os.environ.get('DB_PASSWORD'),
+    'db_address': ('127.0.0.1', 8080),
+    'db_name': os.environ.get('DB_NAME', 'sc_soccer')
+}
+
+
+def measure(func, query, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        df = func(query)
+        timings.append(time.perf_counter() - start)
+    return min(timings), df.shape
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--limit', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-tunnel', action='store_true')
+    args = parser.parse_args()
+
+    tunnel = None if args.no_tunnel else conn.utils.Tunnel(config=SSH_CONFIGURATION)
+    db = conn.psql.Connection(config=DB_CONFIGURATION, tunnel=tunnel)
+
+    queries = {
+        'matches': conn.query.sc_soccer.get_all_match_data().limit(args.limit),
+        'matches+stat+lineups': conn.query.sc_soccer.get_all_match_data(match_stat=True, lineups=True
+                                                                        ).limit(args.limit),
+    }
+    for name, query in queries.items():
+        base, shape = measure(db.sql_query, query, args.repeat)
+        fast, _ = measure(db.sql_query_copy, query, args.repeat)
+        print("%-22s rows=%-7d cols=%-4d sql_query=%.3fs sql_query_copy=%.3fs speedup=%.1fx"
+              % (name, shape[0], shape[1], base, fast, base / fast))
+
+    db.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Measure the time from opening a tunnelled Connection to the result of its first query.
+
+The previous startup slept a fixed 10 seconds after starting the tunnel, the readiness probe returns as soon as
+the database answers through the forwarded port. Run from the repository root, db_conn does not need to be
+installed. Uses the same environment variables as the test suite, e.g.:
+
+    SSH_ADDRESS=... SSH_USERNAME=... SSH_PASSWORD=... DB_USERNAME=... DB_PASSWORD=... DB_NAME=sc_soccer \
+        PYTHONPATH=. python benchmarks/bench_startup.py --repeat 5
+"""
+import argparse
+import os
+import time
+
+import db_conn as conn
+
+SSH_CONFIGURATION = {
+    'ssh_address_or_host': (os.environ.get('SSH_ADDRESS'), 22),
+    'ssh_username': os.environ.get('SSH_USERNAME'),
+    'ssh_password': os.environ.get('SSH_PASSWORD'),
+    'remote_bind_address': ('127.0.0.1', 5432),
+    'local_bind_address': ('127.0.0.1', 8080),
+}
+
+DB_CONFIGURATION = {
+    'db_username': os.environ.get('DB_USERNAME'),
+    'db_password': os.environ.get('DB_PASSWORD'),
+    'db_address': ('127.0.0.1', 8080),
+    'db_name': os.environ.get('DB_NAME', 'sc_soccer')
+}
+
+# The sleep the tunnel startup used before the readiness probe
+FIXED_SLEEP = 10
+
+
+def startup():
+    start = time.perf_counter()
+    tunnel = conn.utils.Tunnel(config=SSH_CONFIGURATION)
+    tunnel.start()
+    started = time.perf_counter()
+    tunnel.wait_ready()
+    ready = time.perf_counter()
+    db = conn.psql.Connection(config={**DB_CONFIGURATION, 'db_address': tunnel.local_bind_addresses[0]})
+    db.sql_query('SELECT 1')
+    first_query = time.perf_counter()
+    db.close()
+    tunnel.stop()
+    return started - start, ready - started, first_query - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for i in range(args.repeat):
+        tunnel_start, wait, total = startup()
+        print("run=%d tunnel_start=%.3fs wait_ready=%.3fs first_query=%.3fs fixed_sleep_first_query=%.3fs"
+              % (i, tunnel_start, wait, total, total - wait + FIXED_SLEEP))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 from db_conn.connection import postgresql as psql
+from db_conn.connection import aio
 from db_conn import utils
 from db_conn import queue
 from db_conn import query
\ No newline at end of file
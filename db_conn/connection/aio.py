@@ -0,0 +1,301 @@
+# Common Python library imports
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+# Pip package imports
+import psycopg2
+from psycopg2 import extensions
+from loguru import logger
+
+# Internal package imports
+from db_conn.utils import get_nested, Tunnel, TunnelGroup
+from db_conn.query.bind import compile_query
+from db_conn.connection.pool import PoolTimeout
+from db_conn.metrics import Metrics
+
+
+async def wait(connection):
+    """Drive an asynchronous psycopg2 connection until its pending operation completes, without blocking the loop.
+
+    The socket is watched with the add_reader/add_writer callbacks of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    fd = connection.fileno()
+    while True:
+        state = connection.poll()
+        if state == extensions.POLL_OK:
+            return
+        if state == extensions.POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        elif state == extensions.POLL_WRITE:
+            add, remove = loop.add_writer, loop.remove_writer
+        else:
+            raise psycopg2.OperationalError("Unexpected poll state: %s" % state)
+        future = loop.create_future()
+        add(fd, future.set_result, None)
+        try:
+            await future
+        finally:
+            remove(fd)
+
+
+async def connect(**kwargs):
+    """Open an asynchronous psycopg2 connection, the keyword arguments are passed to psycopg2.connect()."""
+    connection = psycopg2.connect(async_=True, **kwargs)
+    try:
+        await wait(connection)
+    except BaseException:
+        connection.close()
+        raise
+    return connection
+
+
+class AsyncCursor(object):
+    """Cursor of an asynchronous connection, execute() is awaited, the results are fetched from memory."""
+
+    def __init__(self, connection, metrics=None):
+        self.connection = connection
+        self.metrics = metrics
+        self._cursor = connection.cursor()
+
+    async def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            self._cursor.execute(query, vars)
+            await wait(self.connection)
+        except asyncio.CancelledError:
+            # The statement keeps running on the server otherwise. Sending the cancel request blocks until the
+            # server answers, it is done in the default executor.
+            await asyncio.get_running_loop().run_in_executor(None, self.connection.cancel)
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe('query.execute', time.perf_counter() - start)
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        return self._cursor.fetchmany(self._cursor.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        self._cursor.close()
+
+
+def _dataframe(cursor):
+    try:
+        import pandas as pd
+        return pd.DataFrame.from_records(cursor.fetchall(), columns=[col.name for col in cursor.description],
+                                         coerce_float=True)
+    except ImportError as err:
+        logger.error(err)
+
+
+class AsyncConnection():
+    """Single asynchronous connection for asyncio applications.
+
+    Takes the same arguments as Connection. Use it with 'async with', or await open() and close(). Asynchronous
+    connections are always in autocommit mode, explicit transactions need BEGIN and COMMIT statements.
+    """
+
+    config = {
+        'db_username': '',
+        'db_password': '',
+        'db_address': ('127.0.0.1', 8080),
+        'db_name': os.environ.get('DB_NAME'),
+    }
+
+    def __init__(self, *args, **kwargs):
+
+        self._config = { **AsyncConnection.config, **kwargs.get('config', {})}
+        self._tunnel = kwargs.get('tunnel', None)
+        if self._tunnel is not None:
+            assert isinstance(self._tunnel, (Tunnel, TunnelGroup)), \
+                "Input argument \'tunnel\' must be a type of Tunnel or TunnelGroup object"
+        self.metrics = kwargs.get('metrics', None) or Metrics()
+
+        username = os.environ.get('DB_USERNAME', kwargs.get('username', self._get_config('db_username')))
+        password = os.environ.get('DB_PASSWORD', kwargs.get('password', self._get_config('db_password')))
+        self._credentials = (username, password)
+        self._connection = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    @property
+    def connection(self):
+        return self._connection
+
+    async def open(self):
+        # Starting the tunnel blocks, it is done in the default executor
+        if self._tunnel is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._open_tunnel)
+        self._connection = await self._connect()
+
+    def _open_tunnel(self):
+        self._tunnel.start()
+        self._tunnel.wait_ready()
+        self._config['db_address'] = self._tunnel.local_bind_addresses[0]
+
+    async def _connect(self):
+        return await connect(user=self._credentials[0],
+                             password=self._credentials[1],
+                             host=self._get_config('db_address')[0],
+                             port=self._get_config('db_address')[1],
+                             database=self._get_config('db_name'))
+
+    async def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        if self._tunnel is not None:
+            self._tunnel.stop()
+
+    @asynccontextmanager
+    async def get_cursor(self, **kwargs):
+        cursor = AsyncCursor(kwargs.get('connection', self._connection), self.metrics)
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+    async def execute(self, cursor, query):
+        sql, params = compile_query(query)
+        await cursor.execute(sql, params)
+
+    async def sql_query(self, query):
+        async with self.get_cursor() as cur:
+            await self.execute(cur, query)
+            return _dataframe(cur)
+
+    def _get_config(self, *args):
+        data = get_nested(self._config, *args)
+        assert data is not None, "config \'%s\' is not supported." % args
+        return data
+
+
+class AsyncConnectionPool(AsyncConnection):
+    """Pool of asynchronous connections, every query checks out its own connection.
+
+    At most 'max_connection' queries run at the same time, the others wait up to 'pool_timeout' seconds for a
+    free connection before PoolTimeout is raised. Unlike ConnectionPool it is not a singleton, a pool belongs
+    to the event loop it was opened in.
+    """
+
+    config = {
+        'db_username': '',
+        'db_password': '',
+        'db_address': ('127.0.0.1', 8080),
+        'db_name': os.environ.get('DB_NAME'),
+        'min_connection': 1,
+        'max_connection': 32,
+        'pool_timeout': 30,
+    }
+
+    def __init__(self, *args, **kwargs):
+
+        kwargs['config'] = { **AsyncConnectionPool.config, **kwargs.get('config', {}) }
+
+        super(AsyncConnectionPool, self).__init__(*args, **kwargs)
+        self._idle = deque()
+        self._size = 0
+        self._slots = None
+
+        for name in ('size', 'idle', 'in_use'):
+            self.metrics.register_gauge('pool.%s' % name, lambda name=name: self.stats()[name])
+
+    async def open(self):
+        if self._tunnel is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._open_tunnel)
+        self._slots = asyncio.Semaphore(self._get_config('max_connection'))
+        for _ in range(self._get_config('min_connection')):
+            self._idle.append(await self._connect())
+            self._size += 1
+
+    async def close(self):
+        while self._idle:
+            self._idle.pop().close()
+        self._size = 0
+        if self._tunnel is not None:
+            self._tunnel.stop()
+
+    @property
+    def connection(self):
+        raise AttributeError("AsyncConnectionPool has no single connection, use get_connection()")
+
+    def stats(self):
+        return {'size': self._size, 'idle': len(self._idle), 'in_use': self._size - len(self._idle),
+                'max': self._get_config('max_connection')}
+
+    @asynccontextmanager
+    async def get_connection(self):
+        start = time.perf_counter()
+        timeout = self._config.get('pool_timeout')
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout("no connection available within %s seconds" % timeout)
+        connection = None
+        try:
+            while self._idle and connection is None:
+                connection = self._idle.pop()
+                if connection.closed:
+                    self._size -= 1
+                    connection = None
+            if connection is None:
+                self._size += 1
+                try:
+                    connection = await self._connect()
+                except BaseException:
+                    self._size -= 1
+                    raise
+            self.metrics.observe('pool.checkout_wait', time.perf_counter() - start)
+            yield connection
+        finally:
+            if connection is not None:
+                if connection.closed or connection.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                    # Broken, or left in the middle of a statement, e.g. by a cancelled task
+                    connection.close()
+                    self._size -= 1
+                else:
+                    self._idle.append(connection)
+            self._slots.release()
+
+    @asynccontextmanager
+    async def get_cursor(self, **kwargs):
+        connection = kwargs.get('connection', None)
+        if connection is not None:
+            async with super(AsyncConnectionPool, self).get_cursor(connection=connection) as cursor:
+                yield cursor
+            return
+        async with self.get_connection() as connection:
+            async with super(AsyncConnectionPool, self).get_cursor(connection=connection) as cursor:
+                yield cursor
+
+    async def sql_query_many(self, queries, return_exceptions=False):
+        """Run the queries concurrently, the DataFrames are returned in the order of the queries.
+
+        The number of queries in flight is limited by the 'max_connection' pool size.
+        """
+        return await asyncio.gather(*(self.sql_query(query) for query in queries),
+                                    return_exceptions=return_exceptions)
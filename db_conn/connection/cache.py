@@ -0,0 +1,127 @@
+# Common Python library imports
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+_IDENTIFIER = r'"?(?:\w+"?\.)?"?(\w+)"?'
+_REFERENCED_TABLES = re.compile(r'\b(?:JOIN|INTO|UPDATE|TABLE)\s+' + _IDENTIFIER, re.IGNORECASE)
+_WRITTEN_TABLES = re.compile(r'\b(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM|COPY)\s+' + _IDENTIFIER, re.IGNORECASE)
+
+# Table lists: FROM a, b AS x, "s"."c" y ... and TRUNCATE [TABLE] a, b
+_FROM = re.compile(r'\bFROM\b', re.IGNORECASE)
+_TRUNCATE = re.compile(r'\bTRUNCATE(?:\s+TABLE)?\b', re.IGNORECASE)
+_NAME = r'(?:"[^"]+"|\w+)'
+_KEYWORDS = r'(?:WHERE|JOIN|INNER|LEFT|RIGHT|FULL|CROSS|NATURAL|ON|USING|GROUP|ORDER|LIMIT|OFFSET|HAVING|WINDOW|' \
+            r'UNION|EXCEPT|INTERSECT|FOR|RETURNING|SET|LATERAL|ONLY|RESTART|CONTINUE|CASCADE|RESTRICT)\b'
+_LIST_ITEM = re.compile(r'\s*(?:ONLY\s+)?(?:%s\s*\.\s*)?(%s)(?:\s+(?:AS\s+)?(?!%s)%s)?\s*(,)?'
+                        % (_NAME, _NAME, _KEYWORDS, _NAME), re.IGNORECASE)
+
+# Quoted literals and identifiers, kept unchanged by the normalization
+_QUOTED = re.compile(r"('(?:[^']|'')*'|\"[^\"]*\")")
+_WHITESPACE = re.compile(r'\s+')
+
+
+def _table_lists(keyword, sql):
+    """Names of the tables listed after every match of the keyword, e.g. all tables of a FROM list."""
+    names = []
+    for match in keyword.finditer(sql):
+        position = match.end()
+        while True:
+            item = _LIST_ITEM.match(sql, position)
+            if item is None or item.group(1).upper() in ('SELECT', 'LATERAL'):
+                break
+            names.append(item.group(1).strip('"'))
+            position = item.end()
+            if item.group(2) is None:
+                break
+    return names
+
+
+def referenced_tables(sql):
+    """Names of the tables a statement reads or writes."""
+    return frozenset(name.lower() for name in _REFERENCED_TABLES.findall(sql) + _table_lists(_FROM, sql))
+
+
+def written_tables(sql):
+    """Names of the tables a statement modifies."""
+    return frozenset(name.lower() for name in _WRITTEN_TABLES.findall(sql) + _table_lists(_TRUNCATE, sql))
+
+
+def _normalize(sql):
+    """Collapse the whitespace outside of the quoted literals and identifiers."""
+    parts = _QUOTED.split(sql)
+    for i in range(0, len(parts), 2):
+        parts[i] = _WHITESPACE.sub(' ', parts[i])
+    return ''.join(parts).strip().rstrip(';').rstrip()
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+class ResultCache(object):
+    """Bounded LRU cache of query results keyed by the normalized SQL text and the bind parameters.
+
+    Entries expire after 'ttl' seconds and are dropped when invalidate() is called with any of the tables
+    their statement references.
+    """
+
+    def __init__(self, size=256, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generation = 0
+
+    @staticmethod
+    def key(sql, params=None):
+        return _normalize(sql), _freeze(params)
+
+    @property
+    def generation(self):
+        """Incremented on every invalidation. Pass the value read before a query to set()."""
+        return self._generation
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, _, value = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, generation=None):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            # A table was written while the result was fetched, it may be stale already
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (expires, referenced_tables(key[0]), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *tables):
+        tables = {str(table).strip('"').lower() for table in tables}
+        with self._lock:
+            self._generation += 1
+            for key in [key for key, (_, refs, _) in self._entries.items() if refs & tables]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
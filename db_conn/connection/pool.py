@@ -0,0 +1,243 @@
+# Common Python library imports
+import threading
+import time
+from collections import deque
+
+# Pip package imports
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+from loguru import logger
+
+
+class PoolTimeout(PoolError):
+    pass
+
+
+class _Waiter(object):
+    __slots__ = ('event', 'conn', 'create')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.conn = None
+        self.create = False
+
+
+class BlockingConnectionPool(object):
+    """Thread-safe connection pool which blocks instead of failing when it is exhausted.
+
+    Interface compatible with psycopg2's ThreadedConnectionPool (getconn, putconn, closeall).
+    - getconn waits up to 'timeout' seconds for a free connection, waiters are served in FIFO order.
+    - Connections idle for more than 'check_interval' seconds are pinged on checkout, broken ones are replaced.
+    - Connections older than 'max_lifetime' seconds are closed instead of being reused.
+    - A reaper thread closes connections idle for more than 'idle_timeout' seconds down to 'minconn'
+      and keeps at least 'minconn' connections open.
+    """
+
+    def __init__(self, factory, minconn=1, maxconn=32, **kwargs):
+        self._factory = factory
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = kwargs.get('timeout', 30)
+        self.max_lifetime = kwargs.get('max_lifetime', 3600)
+        self.idle_timeout = kwargs.get('idle_timeout', 300)
+        self.check_interval = kwargs.get('check_interval', 10)
+        reap_interval = kwargs.get('reap_interval', 30)
+
+        self._lock = threading.Lock()
+        # Idle connections as [connection, created, last used], the most recently used at the right
+        self._idle = deque()
+        self._created = {}
+        self._waiters = deque()
+        self._size = 0
+        self._stopped = threading.Event()
+        self.closed = False
+
+        # Warm-up
+        for _ in range(self.minconn):
+            self._size += 1
+            self._idle.append(self._new_entry())
+
+        if reap_interval:
+            self._reaper = threading.Thread(target=self._reap_loop, args=(reap_interval,), daemon=True)
+            self._reaper.start()
+
+    def _new_entry(self):
+        try:
+            conn = self._factory()
+        except Exception:
+            with self._lock:
+                self._size -= 1
+                self._grant_capacity()
+            raise
+        now = time.monotonic()
+        self._created[id(conn)] = now
+        return [conn, now, now]
+
+    def _discard(self, conn):
+        self._created.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._size -= 1
+            self._grant_capacity()
+
+    def _grant_capacity(self):
+        # Must be called with the lock held: a slot became free, let the first waiter open a new connection
+        if self._waiters and self._size < self.maxconn and not self.closed:
+            waiter = self._waiters.popleft()
+            waiter.create = True
+            self._size += 1
+            waiter.event.set()
+
+    def _expired(self, created, now):
+        return self.max_lifetime is not None and now - created > self.max_lifetime
+
+    def _is_alive(self, conn, last_used, now):
+        if conn.closed or conn.info.transaction_status == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if self.check_interval is None or now - last_used < self.check_interval:
+            return True
+        try:
+            autocommit = conn.autocommit
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.autocommit = autocommit
+            return True
+        except psycopg2.Error as err:
+            logger.warning("Discarding broken connection: %s" % err)
+            return False
+
+    def getconn(self, key=None, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            entry, create, waiter = None, False, None
+            with self._lock:
+                if self.closed:
+                    raise PoolError("connection pool is closed")
+                if self._idle and not self._waiters:
+                    entry = self._idle.pop()
+                elif self._size < self.maxconn and not self._waiters:
+                    self._size += 1
+                    create = True
+                else:
+                    waiter = _Waiter()
+                    self._waiters.append(waiter)
+
+            if waiter is not None:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if not waiter.event.wait(remaining):
+                    with self._lock:
+                        if waiter in self._waiters:
+                            self._waiters.remove(waiter)
+                            raise PoolTimeout("no connection available within %s seconds" % timeout)
+                    # Served while timing out, fall through and use it
+                if self.closed and waiter.conn is None and not waiter.create:
+                    raise PoolError("connection pool is closed")
+                if waiter.create:
+                    create = True
+                else:
+                    conn = waiter.conn
+                    return conn
+
+            if create:
+                return self._new_entry()[0]
+
+            conn, created, last_used = entry
+            now = time.monotonic()
+            if self._expired(created, now) or not self._is_alive(conn, last_used, now):
+                self._discard(conn)
+                continue
+            return conn
+
+    def putconn(self, conn, key=None, close=False):
+        if not close and not conn.closed:
+            status = conn.info.transaction_status
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+
+        now = time.monotonic()
+        created = self._created.get(id(conn), now)
+        if close or conn.closed or self.closed or self._expired(created, now):
+            self._discard(conn)
+            return
+
+        with self._lock:
+            self._release([conn, created, now])
+
+    def _release(self, entry, oldest=False):
+        # Must be called with the lock held: hand the connection over to the first waiter or park it as idle
+        if self._waiters:
+            # The waiters are served in arrival order
+            waiter = self._waiters.popleft()
+            waiter.conn = entry[0]
+            waiter.event.set()
+        elif oldest:
+            self._idle.appendleft(entry)
+        else:
+            self._idle.append(entry)
+
+    def _reap_loop(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.reap()
+            except Exception as err:
+                logger.error("Connection pool reaper failed: %s" % err)
+
+    def reap(self):
+        """Close the idle and expired connections above 'minconn' and open new ones up to 'minconn'."""
+        now = time.monotonic()
+        reaped = []
+        with self._lock:
+            keep = deque()
+            for entry in self._idle:
+                conn, created, last_used = entry
+                idle_too_long = self.idle_timeout is not None and now - last_used > self.idle_timeout
+                if self._expired(created, now) or (idle_too_long and self._size - len(reaped) > self.minconn):
+                    reaped.append(conn)
+                else:
+                    keep.append(entry)
+            self._idle = keep
+        for conn in reaped:
+            self._discard(conn)
+
+        while not self.closed:
+            with self._lock:
+                if self._size >= self.minconn or self._waiters:
+                    break
+                self._size += 1
+            entry = self._new_entry()
+            with self._lock:
+                # A caller may have started waiting while the connection was opened
+                self._release(entry, oldest=True)
+
+    def stats(self):
+        with self._lock:
+            idle = len(self._idle)
+            return {
+                'size': self._size,
+                'idle': idle,
+                'in_use': self._size - idle,
+                'waiting': len(self._waiters),
+                'max': self.maxconn,
+            }
+
+    def closeall(self):
+        with self._lock:
+            self.closed = True
+            idle, self._idle = list(self._idle), deque()
+            waiters, self._waiters = list(self._waiters), deque()
+        self._stopped.set()
+        for waiter in waiters:
+            waiter.event.set()
+        for conn, _, _ in idle:
+            self._discard(conn)
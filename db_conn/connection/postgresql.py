@@ -1,18 +1,77 @@
 # Common Python library imports
-from functools import wraps
+from functools import wraps, partial
 from contextlib import contextmanager
 from concurrent.futures import ThreadPoolExecutor
+import atexit
+import io
+import threading
 import time
 import os
+import uuid
 
 
 # Pip package imports
 import psycopg2
-from psycopg2.pool import ThreadedConnectionPool
 from loguru import logger
 
 # Internal package imports
-from db_conn.utils import get_nested, Singleton, Tunnel
+from db_conn.utils import get_nested, Singleton, Tunnel, TunnelGroup
+from db_conn.query.bind import compile_query
+from db_conn.connection.prepared import PreparedStatementCache
+from db_conn.connection.cache import ResultCache
+from db_conn.connection.pool import BlockingConnectionPool
+from db_conn.connection.slowlog import SlowQueryLog
+from db_conn.metrics import Metrics, instrumented_cursor_factory
+from db_conn.resilience import CircuitBreaker
+
+
+# Type OIDs of the columns which can be parsed by the vectorized CSV reader
+_FLOAT_OIDS = (700, 701, 1700)
+_INTEGER_OIDS = (20, 21, 23, 26)
+_TEXT_OIDS = (18, 19, 25, 1042, 1043)
+_BOOL_OIDS = (16,)
+_DATETIME_OIDS = (1082, 1114)
+_DATETIME_TZ_OIDS = (1184,)
+
+
+def _read_copy_csv(buffer, description, cursor):
+    """Parse the CSV output of COPY ... TO STDOUT into a DataFrame, using the dtypes of the cursor description."""
+    import pandas as pd
+
+    dtypes = {}
+    for i, col in enumerate(description):
+        if col.type_code in _FLOAT_OIDS:
+            dtypes[i] = 'float64'
+        elif col.type_code not in _INTEGER_OIDS:
+            # Everything else is parsed as text and converted afterwards
+            dtypes[i] = object
+
+    df = pd.read_csv(buffer, header=None, names=list(range(len(description))), dtype=dtypes,
+                     na_values=['\\N'], keep_default_na=False)
+
+    for i, col in enumerate(description):
+        if col.type_code in _FLOAT_OIDS or col.type_code in _INTEGER_OIDS:
+            continue
+        series = df[i]
+        if col.type_code in _DATETIME_OIDS:
+            df[i] = pd.to_datetime(series)
+        elif col.type_code in _DATETIME_TZ_OIDS:
+            df[i] = pd.to_datetime(series, utc=True)
+        elif col.type_code in _BOOL_OIDS:
+            df[i] = series.map({'t': True, 'f': False}).where(series.notna(), None)
+        elif col.type_code in _TEXT_OIDS:
+            df[i] = series.where(series.notna(), None)
+        else:
+            # JSON, arrays, ... are converted by the registered psycopg2 typecaster
+            caster = psycopg2.extensions.string_types.get(col.type_code)
+            if caster is None:
+                df[i] = series.where(series.notna(), None)
+            else:
+                df[i] = [caster(value, cursor) if isinstance(value, str) else None for value in series]
+
+    # Column names are assigned at the end since a result may hold duplicated names
+    df.columns = [col.name for col in description]
+    return df
 
 
 class Connection():
@@ -21,7 +80,18 @@ class Connection():
         'db_username': '',
         'db_password': '',
         'db_address': ('127.0.0.1', 8080),
-        'db_name': os.environ.get('DB_NAME')
+        'db_name': os.environ.get('DB_NAME'),
+        'prepared_statements': 0,
+        'result_cache_size': 0,
+        'result_cache_ttl': 60,
+        # Statements running longer than this many milliseconds are logged, disabled if 0
+        'slow_query_ms': 0,
+        # Fraction of all statements logged regardless of their duration
+        'slow_query_sample_rate': 0.0,
+        'slow_query_size': 128,
+        'slow_query_explain': True,
+        # Seconds before the plan of a query shape is captured again
+        'slow_query_explain_interval': 300
     }
 
     def __init__(self, *args, **kwargs):
@@ -29,17 +99,39 @@ class Connection():
         self._config = { **Connection.config , **kwargs.get('config', {})}
         self._tunnel = kwargs.get('tunnel', None)
         self._cursor = None
+        self.metrics = kwargs.get('metrics', None) or Metrics()
 
         username = os.environ.get('DB_USERNAME', kwargs.get('username', self._get_config('db_username')))
         password = os.environ.get('DB_PASSWORD', kwargs.get('password', self._get_config('db_password')))
+        self._credentials = (username, password)
 
         # Open the tunnel if give, to establish the database connection.
         self._open_tunnel()
         # The connection has to be started first to get the local bind address
         if self._tunnel is not None:
-            assert isinstance(self._tunnel, Tunnel), "Input argument \'tunnel\' must be a type of Tunnel object"
+            assert isinstance(self._tunnel, (Tunnel, TunnelGroup)), \
+                "Input argument \'tunnel\' must be a type of Tunnel or TunnelGroup object"
             self._config['db_address'] = self._tunnel.local_bind_addresses[0]
 
+        # Per connection cache of server-side prepared statements, disabled if the size is 0
+        prepared_statements = self._config.get('prepared_statements', 0)
+        self._prepared = PreparedStatementCache(prepared_statements) if prepared_statements else None
+        # Opt-in cache of sql_query results, disabled if the size is 0
+        result_cache_size = self._config.get('result_cache_size', 0)
+        self._result_cache = ResultCache(result_cache_size, self._config.get('result_cache_ttl', 60)) \
+            if result_cache_size else None
+        # Opt-in log of the slow statements, their plans are captured on a separate connection
+        slow_query_ms = self._config.get('slow_query_ms', 0)
+        slow_query_sample_rate = self._config.get('slow_query_sample_rate', 0.0)
+        self.slow_queries = SlowQueryLog(slow_query_ms, slow_query_sample_rate,
+                                         size=self._config.get('slow_query_size', 128),
+                                         explain_interval=self._config.get('slow_query_explain_interval', 300),
+                                         connect=self._connect_factory(username, password)
+                                         if self._config.get('slow_query_explain', True) else None) \
+            if slow_query_ms or slow_query_sample_rate else None
+        # Every cursor records its statement latencies and rows into the metrics
+        self._cursor_factory = instrumented_cursor_factory(self.metrics, self.slow_queries)
+
         self._connection = self._create_connection(username, password)
 
     def __del__(self):
@@ -68,10 +160,44 @@ class Connection():
                 connection.commit()
 
 
+    def execute(self, cursor, query):
+        """Execute a query on the cursor, through the prepared statement cache if it is enabled."""
+        sql, params = compile_query(query)
+        if self._prepared is not None and params is not None:
+            self._prepared.execute(cursor, sql, params)
+        else:
+            cursor.execute(sql, params)
+
     def sql_query(self, query):
+        return self._cached_query(query, lambda: self._sql_query(self._connection, query))
+
+    def _cached_query(self, query, fetch):
+        if self._result_cache is None:
+            return fetch()
+        key = ResultCache.key(*compile_query(query))
+        df = self._result_cache.get(key)
+        if df is None:
+            generation = self._result_cache.generation
+            df = fetch()
+            if df is not None:
+                self._result_cache.set(key, df, generation)
+        # Callers get their own copy, so the cached frame can not be modified
+        return df.copy() if df is not None else None
+
+    def invalidate_cache(self, *tables):
+        """Drop the cached results of the queries referencing any of the tables."""
+        if self._result_cache is not None:
+            self._result_cache.invalidate(*tables)
+
+    def _sql_query(self, connection, query):
+        if self._prepared is None:
+            return self.s_sql_query(connection, query)
         try:
             import pandas as pd
-            return pd.read_sql_query(str(query), self._connection)
+            with connection.cursor() as cur:
+                self.execute(cur, query)
+                return pd.DataFrame.from_records(cur.fetchall(), columns=[col.name for col in cur.description],
+                                                 coerce_float=True)
         except ImportError as err:
             logger.error(err)
 
@@ -79,10 +205,64 @@ class Connection():
     def s_sql_query(connection, query):
         try:
             import pandas as pd
-            return pd.read_sql_query(str(query), connection)
+            sql, params = compile_query(query)
+            return pd.read_sql_query(sql, connection, params=params)
         except ImportError as err:
             logger.error(err)
 
+    def sql_query_copy(self, query):
+        """Fetch the query result with COPY ... TO STDOUT and parse it with the vectorized pandas CSV reader.
+
+        Faster than sql_query for wide and long results. Dtypes are derived from the cursor description, date
+        and timestamp columns are returned as datetime64 columns. NUMERIC columns are parsed to float64, the way
+        pandas coerces the Decimal values in sql_query, so digits beyond the float precision are lost.
+        """
+        return self.s_sql_query_copy(self._connection, query)
+
+    @staticmethod
+    def s_sql_query_copy(connection, query):
+        sql, params = compile_query(query)
+        buffer = io.StringIO()
+        with connection.cursor() as cur:
+            # COPY does not accept bind parameters, they are rendered on the client side
+            if params is not None:
+                sql = cur.mogrify(sql, params).decode(psycopg2.extensions.encodings[connection.encoding])
+            sql = sql.strip().rstrip(';')
+            # Describe the result without fetching any rows
+            cur.execute('SELECT * FROM (%s) AS q LIMIT 0' % sql)
+            description = cur.description
+            cur.copy_expert("COPY (%s) TO STDOUT WITH (FORMAT csv, NULL '\\N')" % sql, buffer)
+            buffer.seek(0)
+            return _read_copy_csv(buffer, description, cur)
+
+    def sql_query_chunks(self, query, chunk_size=1000, dataframe=True):
+        """Run the query on a server-side cursor and yield the result in chunks of 'chunk_size' rows.
+
+        The chunks are pandas DataFrames, or lists of row tuples if 'dataframe' is False. Only one chunk is held
+        in memory at a time.
+        """
+        return self.s_sql_query_chunks(self._connection, query, chunk_size, dataframe)
+
+    @staticmethod
+    def s_sql_query_chunks(connection, query, chunk_size=1000, dataframe=True):
+        if dataframe:
+            import pandas as pd
+        # Named cursors are declared on the server and fetched lazily
+        cursor = connection.cursor(name='db_conn_%s' % uuid.uuid4().hex)
+        cursor.itersize = chunk_size
+        try:
+            cursor.execute(*compile_query(query))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                if dataframe:
+                    yield pd.DataFrame.from_records(rows, columns=[col.name for col in cursor.description])
+                else:
+                    yield rows
+        finally:
+            cursor.close()
+
     def close(self):
         self._connection.close()
 
@@ -93,19 +273,42 @@ class Connection():
             self.close()
         except Exception as err:
             logger.error(err)
+        if self.slow_queries is not None:
+            self.slow_queries.close()
         # Close the tunnel also
         self._close_tunnel()
 
     def restart(self):
+        if self._prepared is not None:
+            self._prepared.clear()
+        if self._result_cache is not None:
+            self._result_cache.clear()
         if self._tunnel is not None:
             self._tunnel.restart()
+            self._tunnel.wait_ready()
+
+    def clone_kwargs(self):
+        """Keyword arguments of an equivalent connection, e.g. in a child process, using the already opened tunnel."""
+        return {
+            'config': dict(self._config),
+            'username': self._credentials[0],
+            'password': self._credentials[1]
+        }
 
     def _create_connection(self, username, password):
-        return psycopg2.connect(user=username,
-                         password=password,
-                         host=self._get_config('db_address')[0],
-                         port=self._get_config('db_address')[1],
-                         database=self._get_config('db_name'))
+        return self._instrument(self._connect_factory(username, password)())
+
+    def _connect_factory(self, username, password):
+        return partial(psycopg2.connect,
+                       user=username,
+                       password=password,
+                       host=self._get_config('db_address')[0],
+                       port=self._get_config('db_address')[1],
+                       database=self._get_config('db_name'))
+
+    def _instrument(self, connection):
+        connection.cursor_factory = self._cursor_factory
+        return connection
 
     def _get_config(self, *args):
         data = get_nested(self._config, *args)
@@ -115,7 +318,7 @@ class Connection():
     def _open_tunnel(self):
         if self._tunnel is not None:
             self._tunnel.start()
-            time.sleep(10)
+            self._tunnel.wait_ready()
 
     def _close_tunnel(self):
         if self._tunnel is not None:
@@ -128,25 +331,69 @@ class ConnectionPool(Connection, metaclass=Singleton):
         'db_password': '',
         'db_address': ('127.0.0.1', 8080),
         'db_name': os.environ.get('DB_NAME'),
+        'prepared_statements': 0,
+        'result_cache_size': 0,
+        'result_cache_ttl': 60,
+        'slow_query_ms': 0,
+        'slow_query_sample_rate': 0.0,
+        'slow_query_size': 128,
+        'slow_query_explain': True,
         'min_connection': 1,
-        'max_connection': 800
+        'max_connection': 32,
+        # Seconds to wait for a free connection before PoolTimeout is raised
+        'pool_timeout': 30,
+        # Seconds after which a connection is closed instead of being reused
+        'max_lifetime': 3600,
+        # Seconds after which idle connections above 'min_connection' are closed
+        'idle_timeout': 300,
+        # Idle seconds after which a connection is pinged on checkout
+        'health_check_interval': 10,
+        # Consecutive connection failures after which the checkouts fail fast with CircuitOpenError, 0 disables it
+        'breaker_threshold': 5,
+        # Seconds before the first probe of an open breaker, growing with jitter up to 'breaker_max_reset'
+        'breaker_reset': 1.0,
+        'breaker_max_reset': 30.0
     }
 
     def __init__(self, *args, **kwargs):
 
         kwargs['config'] = { **ConnectionPool.config, **kwargs.get('config',{}) }
 
+        # Shared by every user of the pool
+        config = kwargs['config']
+        self.breaker = CircuitBreaker(config['breaker_threshold'], config['breaker_reset'],
+                                      config['breaker_max_reset'], name=config.get('db_name') or 'database') \
+            if config.get('breaker_threshold') else None
+
         super(ConnectionPool, self).__init__(*args, **kwargs)
 
+        for name in ('size', 'idle', 'in_use', 'waiting'):
+            self.metrics.register_gauge('pool.%s' % name, partial(self._pool_stat, name))
+        if self.breaker is not None:
+            self.metrics.register_gauge('pool.breaker_open', lambda: int(self.breaker.state != CircuitBreaker.CLOSED))
+
+    def _pool_stat(self, name):
+        return self._connection.stats()[name]
 
     def _create_connection(self, username, password):
-        return ThreadedConnectionPool(minconn=self._get_config('min_connection'),
+        connect = self._connect_factory(username, password)
+
+        def factory():
+            if not isinstance(self._tunnel, TunnelGroup):
+                return self._instrument(connect())
+            # Spread the connections over the tunnels of the group
+            address = self._tunnel.next_address()
+            conn = connect(host=address[0], port=address[1])
+            self._tunnel.track(address, conn)
+            return self._instrument(conn)
+
+        return BlockingConnectionPool(factory,
+                                      minconn=self._get_config('min_connection'),
                                       maxconn=self._get_config('max_connection'),
-                                      user=username,
-                                      password=password,
-                                      host=self._get_config('db_address')[0],
-                                      port=self._get_config('db_address')[1],
-                                      database=self._get_config('db_name'))
+                                      timeout=self._config.get('pool_timeout'),
+                                      max_lifetime=self._config.get('max_lifetime'),
+                                      idle_timeout=self._config.get('idle_timeout'),
+                                      check_interval=self._config.get('health_check_interval'))
 
     @contextmanager
     def get_cursor(self, **kwargs):
@@ -177,41 +424,186 @@ class ConnectionPool(Connection, metaclass=Singleton):
                     connection.commit()
 
     def sql_query(self, query):
-        try:
-            import pandas as pd
+        def fetch():
             with self.get_connection() as conn:
-                return pd.read_sql_query(str(query), conn)
-        except ImportError as err:
-            logger.error(err)
+                return self._sql_query(conn, query)
+        return self._cached_query(query, fetch)
+
+    def sql_query_copy(self, query):
+        with self.get_connection() as conn:
+            return self.s_sql_query_copy(conn, query)
+
+    def sql_query_many(self, queries, max_workers=None):
+        """Run the queries concurrently, each on its own pooled connection.
+
+        The DataFrames are returned in the order of the queries. At most 'max_workers' queries run at the same
+        time, by default one per query up to the 'max_connection' pool size.
+        """
+        queries = list(queries)
+        if not queries:
+            return []
+        max_workers = max_workers or min(len(queries), self._get_config('max_connection'))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.sql_query, queries))
+
+    def sql_query_chunks(self, query, chunk_size=1000, dataframe=True):
+        # The pooled connection is held until the generator is exhausted or closed.
+        with self.get_connection() as conn:
+            yield from self.s_sql_query_chunks(conn, query, chunk_size, dataframe)
 
     @contextmanager
     def get_connection(self):
-        conn = self._connection.getconn()
+        start = time.perf_counter()
+        probe = False
+        if self.breaker is not None:
+            # Fails fast while the database is known to be down
+            self.breaker.before_call()
+            probe = self.breaker.state == CircuitBreaker.HALF_OPEN
+        try:
+            conn = self._connection.getconn()
+            if probe:
+                # A recently used connection is handed out without a round trip, the probe pings it, so a half-open
+                # breaker is closed by the database answering and does not wait for a long-held connection
+                self._ping(conn)
+        except Exception as err:
+            if self.breaker is not None:
+                self.breaker.record_failure(err)
+            raise
+        if probe:
+            self.breaker.record_success()
+        checked_out = time.perf_counter()
+        self.metrics.observe('pool.checkout_wait', checked_out - start)
         # TODO: Test code
         #conn.autocommit = False
         try:
             yield conn
+        except Exception as err:
+            if self.breaker is not None:
+                self.breaker.record_failure(err)
+            raise
+        else:
+            if self.breaker is not None and not probe:
+                self.breaker.record_success()
         finally:
             # Code to release resource, e.g.:
             self._connection.putconn(conn)
+            self.metrics.observe('pool.hold', time.perf_counter() - checked_out)
+
+    def _ping(self, conn):
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+        except Exception:
+            self._connection.putconn(conn, close=True)
+            raise
 
     def close(self):
         self._connection.closeall()
 
+class _Session(object):
+    """Warm tunnel and connection pool shared by the db_session calls with the same credentials and target."""
+
+    def __init__(self, username, password, max_connection=8):
+        self.tunnel = Tunnel(username=username, password=password)
+        self.tunnel.start()
+        try:
+            self.tunnel.wait_ready()
+            config = Connection.config
+            connect = partial(psycopg2.connect,
+                              user=os.environ.get('DB_USERNAME', username),
+                              password=os.environ.get('DB_PASSWORD', password),
+                              host=self.tunnel.local_bind_addresses[0][0],
+                              port=self.tunnel.local_bind_addresses[0][1],
+                              database=config['db_name'])
+            self.pool = BlockingConnectionPool(connect, minconn=1, maxconn=max_connection)
+        except BaseException:
+            # The tunnel would be left open by the failed session
+            self.tunnel.stop()
+            raise
+
+    @contextmanager
+    def get_connection(self):
+        if not self.tunnel.is_active:
+            logger.warning("Session tunnel is down, restarting it.")
+            self.tunnel.restart()
+            self.tunnel.wait_ready()
+        conn = self.pool.getconn()
+        try:
+            yield conn
+        finally:
+            # Whatever the function did not commit must not leak into the next call
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self.pool.putconn(conn, close=True)
+            else:
+                self.pool.putconn(conn)
+
+    def close(self):
+        self.pool.closeall()
+        self.tunnel.stop()
+
+
+_sessions = {}
+# Guards the dictionaries, every session is opened under the lock of its own key
+_sessions_lock = threading.Lock()
+_session_locks = {}
+
+
+def _session_key(username, password):
+    return (username, password,
+            tuple(Tunnel.config['ssh_address_or_host']), tuple(Tunnel.config['remote_bind_address']),
+            Connection.config['db_name'])
+
+
+def get_session(username, password):
+    """Return the session of the credentials and target, opening its tunnel and pool on the first call."""
+    key = _session_key(username, password)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is not None:
+            return session
+        key_lock = _session_locks.setdefault(key, threading.Lock())
+    # Starting the tunnel takes up to its 'ready_timeout', the sessions of other keys are not blocked meanwhile
+    with key_lock:
+        with _sessions_lock:
+            session = _sessions.get(key)
+        if session is None:
+            session = _Session(username, password)
+            with _sessions_lock:
+                _sessions[key] = session
+        return session
+
+
+@atexit.register
+def close_sessions():
+    """Close the pools and tunnels of all db_session sessions."""
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        try:
+            session.close()
+        except Exception as err:
+            logger.error(err)
+
+
 def db_session(username, password):
     def deco_session(f):
         @wraps(f)
         def f_connect(*args, **kwargs):
-            db = Connection(username=username,
-                            password=password,
-                            tunnel=Tunnel(username=username,
-                                          password=password))
-
-            with db.get_cursor() as curr:
-                kwargs['cursor'] = curr
-                kwargs['connection'] = db.connection
-                return f(*args, **kwargs)
+            session = get_session(username, password)
+
+            with session.get_connection() as connection:
+                with connection.cursor() as curr:
+                    kwargs['cursor'] = curr
+                    kwargs['connection'] = connection
+                    try:
+                        return f(*args, **kwargs)
+                    except psycopg2.IntegrityError:
+                        # The transaction is rolled back when the connection is returned
+                        return None
 
         return f_connect  # true decorator
     return deco_session
-
@@ -0,0 +1,78 @@
+# Common Python library imports
+import itertools
+import re
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+
+# Pip package imports
+from loguru import logger
+
+
+_PLACEHOLDER = re.compile(r'%%|%s')
+
+
+def to_positional(sql):
+    """Convert the %s placeholders of a psycopg2 statement into the $1, $2, ... form used by PREPARE."""
+    counter = itertools.count(1)
+    return _PLACEHOLDER.sub(lambda m: '%' if m.group(0) == '%%' else '$%d' % next(counter), sql)
+
+
+class PreparedStatementCache(object):
+    """LRU cache of server-side prepared statements, kept separately for every connection.
+
+    Each distinct statement text (query shape) is prepared once per connection and executed with new parameters
+    afterwards. A connection is recognised by its backend process id, so the statements are forgotten
+    automatically when a connection is re-established.
+    """
+
+    def __init__(self, size=128):
+        self.size = size
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._names = itertools.count()
+
+    def _statements(self, connection):
+        key = id(connection)
+        pid = connection.get_backend_pid()
+        with self._lock:
+            entry = self._connections.get(key)
+            if entry is None or entry[0] != pid:
+                entry = (pid, OrderedDict())
+                self._connections[key] = entry
+            return entry[1]
+
+    def execute(self, cursor, sql, params=None):
+        statements = self._statements(cursor.connection)
+        name = statements.get(sql)
+        if name is None:
+            with self._lock:
+                name = 'db_conn_stmt_%d' % next(self._names)
+            cursor.execute('PREPARE %s AS %s' % (name, to_positional(sql)))
+            statements[sql] = name
+            if len(statements) > self.size:
+                _, evicted = statements.popitem(last=False)
+                logger.debug("Deallocating prepared statement: %s" % evicted)
+                cursor.execute('DEALLOCATE %s' % evicted)
+        else:
+            statements.move_to_end(sql)
+
+        # The slow query log records the statement itself, not its EXECUTE
+        record_as = getattr(cursor, 'record_as', None)
+        with record_as(sql, params) if record_as is not None else nullcontext():
+            if params:
+                cursor.execute('EXECUTE %s (%s)' % (name, ', '.join(['%s'] * len(params))), params)
+            else:
+                cursor.execute('EXECUTE %s' % name)
+
+    def forget(self, connection):
+        with self._lock:
+            self._connections.pop(id(connection), None)
+
+    def clear(self):
+        with self._lock:
+            self._connections.clear()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(statements) for _, statements in self._connections.values())
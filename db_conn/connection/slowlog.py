@@ -0,0 +1,125 @@
+# Common Python library imports
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Pip package imports
+from loguru import logger
+
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'(?<![\w"$])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b')
+_PLACEHOLDER = re.compile(r'%\(\w+\)s|%s|\$\d+')
+_VALUE_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_ROW_LIST = re.compile(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+')
+_EXPLAINABLE = re.compile(r'^\s*(?:SELECT|WITH)\b', re.IGNORECASE)
+
+
+def query_shape(sql):
+    """Normalize a statement to its shape: literals and placeholders become '?' and value lists are collapsed."""
+    shape = _STRING_LITERAL.sub('?', sql)
+    shape = _PLACEHOLDER.sub('?', shape)
+    shape = _NUMBER_LITERAL.sub('?', shape)
+    shape = _VALUE_LIST.sub('(...)', shape)
+    shape = _ROW_LIST.sub('(...)', shape)
+    return ' '.join(shape.split()).rstrip(';')
+
+
+class SlowQueryLog(object):
+    """Log of the statements running longer than 'threshold' milliseconds, plus a 'sample_rate' fraction of all.
+
+    The recorded statements are grouped by their shape in a bounded LRU of 'size' shapes, each keeping the last
+    'samples' statements. If 'connect' is given, the plan of the read-only statements is captured with
+    EXPLAIN (ANALYZE, BUFFERS) on a separate connection, in a background thread. ANALYZE runs the statement
+    again, so a shape is explained at most once per 'explain_interval' seconds and the statements recorded while
+    an explain is running are not explained.
+    """
+
+    def __init__(self, threshold=500, sample_rate=0.0, size=128, samples=5, connect=None, explain_interval=300):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.size = size
+        self.samples = samples
+        self.explain_interval = explain_interval
+        self._connect = connect
+        self._explain_pending = False
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._explain_connection = None
+        self._executor = ThreadPoolExecutor(max_workers=1) if connect is not None else None
+
+    def record(self, sql, params, duration):
+        """Called with the executed statement and its duration in seconds."""
+        slow = self.threshold and duration * 1000 >= self.threshold
+        if not slow and not (self.sample_rate and random.random() < self.sample_rate):
+            return
+        shape = query_shape(sql)
+        sample = {
+            'sql': sql,
+            'params': params,
+            'duration': duration,
+            'time': time.time(),
+            'slow': bool(slow),
+            'plan': None
+        }
+        with self._lock:
+            entry = self._entries.pop(shape, None)
+            if entry is None:
+                entry = {'shape': shape, 'count': 0, 'total': 0.0, 'max': 0.0, 'samples': deque(maxlen=self.samples),
+                         'explained': None}
+            entry['count'] += 1
+            entry['total'] += duration
+            entry['max'] = max(entry['max'], duration)
+            entry['samples'].append(sample)
+            self._entries[shape] = entry
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+            explain = self._executor is not None and not self._explain_pending and _EXPLAINABLE.match(sql) and \
+                (entry['explained'] is None or time.monotonic() - entry['explained'] >= self.explain_interval)
+            if explain:
+                entry['explained'] = time.monotonic()
+                self._explain_pending = True
+
+        if slow:
+            logger.warning("Slow query (%.1f ms): %s Parameters: %s" % (duration * 1000, sql, params))
+        if explain:
+            self._executor.submit(self._explain, sample)
+
+    def _explain(self, sample):
+        try:
+            if self._explain_connection is None or self._explain_connection.closed:
+                self._explain_connection = self._connect()
+            with self._explain_connection.cursor() as cur:
+                cur.execute('EXPLAIN (ANALYZE, BUFFERS) ' + sample['sql'], sample['params'])
+                sample['plan'] = '\n'.join(row[0] for row in cur.fetchall())
+        except Exception as err:
+            logger.error("Failed to explain the slow query: %s" % err)
+            sample['plan'] = None
+        finally:
+            # ANALYZE executes the statement, never keep anything it did
+            try:
+                self._explain_connection.rollback()
+            except Exception:
+                self._explain_connection = None
+            with self._lock:
+                self._explain_pending = False
+
+    def entries(self):
+        """Recorded query shapes, the ones with the largest total time first."""
+        with self._lock:
+            entries = [dict(entry, samples=list(entry['samples'])) for entry in self._entries.values()]
+        return sorted(entries, key=lambda entry: entry['total'], reverse=True)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        if self._explain_connection is not None:
+            self._explain_connection.close()
+            self._explain_connection = None
@@ -0,0 +1,84 @@
+# Common Python library imports
+import json
+import os
+import threading
+
+# Pip package imports
+from psycopg2.errors import DuplicateTable, UniqueViolation
+from psycopg2.extras import Json, execute_values
+
+
+_COLUMNS = ('queue', 'worker', 'table_name', 'statement', 'columns', 'rows', 'error', 'sqlstate')
+
+
+def _dumps(value):
+    # Dates, decimals, ... of the failed rows are kept as their string form
+    return json.dumps(value, default=str)
+
+
+class DeadLetterFile(object):
+    """Dead-letter sink appending the failed items to a JSON lines file, one record per line.
+
+    The records are written when the transaction of their batch is about to be committed. If 'fsync' is set the
+    file is synced to the disk after every write.
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def __getstate__(self):
+        return {'path': self.path, 'fsync': self.fsync}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def put(self, records, cursor=None):
+        data = ''.join(_dumps(record) + '\n' for record in records)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(data)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+
+    def read(self):
+        """The records written so far."""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+
+class DeadLetterTable(object):
+    """Dead-letter sink inserting the failed items into a table, in the transaction of their batch.
+
+    The table is created on the first use, the failed rows are stored as JSONB.
+    """
+
+    def __init__(self, table='db_conn_dead_letter'):
+        self.table = table
+
+    def _create(self, cursor):
+        # Workers creating the table at the same time collide on the catalog, the loser keeps its transaction
+        cursor.execute('SAVEPOINT db_conn_dead_letter')
+        try:
+            cursor.execute('CREATE TABLE IF NOT EXISTS "%s" (id BIGSERIAL PRIMARY KEY, created TIMESTAMPTZ NOT NULL '
+                           'DEFAULT now(), queue TEXT, worker INTEGER, table_name TEXT, statement TEXT, '
+                           'columns JSONB, rows JSONB, error TEXT, sqlstate TEXT)' % self.table)
+        except (DuplicateTable, UniqueViolation):
+            cursor.execute('ROLLBACK TO SAVEPOINT db_conn_dead_letter')
+        else:
+            cursor.execute('RELEASE SAVEPOINT db_conn_dead_letter')
+
+    def put(self, records, cursor):
+        self._create(cursor)
+        rows = [tuple(Json(record.get(c), dumps=_dumps) if c in ('columns', 'rows') else record.get(c)
+                      for c in _COLUMNS) for record in records]
+        execute_values(cursor, 'INSERT INTO "%s" (%s) VALUES %%s' % (self.table, ','.join(_COLUMNS)), rows)
@@ -0,0 +1,219 @@
+# Common Python library imports
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Pip package imports
+from psycopg2 import extensions
+from loguru import logger
+
+
+# Latency bucket upper bounds in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    return '%s[%s]' % (name, ','.join('%s=%s' % item for item in sorted(labels.items())))
+
+
+class Histogram(object):
+    """Fixed bucket histogram, the last bucket counts the values above the largest bound."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate of the q quantile: the upper bound of the bucket holding it."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': dict(zip(self.buckets + (float('inf'),), self.counts)),
+        }
+
+
+class Metrics(object):
+    """Registry of counters, gauges and latency histograms.
+
+    snapshot() returns the current values. Hooks added with add_hook() are called on every recorded value as
+    hook(kind, name, value, labels) with kind being 'counter', 'gauge' or 'histogram', so the values can be
+    exported without polling. Gauges can also be registered as callbacks, evaluated at snapshot time.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._gauge_callbacks = {}
+        self._histograms = {}
+        self._hooks = []
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def _notify(self, kind, name, value, labels):
+        for hook in list(self._hooks):
+            try:
+                hook(kind, name, value, labels)
+            except Exception as err:
+                logger.error("Metrics hook failed: %s" % err)
+
+    def increment(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._notify('counter', name, value, labels)
+
+    def counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get(_key(name, labels), 0)
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[_key(name, labels)] = value
+        self._notify('gauge', name, value, labels)
+
+    def register_gauge(self, name, callback, **labels):
+        with self._lock:
+            self._gauge_callbacks[_key(name, labels)] = callback
+
+    def unregister_gauge(self, name, **labels):
+        with self._lock:
+            self._gauge_callbacks.pop(_key(name, labels), None)
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+        self._notify('histogram', name, value, labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            callbacks = dict(self._gauge_callbacks)
+            histograms = {key: histogram.snapshot() for key, histogram in self._histograms.items()}
+        for key, callback in callbacks.items():
+            try:
+                gauges[key] = callback()
+            except Exception as err:
+                logger.error("Metrics gauge \'%s\' failed: %s" % (key, err))
+        return {'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+
+class InstrumentedCursor(extensions.cursor):
+    """Cursor recording the execution and fetch latency and the returned rows into the class' metrics.
+
+    If the class has a slowlog, every executed statement is passed to it with its duration.
+    """
+    metrics = None
+    slowlog = None
+    _record_as = None
+
+    @contextmanager
+    def record_as(self, query, vars=None):
+        """Pass the statements executed in the block to the slowlog as 'query', e.g. the SQL behind an EXECUTE."""
+        self._record_as = (query, vars)
+        try:
+            yield self
+        finally:
+            self._record_as = None
+
+    def _timed(self, name, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.metrics.observe(name, time.perf_counter() - start)
+
+    def _statement(self, func, query, vars):
+        start = time.perf_counter()
+        try:
+            return func(query, vars)
+        finally:
+            duration = time.perf_counter() - start
+            self.metrics.observe('query.execute', duration)
+            if self.slowlog is not None:
+                if self._record_as is not None:
+                    query, vars = self._record_as
+                self.slowlog.record(query.decode() if isinstance(query, bytes) else str(query), vars, duration)
+
+    def execute(self, query, vars=None):
+        return self._statement(super(InstrumentedCursor, self).execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._statement(super(InstrumentedCursor, self).executemany, query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._timed('query.copy', super(InstrumentedCursor, self).copy_expert, sql, file, size)
+
+    def _fetch(self, func, *args):
+        rows = self._timed('query.fetch', func, *args)
+        self.metrics.increment('query.rows', len(rows) if isinstance(rows, list) else int(rows is not None))
+        return rows
+
+    def fetchone(self):
+        return self._fetch(super(InstrumentedCursor, self).fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetch(super(InstrumentedCursor, self).fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._fetch(super(InstrumentedCursor, self).fetchall)
+
+
+def instrumented_cursor_factory(metrics, slowlog=None):
+    """Cursor class recording into the given metrics, to be used as the cursor_factory of connections."""
+    return type('InstrumentedCursor', (InstrumentedCursor,), {'metrics': metrics, 'slowlog': slowlog})
@@ -1 +1,2 @@
-from db_conn.query import sc_soccer
\ No newline at end of file
+from db_conn.query.bind import Binder, BoundQuery, compile_query
+from db_conn.query import sc_soccer
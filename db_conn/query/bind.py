@@ -0,0 +1,114 @@
+# Common Python library imports
+import re
+from functools import wraps
+
+# Pip package imports
+from pypika import Parameter
+from pypika.queries import QueryBuilder
+from pypika.terms import Function, ValueWrapper
+
+
+_PLACEHOLDER = re.compile(r'%\((p\d+)\)s')
+# A placeholder or a literal '%', e.g. of a LIKE pattern, which has to be escaped for psycopg2
+_PLACEHOLDER_OR_PERCENT = re.compile(r'%\((p\d+)\)s|%')
+
+
+def _literal(value):
+    if isinstance(value, (list, tuple)):
+        if not value:
+            return "'{}'"
+        return 'ARRAY[%s]' % ','.join(_literal(v) for v in value)
+    return ValueWrapper(value).get_sql()
+
+
+class Binder(object):
+    """Collects the bind values of a query builder and hands out their placeholders.
+
+    Example:
+        b = Binder()
+        q = Query.from_(m).select(m.star).where(m.season_id == b(season_id))
+        return b.bind(q)
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def __call__(self, value):
+        name = 'p%d' % len(self.values)
+        self.values[name] = value
+        return Parameter('%%(%s)s' % name)
+
+    def any(self, field, values):
+        """Membership test binding the whole list as a single array parameter: field = ANY(%s)"""
+        return field == Function('ANY', self(list(values)))
+
+    def bind(self, query):
+        return BoundQuery(query, self.values)
+
+
+class BoundQuery(object):
+    """A pypika query holding placeholders together with the values bound to them.
+
+    compile() returns the SQL text with positional %s placeholders and the parameter tuple, which can be executed
+    directly: cursor.execute(*query). str() renders the values inline for backward compatibility.
+    Builder methods are forwarded to the wrapped query, so the result can still be refined, e.g.: query.limit(10)
+    """
+    __slots__ = ('query', 'values')
+
+    def __init__(self, query, values=None):
+        self.query = query
+        self.values = dict(values or {})
+
+    def compile(self):
+        params = []
+
+        def placeholder(match):
+            if match.group(1) is None:
+                return '%%'
+            params.append(self.values[match.group(1)])
+            return '%s'
+
+        return _PLACEHOLDER_OR_PERCENT.sub(placeholder, str(self.query)), tuple(params)
+
+    @property
+    def sql(self):
+        return self.compile()[0]
+
+    @property
+    def params(self):
+        return self.compile()[1]
+
+    def __iter__(self):
+        return iter(self.compile())
+
+    def __str__(self):
+        return _PLACEHOLDER.sub(lambda match: _literal(self.values[match.group(1)]), str(self.query))
+
+    def __repr__(self):
+        return '<BoundQuery %r %r>' % self.compile()
+
+    def __getattr__(self, name):
+        if name in BoundQuery.__slots__:
+            raise AttributeError(name)
+        attr = getattr(self.query, name)
+        if not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def forward(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            return BoundQuery(result, self.values) if isinstance(result, QueryBuilder) else result
+
+        return forward
+
+
+def compile_query(query):
+    """Return the SQL text and the bind parameters (or None) of a query.
+
+    Accepts BoundQuery objects, (sql, params) pairs and anything else rendering to SQL through str().
+    """
+    if isinstance(query, BoundQuery):
+        return query.compile()
+    if isinstance(query, tuple) and len(query) == 2:
+        return str(query[0]), query[1]
+    return str(query), None
@@ -2,4 +2,6 @@ from .tables import *
 from .insert import *
 from .update import *
 from .select import *
-from .complex import *
\ No newline at end of file
+from .complex import *
+from .bulk import *
+from .dimensions import *
@@ -0,0 +1,202 @@
+# Common Python library imports
+import json
+from datetime import date, datetime, time
+
+# Pip package imports
+from pypika import Table
+
+# Internal package imports
+from db_conn.query.sc_soccer import tables
+
+
+# Columns which need a dedicated text representation in COPY. Keep in sync with create.py
+json_columns = {
+    tables.statistics.get_table_name(): ('sc_statistics', 'fd_statistics', 'sc_forms', 'sc_votes',
+                                         'sc_manager_duels', 'sc_h2h'),
+    tables.odds.get_table_name(): ('sc_odds', 'fd_odds'),
+    tables.players_stats.get_table_name(): ('sc_stat', 'fifa_stat'),
+}
+
+array_columns = {
+    tables.lineups.get_table_name(): ('formation',),
+}
+
+# Primary keys of the tables, e.g. the merge_keys of an InsertQueue. Keep in sync with create.py
+primary_keys = {
+    tables.tournaments.get_table_name(): ('tournament_id',),
+    tables.seasons.get_table_name(): ('season_id',),
+    tables.teams.get_table_name(): ('team_id',),
+    tables.players.get_table_name(): ('sc_player_id',),
+    tables.referees.get_table_name(): ('referee_id',),
+    tables.managers.get_table_name(): ('manager_id',),
+    tables.stadiums.get_table_name(): ('stadium_id',),
+    tables.matches.get_table_name(): ('match_id',),
+    tables.lineups.get_table_name(): ('match_id', 'team_id'),
+    tables.player_lineups.get_table_name(): ('match_id', 'team_id', 'sc_player_id'),
+    tables.players_stats.get_table_name(): ('sc_player_id', 'match_id'),
+}
+
+# Tables in the order of their foreign keys, parents first, e.g. the insert_order of an InsertQueue
+insert_order = tuple(table.get_table_name() for table in (
+    tables.tournaments, tables.seasons, tables.teams, tables.players, tables.referees, tables.managers,
+    tables.stadiums, tables.matches, tables.statistics, tables.odds, tables.lineups, tables.player_lineups,
+    tables.players_stats))
+
+_COPY_NULL = '\\N'
+_COPY_ESCAPE = str.maketrans({'\\': '\\\\', '\n': '\\n', '\r': '\\r', '\t': '\\t'})
+
+
+def _escape(text):
+    return text.translate(_COPY_ESCAPE)
+
+
+def _encode_float(value):
+    if value != value:
+        return _COPY_NULL
+    # Integer columns holding missing values arrive as floats from pandas.
+    return '%d' % value if value.is_integer() else repr(value)
+
+
+# Fast path for the most common exact types, looked up before the generic conversion.
+_TYPE_ENCODERS = {
+    int: str,
+    float: _encode_float,
+    str: _escape,
+    bool: lambda value: 't' if value else 'f',
+    type(None): lambda value: _COPY_NULL,
+}
+
+
+def _encode_value(value):
+    encoder = _TYPE_ENCODERS.get(type(value))
+    if encoder is not None:
+        return encoder(value)
+    if value is None:
+        return _COPY_NULL
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, float):
+        return _encode_float(value)
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, (dict, list, tuple)):
+        return _escape(json.dumps(value))
+    return _escape(str(value))
+
+
+def _encode_json(value):
+    if value is None:
+        return _COPY_NULL
+    # Strings are expected to be serialized JSON documents already.
+    if isinstance(value, (str, bytes)):
+        return _escape(value.decode() if isinstance(value, bytes) else value)
+    return _escape(json.dumps(value))
+
+
+def _encode_array(value):
+    if value is None:
+        return _COPY_NULL
+    if isinstance(value, str):
+        # Already a postgres array literal, e.g.: '{4,4,2}'
+        return _escape(value)
+    elements = []
+    for element in value:
+        if element is None:
+            elements.append('NULL')
+        else:
+            elements.append('"%s"' % str(element).replace('\\', '\\\\').replace('"', '\\"'))
+    return _escape('{%s}' % ','.join(elements))
+
+
+def _column_encoders(table_name, columns):
+    encoders = []
+    for column in columns:
+        if column in json_columns.get(table_name, ()):
+            encoders.append(_encode_json)
+        elif column in array_columns.get(table_name, ()):
+            encoders.append(_encode_array)
+        else:
+            encoders.append(_encode_value)
+    return encoders
+
+
+class _CopyStream(object):
+    """File-like object feeding the COPY text format of the rows to psycopg2 on demand."""
+
+    def __init__(self, rows, encoders):
+        self._rows = iter(rows)
+        self._encoders = encoders
+        self._buffer = ''
+        self.row_count = 0
+
+    def _encode_row(self, row):
+        return '\t'.join([encode(value) for encode, value in zip(self._encoders, row)]) + '\n'
+
+    def read(self, size=-1):
+        parts = [self._buffer]
+        length = len(self._buffer)
+        for row in self._rows:
+            line = self._encode_row(row)
+            parts.append(line)
+            length += len(line)
+            self.row_count += 1
+            if 0 <= size <= length:
+                break
+        data = ''.join(parts)
+        if size < 0:
+            self._buffer = ''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+
+
+def _table_name(table):
+    return table.get_table_name() if isinstance(table, Table) else str(table)
+
+
+def copy_rows(pool, table, columns, rows, **kwargs):
+    """Bulk load an iterable of row tuples into the given table using COPY ... FROM STDIN.
+
+    The rows are encoded lazily while the server consumes them, so arbitrarily large generators can be loaded
+    with a constant memory footprint. The load runs in a single transaction on a pooled connection.
+    Returns the number of loaded rows.
+    """
+    from db_conn.connection.postgresql import ConnectionPool
+    assert isinstance(pool, ConnectionPool), "Pool input parameter must be a type of ConnectionPool"
+
+    buffer_size = kwargs.get('buffer_size', 1 << 16)
+    table_name = _table_name(table)
+    columns = tuple(columns)
+    stream = _CopyStream(rows, _column_encoders(table_name, columns))
+    sql = 'COPY "%s" (%s) FROM STDIN' % (table_name, ','.join('"%s"' % c for c in columns))
+
+    with pool.get_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.copy_expert(sql, stream, size=buffer_size)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    pool.invalidate_cache(table_name)
+    return stream.row_count
+
+
+def copy_dataframe(pool, table, df, **kwargs):
+    """Bulk load a pandas DataFrame into the given table using COPY ... FROM STDIN.
+
+    The DataFrame column names are used as table columns unless 'columns' is given. Missing values (NaN, NaT)
+    are loaded as NULL.
+    """
+    columns = list(kwargs.pop('columns', df.columns))
+    chunk_size = kwargs.pop('chunk_size', 100000)
+    frame = df[columns]
+
+    def iter_rows():
+        for start in range(0, len(frame.index), chunk_size):
+            chunk = frame.iloc[start:start + chunk_size]
+            chunk = chunk.astype(object).where(chunk.notna(), None)
+            yield from chunk.itertuples(index=False, name=None)
+
+    return copy_rows(pool, table, columns, iter_rows(), **kwargs)
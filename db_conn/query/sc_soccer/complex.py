@@ -2,23 +2,25 @@ from pypika import Query, Table, Field, enums, JoinType
 
 from db_conn.query.sc_soccer import tables
 from db_conn.utils import listify
+from db_conn.query.bind import Binder, BoundQuery
 
 
 def get_player_lineups(matches=None, **kwargs):
     substitute = kwargs.get('substitute', None)
     pl = tables.player_lineups.as_('pl')
     m = tables.matches.as_('m')
+    b = Binder()
 
     q = Query.from_(pl
         ).join(m).on(m.match_id == pl.match_id
         ).select(pl.star
         ).orderby(m.full_date, order=enums.Order.desc)
     if matches is not None:
-        q = q.where(pl.match_id.isin(listify(matches)))
+        q = q.where(b.any(pl.match_id, listify(matches)))
     if substitute is not None:
-        q = q.where(pl.substitute == substitute)
+        q = q.where(pl.substitute == b(substitute))
 
-    return q
+    return b.bind(q)
 
 
 def get_all_match_data(**kwargs):
@@ -35,6 +37,9 @@ def get_all_match_data(**kwargs):
     include_match_stat = kwargs.get('match_stat', False)
     include_lineups = kwargs.get('lineups', False)
 
+    # With a DimensionCache the dimension tables are not joined, the slugs are resolved to ids on the client
+    dimensions = kwargs.get('dimensions', None)
+
     s = tables.seasons.as_('s')
     m = tables.matches.as_('m')
     t = tables.tournaments.as_('t')
@@ -50,45 +55,62 @@ def get_all_match_data(**kwargs):
     away_l = tables.lineups.as_('away_l')
     home_m = tables.managers.as_('home_m')
     away_m = tables.managers.as_('away_m')
+    b = Binder()
+
+    if dimensions is None:
+        q = Query.from_(m
+                ).join(home).on(m.home_team_id == home.team_id
+                ).join(away).on(m.away_team_id == away.team_id
+                ).join(s).on(m.season_id == s.season_id
+                ).join(t).on(m.tournament_id == t.tournament_id
+                ).join(r, how=JoinType.left).on(m.referee_id == r.referee_id
+                ).join(st, how=JoinType.left).on(m.stadium_id == st.stadium_id
+                ).select(
+                    m.star,
+                    s.star,
+                    t.star,
+                    r.star,
+                    st.star,
+                    home.team_name.as_('home_team_name'),
+                    home.team_slug.as_('home_team_slug'),
+                    home.team_short.as_('home_team_short'),
+                    away.team_name.as_('away_team_name'),
+                    away.team_slug.as_('away_team_slug'),
+                    away.team_short.as_('away_team_short')
+                ).orderby(m.full_date, order=enums.Order.desc)
+
+        if season_filter is not None:
+            q = q.where(s.season_year == b(season_filter))
+        if tournament_filter is not None:
+            q = q.where(t.tournament_slug == b(tournament_filter.replace(' ', '-').lower()))
+        if home_team_filter is not None:
+            q = q.where(home.team_slug == b(home_team_filter.replace(' ', '-').lower()))
+        if away_team_filter is not None:
+            q = q.where(away.team_slug == b(away_team_filter.replace(' ', '-').lower()))
+    else:
+        q = Query.from_(m
+                ).select(
+                    m.star
+                ).orderby(m.full_date, order=enums.Order.desc)
+
+        if season_filter is not None:
+            q = q.where(b.any(m.season_id, dimensions.season_ids(season_filter)))
+        if tournament_filter is not None:
+            q = q.where(b.any(m.tournament_id, dimensions.tournament_ids(tournament_filter)))
+        if home_team_filter is not None:
+            q = q.where(b.any(m.home_team_id, dimensions.team_ids(home_team_filter)))
+        if away_team_filter is not None:
+            q = q.where(b.any(m.away_team_id, dimensions.team_ids(away_team_filter)))
 
-    q = Query.from_(m
-            ).join(home).on(m.home_team_id == home.team_id
-            ).join(away).on(m.home_team_id == away.team_id
-            ).join(s).on(m.season_id == s.season_id
-            ).join(t).on(m.tournament_id == t.tournament_id
-            ).join(r, how=JoinType.left).on(m.referee_id == r.referee_id
-            ).join(st, how=JoinType.left).on(m.stadium_id == st.stadium_id
-            ).select(
-                m.star,
-                s.star,
-                t.star,
-                r.star,
-                st.star,
-                home.team_name.as_('home_team_name'),
-                home.team_slug.as_('home_team_slug'),
-                home.team_short.as_('home_team_short'),
-                away.team_name.as_('away_team_name'),
-                away.team_slug.as_('away_team_slug'),
-                away.team_short.as_('away_team_short')
-            ).orderby(m.full_date, order=enums.Order.desc)
-
-    if season_filter is not None:
-        q = q.where(s.season_year == season_filter)
-    if tournament_filter is not None:
-        q = q.where(t.tournament_slug == tournament_filter.replace(' ', '-').lower())
     if date_filter is not None:
         from datetime import datetime, date
         if isinstance(date_filter, datetime):
-            q = q.where(m.full_date == date_filter)
+            q = q.where(m.full_date == b(date_filter))
         if isinstance(date_filter, date):
-            q = q.where(m.match_date == date_filter)
-    if home_team_filter is not None:
-        q = q.where(home.team_slug == home_team_filter.replace(' ', '-').lower())
-    if away_team_filter is not None:
-        q = q.where(home.team_slug == away_team_filter.replace(' ', '-').lower())
+            q = q.where(m.match_date == b(date_filter))
 
     if match_filter is not None:
-        q = q.where(m.match_id.isin(listify(match_filter)))
+        q = q.where(b.any(m.match_id, listify(match_filter)))
 
     if include_odds:
         q = q.join(odds).on(m.match_id == odds.match_id
@@ -107,8 +129,8 @@ def get_all_match_data(**kwargs):
                 stat.away_score,
             )
     if include_lineups:
-        q = q.join(home_l, how=JoinType.left).on((m.match_id == home_l.match_id) & (home.team_id == home_l.team_id)
-            ).join(away_l, how=JoinType.left).on((m.match_id == away_l.match_id) & (away.team_id == away_l.team_id)
+        q = q.join(home_l, how=JoinType.left).on((m.match_id == home_l.match_id) & (m.home_team_id == home_l.team_id)
+            ).join(away_l, how=JoinType.left).on((m.match_id == away_l.match_id) & (m.away_team_id == away_l.team_id)
             ).join(home_m, how=JoinType.left).on(home_l.manager_id == home_m.manager_id
             ).join(away_m, how=JoinType.left).on(away_l.manager_id == away_m.manager_id
             ).select(
@@ -120,50 +142,97 @@ def get_all_match_data(**kwargs):
                 away_m.manager_name.as_('away_manager_name')
             )
 
-    return q
+    return b.bind(q)
+
+def get_match_ids(**kwargs):
+    """Select only the ids of the matches filtered by the get_all_match_data arguments."""
+    filters = {key: value for key, value in kwargs.items() if key not in ('odds', 'match_stat', 'lineups')}
+    q = get_all_match_data(**filters)
+    sub = q.query.as_('sub')
+    return BoundQuery(Query.from_(sub).select(sub.match_id), q.values)
+
+
+def flatten_player_lineups(lineups, matches):
+    """Flatten the player lineups into one row per match.
+
+    The i-th player (in query order) of the home and away team of a match is spread into the
+    'home_<column>_<i>' and 'away_<column>_<i>' columns. A team is the home team if it equals the
+    'home_team_id' of the match in the matches frame, otherwise it is the away team.
+    """
+    import numpy as np
+    import pandas as pd
+
+    value_cols = [col for col in lineups.columns if col not in ('match_id', 'team_id')]
+    home_team_ids = matches.drop_duplicates('match_id').set_index('match_id')['home_team_id']
+    lineups = lineups[lineups['match_id'].isin(home_team_ids.index)]
+    if lineups.empty:
+        return pd.DataFrame(columns=['match_id'])
+
+    side = np.where(lineups['team_id'].to_numpy() == lineups['match_id'].map(home_team_ids).to_numpy(),
+                    'home', 'away')
+    rank = lineups.groupby(['match_id', 'team_id'], sort=False).cumcount().to_numpy()
+
+    wide = lineups.set_index([lineups['match_id'], side, rank])[value_cols]
+    wide = wide[~wide.index.duplicated()]
+    wide = wide.unstack([1, 2])
+
+    # Order the columns by side, player then lineup column and name them as <side>_<column>_<i>
+    wide = wide.reindex(columns=sorted(wide.columns, key=lambda c: (c[1] != 'home', c[2], value_cols.index(c[0]))))
+    wide.columns = ['%s_%s_%d' % (prefix, col, i) for col, prefix, i in wide.columns]
+    wide.index.name = 'match_id'
+    return wide.reset_index()
+
+
+def _get_combined_data_parallel(pool, chunk_size, max_workers, **kwargs):
+    import pandas as pd
+
+    match_ids = kwargs.get('match_ids', None)
+    if match_ids is None:
+        match_ids = pool.sql_query(get_match_ids(**kwargs))['match_id'].to_list()
+    else:
+        match_ids = listify(match_ids)
+    chunks = [match_ids[i:i + chunk_size] for i in range(0, len(match_ids), chunk_size)] or [[]]
+
+    # Every chunk needs a match and a lineup query, all of them run on separate pooled connections
+    queries = []
+    for chunk in chunks:
+        queries.append(get_all_match_data(**{**kwargs, 'match_ids': chunk}))
+        queries.append(get_player_lineups(chunk))
+    results = pool.sql_query_many(queries, max_workers=max_workers)
+
+    result_df = pd.concat(results[0::2], ignore_index=True)
+    lineups_df = pd.concat(results[1::2], ignore_index=True)
+    result_df = result_df.sort_values('full_date', ascending=False, kind='stable', ignore_index=True)
+    return result_df, lineups_df
+
 
 def get_combined_data(conn, **kwargs):
+    """Match data joined with the flattened player lineups of both teams.
+
+    With 'parallel=True' the match ids are split into chunks of 'chunk_size' and the match and lineup queries
+    of the chunks are fetched concurrently on up to 'max_workers' connections of a ConnectionPool.
+    """
     import pandas as pd
-    from db_conn.connection.postgresql import Connection
+    from db_conn.connection.postgresql import Connection, ConnectionPool
     assert isinstance(conn, Connection), "Connection input parameters must be a type of Connection"
 
-    result_df = conn.sql_query(str(get_all_match_data(**kwargs)))
-    match_ids = result_df['match_id'].to_list()
-    lineups_df = conn.sql_query(str(get_player_lineups(match_ids)))
-
-    def join_player_lineup(lineups, matches):
-        df_list = []
-
-        match_grp = lineups.groupby('match_id')
-        for match_id, e_match_grp in match_grp:
-            # TODO: Remove the grouped column
-            fixed_e_match_grp = e_match_grp.drop('match_id', axis=1)
-            new_cols = []
-            # Group by teams also
-            team_grp = fixed_e_match_grp.groupby('team_id')
-            for team_id, e_team_grp in team_grp:
-                # TODO: Remove the grouped column
-                fixed_e_team_grp = e_team_grp.drop('team_id', axis=1)
-                matches_filtered = matches[matches['match_id'] == match_id]
-                if matches_filtered['home_team_id'].iloc[0] == team_id:
-                    prefix = 'home'
-                else:
-                    prefix = 'away'
-                rows = len(fixed_e_team_grp.index)
-                cols = fixed_e_team_grp.keys()
-                for i in range(0, rows):
-                    for col in cols:
-                        new_cols.append(prefix + '_' + col + '_' + str(i))
-
-            values_df = fixed_e_match_grp.drop('team_id', axis=1)
-            values_list = values_df.values.flatten()
-            new_df = pd.DataFrame([values_list], columns=new_cols)
-            new_df['match_id'] = match_id
-            df_list.append(new_df)
-
-        return pd.concat(df_list)
-
-    flattened_lineups = join_player_lineup(lineups_df, result_df)
+    parallel = kwargs.pop('parallel', False)
+    chunk_size = kwargs.pop('chunk_size', 2000)
+    max_workers = kwargs.pop('max_workers', None)
+
+    if parallel:
+        assert isinstance(conn, ConnectionPool), "Parallel mode requires a ConnectionPool"
+        result_df, lineups_df = _get_combined_data_parallel(conn, chunk_size, max_workers, **kwargs)
+    else:
+        result_df = conn.sql_query(get_all_match_data(**kwargs))
+        match_ids = result_df['match_id'].to_list()
+        lineups_df = conn.sql_query(get_player_lineups(match_ids))
+
+    dimensions = kwargs.get('dimensions', None)
+    if dimensions is not None:
+        result_df = dimensions.enrich(result_df)
+
+    flattened_lineups = flatten_player_lineups(lineups_df, result_df)
 
     result_df = pd.merge(result_df, flattened_lineups, how='left', left_on='match_id',
                          right_on='match_id', copy=False)
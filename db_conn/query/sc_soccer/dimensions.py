@@ -0,0 +1,103 @@
+# Common Python library imports
+import threading
+import time
+
+# Pip package imports
+from pypika import Query
+from loguru import logger
+
+# Internal package imports
+from db_conn.query.sc_soccer import tables
+
+
+def _slugify(value):
+    return value.replace(' ', '-').lower()
+
+
+class DimensionCache(object):
+    """In-process copy of the small, rarely changing dimension tables referenced by the matches.
+
+    The teams, seasons, tournaments, referees and stadiums are loaded once and reloaded when they are older than
+    'ttl' seconds (never if ttl is None) or refresh() is called. Pass the cache to get_all_match_data or
+    get_combined_data as 'dimensions' to resolve the slug filters on the client side and skip the dimension
+    joins, then add the dimension columns to the result with enrich().
+    """
+
+    def __init__(self, conn, ttl=3600):
+        self._conn = conn
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # Held while loading, so concurrent callers of an expired cache load the tables once
+        self._load_lock = threading.Lock()
+        self._loaded_at = None
+        self._frames = {}
+        self._index = {}
+
+    def refresh(self):
+        with self._load_lock:
+            self._load()
+
+    def _load(self):
+        frames = {}
+        for table in (tables.teams, tables.seasons, tables.tournaments, tables.referees, tables.stadiums):
+            frames[table.get_table_name()] = self._conn.sql_query(Query.from_(table).select('*'))
+
+        def index(frame, key, value):
+            return frame.groupby(key)[value].apply(list).to_dict()
+
+        lookups = {
+            'team_slug': index(frames['teams'], 'team_slug', 'team_id'),
+            'season_year': index(frames['seasons'], 'season_year', 'season_id'),
+            'tournament_slug': index(frames['tournaments'], 'tournament_slug', 'tournament_id'),
+        }
+        with self._lock:
+            self._frames, self._index = frames, lookups
+            self._loaded_at = time.monotonic()
+        logger.debug("Dimension cache loaded: %s" % {name: len(df.index) for name, df in frames.items()})
+
+    def _expired(self):
+        return self._loaded_at is None or (self.ttl is not None and time.monotonic() - self._loaded_at > self.ttl)
+
+    def _ensure_loaded(self):
+        if self._expired():
+            with self._load_lock:
+                # Another caller may have loaded the tables while this one was waiting
+                if self._expired():
+                    self._load()
+
+    def frame(self, name):
+        self._ensure_loaded()
+        return self._frames[name]
+
+    def _lookup(self, index, key):
+        self._ensure_loaded()
+        return list(self._index[index].get(key, []))
+
+    def team_ids(self, slug):
+        return self._lookup('team_slug', _slugify(slug))
+
+    def season_ids(self, year):
+        return self._lookup('season_year', year)
+
+    def tournament_ids(self, slug):
+        return self._lookup('tournament_slug', _slugify(slug))
+
+    def enrich(self, matches):
+        """Add the dimension columns selected by get_all_match_data to a frame of match rows.
+
+        Matches without a season, tournament or teams are dropped, like the inner joins of the query do. A
+        dimension column whose name is already in the frame gets the table name as suffix, e.g. 'name_stadiums'.
+        """
+        teams = self.frame('teams')[['team_id', 'team_name', 'team_slug', 'team_short']]
+        home = teams.rename(columns=lambda col: 'home_' + col if col != 'team_id' else 'home_team_id')
+        away = teams.rename(columns=lambda col: 'away_' + col if col != 'team_id' else 'away_team_id')
+
+        df = matches
+        for name, frame, key, how in (('seasons', self.frame('seasons'), 'season_id', 'inner'),
+                                      ('tournaments', self.frame('tournaments'), 'tournament_id', 'inner'),
+                                      ('referees', self.frame('referees'), 'referee_id', 'left'),
+                                      ('stadiums', self.frame('stadiums'), 'stadium_id', 'left'),
+                                      ('home', home, 'home_team_id', 'inner'),
+                                      ('away', away, 'away_team_id', 'inner')):
+            df = df.merge(frame, on=key, how=how, suffixes=('', '_' + name))
+        return df
@@ -1,6 +1,7 @@
 from pypika import Query, Table, Field, enums
 
 from db_conn.query.sc_soccer import tables
+from db_conn.query.bind import Binder
 
 
 def get_matches_with_teams_odds():
@@ -35,7 +36,7 @@ def get_matches_with_teams_odds():
         odds.sc_odds.as_('sofa_odds'),
         odds.fd_odds.as_('fd_odds')
     )
-    return q
+    return Binder().bind(q)
 
 def get_matches_with_teams_scores(season_filter):
     """
@@ -62,6 +63,7 @@ def get_matches_with_teams_scores(season_filter):
     odds = tables.odds.as_('odds')
     stat = tables.statistics.as_('stat')
     season = tables.seasons.as_('season')
+    b = Binder()
 
     q = Query.from_(m
     ).join(home, enums.JoinType.left).on(m.home_team_id == home.team_id
@@ -78,8 +80,8 @@ def get_matches_with_teams_scores(season_filter):
         stat.away_score.as_('away_goal'),
         odds.sc_odds.as_('sofa_odds'),
         odds.fd_odds.as_('fd_odds')
-    ).where(season.season_year == season_filter)
-    return q
+    ).where(season.season_year == b(season_filter))
+    return b.bind(q)
 
 def get_matches_where_odds_are_null(start_date, end_date):
     """
@@ -112,6 +114,7 @@ def get_matches_where_odds_are_null(start_date, end_date):
     stat = tables.statistics.as_('stat')
     season = tables.seasons.as_('season')
     tr = tables.tournaments.as_('tr')
+    b = Binder()
 
     q = Query.from_(m
     ).join(home, enums.JoinType.left).on(m.home_team_id == home.team_id
@@ -132,10 +135,10 @@ def get_matches_where_odds_are_null(start_date, end_date):
         stat.home_score.as_('home_goal'),
         stat.away_score.as_('away_goal')
     ).where(
-        (m.match_date[start_date:end_date]) &
+        (m.match_date[b(start_date):b(end_date)]) &
         (odds.fd_odds.isnull())
     )
-    return q
+    return b.bind(q)
 
 def get_null_fifa_stats(limit=None):
     """
@@ -177,7 +180,7 @@ def get_null_fifa_stats(limit=None):
                         p.birth_date.as_('birth')
                     )
 
-    return q
+    return Binder().bind(q)
 
 def get_all_match_for_player_id(player_id):
     """
@@ -190,6 +193,7 @@ def get_all_match_for_player_id(player_id):
     """
     ps = tables.players_stats.as_('ps')
     m = tables.matches.as_('m')
+    b = Binder()
 
     q = Query.from_(ps
         ).join(m, enums.JoinType.inner).on(m.match_id == ps.match_id
@@ -197,10 +201,10 @@ def get_all_match_for_player_id(player_id):
             m.match_id.as_('match_id'),
             ps.sc_player_id.as_('player_id'),
             m.match_date.as_('date')
-        ).where((ps.sc_player_id == player_id) & (ps.fifa_stat.isnull())
+        ).where((ps.sc_player_id == b(player_id)) & (ps.fifa_stat.isnull())
         ).orderby(m.match_date, order=enums.Order.desc)
 
-    return q
+    return b.bind(q)
 
 
 def get_last_match_date():
@@ -217,4 +221,4 @@ def get_last_match_date():
             m.match_date.as_('date')
         ).orderby(m.match_date, order=enums.Order.desc
         ).limit(1)
-    return q
\ No newline at end of file
+    return Binder().bind(q)
\ No newline at end of file
@@ -1,72 +1,1021 @@
 # Common Python library imports
 import multiprocessing as mp
+import itertools
 import multiprocessing.queues as mpq
-from threading import Thread
+import os
+import pickle
+import queue
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from contextlib import nullcontext
+from copy import copy
+from functools import partial
+from threading import Event, Lock, Thread
 import traceback
 
 
 # Pip package imports
+import psycopg2
+from psycopg2.errors import ForeignKeyViolation
+from psycopg2.extras import Json, execute_values
+from psycopg2.pool import PoolError
+from pypika.queries import QueryBuilder, Table
+from pypika.terms import NullValue, ValueWrapper
 from loguru import logger
 
 # Internal package imports
-from db_conn.utils import retry
+from db_conn.utils import TunnelError
+from db_conn.resilience import CircuitOpenError, RetryBudget, retry
 from db_conn.connection.postgresql import ConnectionPool
+from db_conn.connection.cache import written_tables
+from db_conn.metrics import Metrics
+from db_conn.spool import Spool
+from db_conn.deadletter import DeadLetterFile
+
+
+# Errors telling that the database can not be reached, the batches are spooled meanwhile
+_UNREACHABLE = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolError, TunnelError)
+
+# Errors caused by the statement itself, only the failing statement is discarded
+_STATEMENT_ERRORS = (psycopg2.IntegrityError, psycopg2.DataError, psycopg2.ProgrammingError,
+                     psycopg2.NotSupportedError)
+
+# Objects inherited from the parent by a forked writer process. They are kept referenced, because closing
+# them in the child would terminate the connections of the parent.
+_inherited = []
+
+
+def _process_writer(insert_queue, index, pool_class, pool_kwargs):
+    """Entry point of the writer processes, consuming the shared queue with their own connection pool."""
+    _inherited.append(insert_queue.pool)
+    if hasattr(pool_class, 'reset_instance'):
+        pool_class.reset_instance()
+    config = {**pool_kwargs['config'], 'min_connection': 1, 'max_connection': 1}
+    pool = pool_class(**{**pool_kwargs, 'config': config})
+    insert_queue.pool = pool
+    insert_queue.metrics = pool.metrics
+    insert_queue._writer_process = True
+    result = {'name': insert_queue.name, 'worker': index, 'pid': os.getpid(), 'result': False}
+    try:
+        result.update(insert_queue._run_worker(index))
+    finally:
+        result['items'] = insert_queue.metrics.counter('queue.items', queue=insert_queue.name, worker=index)
+        result['batches'] = insert_queue.metrics.counter('queue.batches', queue=insert_queue.name, worker=index)
+        result['tables'] = sorted(insert_queue._tables_written)
+        insert_queue._results.put(result)
+        pool.close()
+
+
+class InsertRows(object):
+    """Compact queue payload of rows inserted into a table, written by the workers with a bulk INSERT.
+
+    Cheaper to pickle than the equivalent pypika query, and payloads of the same table and columns are folded
+    into one statement. Dict values and the values of the 'json_columns' passed to execute() are written as JSON,
+    other lists as arrays. If 'conflict' holds the key columns, the rows are upserted: existing rows get the
+    other columns updated.
+    """
+    __slots__ = ('table', 'columns', 'rows', 'conflict')
+
+    def __init__(self, table, columns, rows, conflict=None):
+        self.table = table.get_table_name() if isinstance(table, Table) else table
+        self.columns = tuple(columns)
+        self.rows = rows
+        self.conflict = tuple(conflict) if conflict else None
+
+    def __reduce__(self):
+        return InsertRows, (self.table, self.columns, self.rows, self.conflict)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __str__(self):
+        sql = 'INSERT INTO "%s" (%s) VALUES %%s' % (self.table, ','.join('"%s"' % c for c in self.columns))
+        if self.conflict is None:
+            return sql
+        updates = ','.join('"%s"=EXCLUDED."%s"' % (c, c) for c in self.columns if c not in self.conflict)
+        return '%s ON CONFLICT (%s) %s' % (sql, ','.join('"%s"' % c for c in self.conflict),
+                                          'DO UPDATE SET %s' % updates if updates else 'DO NOTHING')
+
+    def split(self):
+        """One payload per row."""
+        return [InsertRows(self.table, self.columns, [row], self.conflict) for row in self.rows]
+
+    def execute(self, cursor, json_columns=()):
+        rows = self.rows
+        json = [column in json_columns for column in self.columns]
+        if any(json) or any(isinstance(value, dict) for row in rows for value in row):
+            # Like the COPY loader, strings of the JSON columns are expected to be serialized documents already
+            rows = [tuple(Json(value) if isinstance(value, dict) or
+                          (is_json and value is not None and not isinstance(value, (str, bytes))) else value
+                          for is_json, value in zip(json, row)) for row in rows]
+        execute_values(cursor, str(self), rows, page_size=max(len(rows), 1))
+
+
+def _picklable(value):
+    try:
+        pickle.dumps(value)
+    except Exception:
+        return False
+    return True
+
+
+def _execute(cursor, item, json_columns=None):
+    if isinstance(item, InsertRows):
+        item.execute(cursor, (json_columns or {}).get(item.table, ()))
+    else:
+        cursor.execute(str(item))
+
+
+def _split_rows(item):
+    """One item per row of a multi-row INSERT, otherwise the item itself."""
+    if isinstance(item, InsertRows):
+        return item.split()
+    if _insert_table(item) is not None and len(item._values) > 1:
+        rows = []
+        for values in item._values:
+            row = copy(item)
+            row._values = [values]
+            rows.append(row)
+        return rows
+    return [item]
+
+
+def _savepoint(cursor, item, json_columns=None):
+    """Execute the item under a savepoint, the statement error is returned and rolled back."""
+    cursor.execute('SAVEPOINT db_conn_item')
+    try:
+        _execute(cursor, item, json_columns)
+    except _STATEMENT_ERRORS as err:
+        cursor.execute('ROLLBACK TO SAVEPOINT db_conn_item')
+        return err
+    cursor.execute('RELEASE SAVEPOINT db_conn_item')
+    return None
+
+
+def as_insert_rows(item):
+    """Convert a plain pypika INSERT ... VALUES query with named columns into InsertRows, None if not possible."""
+    if isinstance(item, InsertRows):
+        return item
+    values = _insert_values(item) if _insert_key(item) is not None else None
+    if values is None:
+        return None
+    return InsertRows(item._insert_table.get_table_name(), *values)
+
+
+def _insert_values(item):
+    """Columns and rows of an INSERT ... VALUES item with named columns, upserts included, None if not readable."""
+    if isinstance(item, InsertRows):
+        return item.columns, item.rows
+    if _insert_table(item) is None or not item._columns:
+        return None
+    rows = []
+    for values in item._values:
+        if not all(isinstance(value, (ValueWrapper, NullValue)) for value in values):
+            return None
+        rows.append(tuple(None if isinstance(value, NullValue) else value.value for value in values))
+    return [c.name for c in item._columns], rows
+
+
+class MergeBuffer(object):
+    """Deduplicate inserted rows by their key columns before they are upserted.
+
+    'keys' maps the table names to their key columns. A row replaces the buffered row of the same key, or if
+    'merge' is given, the two are combined by merge(old, new), both dicts of the column values; 'merge' can
+    also map table names to such functions. drain() returns an upsert InsertRows per table and column set.
+    """
+
+    def __init__(self, keys, merge=None):
+        self.keys = keys
+        self.merge = merge
+        self.started = None
+        self.merged = 0
+        self._groups = OrderedDict()
+        self._rows = 0
+
+    def __len__(self):
+        return self._rows
+
+    def _merge_function(self, table):
+        if isinstance(self.merge, dict):
+            return self.merge.get(table)
+        return self.merge
+
+    def add(self, item):
+        """Buffer the rows of the item and return True, or False if the item can not be merged."""
+        if isinstance(item, str):
+            return False
+        payload = as_insert_rows(item)
+        if payload is None or payload.conflict is not None or payload.table not in self.keys:
+            return False
+        key_columns = self.keys[payload.table]
+        if any(c not in payload.columns for c in key_columns):
+            return False
+
+        index = [payload.columns.index(c) for c in key_columns]
+        merge = self._merge_function(payload.table)
+        rows = self._groups.setdefault((payload.table, payload.columns), OrderedDict())
+        for row in payload.rows:
+            key = tuple(row[i] for i in index)
+            old = rows.get(key)
+            if old is None:
+                self._rows += 1
+            else:
+                self.merged += 1
+                if merge is not None:
+                    merged = merge(dict(zip(payload.columns, old)), dict(zip(payload.columns, row)))
+                    row = tuple(merged[c] for c in payload.columns)
+            rows[key] = row
+        if self.started is None:
+            self.started = time.monotonic()
+        return True
+
+    def drain(self):
+        payloads = [InsertRows(table, columns, list(rows.values()), self.keys[table])
+                    for (table, columns), rows in self._groups.items()]
+        self._groups.clear()
+        self._rows = 0
+        self.started = None
+        return payloads
+
+
+def _insert_table(item):
+    """Name of the table an INSERT ... VALUES item writes, upserts included, None for any other item."""
+    if isinstance(item, InsertRows):
+        return item.table
+    if not isinstance(item, QueryBuilder) or item._insert_table is None or item._selects:
+        return None
+    return item._insert_table.get_table_name()
+
+
+def order_inserts(items, insert_order):
+    """Stable sort the INSERT items by the position of their table in 'insert_order', parent tables first.
+
+    Any other item, e.g. an update or raw SQL, is a barrier: nothing is moved across it. Tables missing from
+    'insert_order' go last.
+    """
+    rank = {table: i for i, table in enumerate(insert_order)}
+    result, segment = [], []
+    for item in items:
+        table = _insert_table(item)
+        if table is None:
+            result.extend(sorted(segment, key=lambda d: rank.get(_insert_table(d), len(rank))))
+            segment = []
+            result.append(item)
+        else:
+            segment.append(item)
+    result.extend(sorted(segment, key=lambda d: rank.get(_insert_table(d), len(rank))))
+    return result
+
+
+def _insert_key(item):
+    """Return the folding key of a plain INSERT ... VALUES query or None if the item cannot be folded."""
+    if isinstance(item, InsertRows):
+        return (InsertRows, item.table, item.columns, item.conflict)
+    if not isinstance(item, QueryBuilder) or item._insert_table is None:
+        return None
+    # Builders resolve unknown attributes to fields, so the dialect specific flags are looked up directly.
+    state = vars(item)
+    if item._selects or any(state.get(flag) for flag in ('_on_conflict', '_returns', '_replace', '_ignore')):
+        return None
+    return (type(item), str(item._insert_table), tuple(str(c) for c in item._columns))
+
+
+def _upsert_rows(columns, conflict, rows):
+    """One row per conflict key, the one an upsert of the rows one after the other would leave.
+
+    A statement can not affect the same row twice, the later row wins, or the first one with DO NOTHING.
+    """
+    index = [columns.index(c) for c in conflict]
+    unique = OrderedDict()
+    for row in rows:
+        key = tuple(row[i] for i in index)
+        if len(index) < len(columns):
+            unique[key] = row
+        else:
+            unique.setdefault(key, row)
+    return list(unique.values())
+
+
+def _fold(group):
+    """One multi-row statement of INSERTs with the same folding key."""
+    if len(group) == 1:
+        return group[0]
+    if isinstance(group[0], InsertRows):
+        rows = [row for q in group for row in q.rows]
+        if group[0].conflict is not None:
+            rows = _upsert_rows(group[0].columns, group[0].conflict, rows)
+        return InsertRows(group[0].table, group[0].columns, rows, group[0].conflict)
+    merged = copy(group[0])
+    merged._values = [row for q in group for row in q._values]
+    return merged
+
+
+def coalesce_inserts(items):
+    """Fold INSERT queries targeting the same table and columns into multi-row statements.
+
+    Only runs of adjacent INSERTs with the same key are folded, so no item is moved across another one and the
+    parent rows keep their place before the child rows. Items which can not be folded (raw SQL strings, updates,
+    upserts, ...) are passed through unchanged. With an insert_order the batch is sorted by order_inserts() first,
+    which puts the INSERTs of a table next to each other.
+    """
+    result = []
+    group, group_key = [], None
+    for item in items:
+        key = _insert_key(item)
+        if group and key != group_key:
+            result.append(_fold(group))
+            group = []
+        if key is None:
+            result.append(item)
+        else:
+            group.append(item)
+            group_key = key
+    if group:
+        result.append(_fold(group))
+    return result
+
 
 class InsertQueue(mpq.Queue):
+    """Queue of statements written to the database by the hired workers.
+
+    In the default 'thread' mode the workers are threads of the current process sharing its pool. In the
+    'process' mode every worker is a separate process with its own single connection pool, created from the
+    clone_kwargs() of the given pool, so statement building and adaptation are not bound to a single core. The
+    processes are spawned unless another 'mp_context' is given, and the options passed to them (merge functions,
+    dead-letter sink, ...) must be picklable.
+    """
 
     def __init__(self, *args, **kwargs):
         size = kwargs.get('size', 120)
         self.num_workers = kwargs.get('max_workers', 1)
-        self.pool = kwargs.get('pool', ConnectionPool())
+        # Autoscale mode: a controller starts with 'min_workers' and hires or retires workers up to 'max_workers'
+        # every 'autoscale_interval' seconds, see _autoscale().
+        self.autoscale = kwargs.get('autoscale', False)
+        self.min_workers = kwargs.get('min_workers', 1)
+        self.max_workers = self.num_workers
+        self.autoscale_interval = kwargs.get('autoscale_interval', 1.0)
+        # Commit latency in milliseconds above which the workers are halved, by default twice the lowest seen
+        # but at least 50 ms
+        self.autoscale_latency = kwargs.get('autoscale_latency', None)
+        if self.autoscale:
+            self.num_workers = self.min_workers
+        # Partitioned mode: every worker consumes its own lane, a dispatcher routes the items to the lanes by the
+        # hash of their 'partition_key', either a column name or a function of the item. Items of the same key are
+        # written in order by the same worker. Items without a key are distributed round-robin. A column is read
+        # from the INSERTs only, upserts included: updates, deletes and raw SQL need a function to be ordered.
+        self.partition_key = kwargs.get('partition_key', None)
+        self._unordered_warned = False
+        # Rows of a lane missing their parent row are written again after each of the next 'defer_tries' batches
+        # of the lane, then they go to the dead-letter sink. They are kept per worker when a worker fails.
+        self.defer_tries = kwargs.get('defer_tries', 3)
+        self._deferred = {}
+        # Table names, parents first. The INSERTs of a batch are written in this order, see order_inserts().
+        self.insert_order = kwargs.get('insert_order', None)
+        # Table names and their JSON columns, the list values of these columns are written by InsertRows as JSON
+        # instead of arrays, e.g. bulk.json_columns of sc_soccer.
+        self.json_columns = kwargs.get('json_columns', None)
+        self._lanes = []
+        self._dispatcher = None
+        self.pool = kwargs['pool'] if 'pool' in kwargs else ConnectionPool()
         self.name = kwargs.get('name', "Unknown")
+        # Batching mode: each worker drains up to 'batch_size' items or waits up to 'batch_timeout'
+        # milliseconds, then writes them in a single transaction.
+        self.batch_size = max(1, kwargs.get('batch_size', 1))
+        self.batch_timeout = kwargs.get('batch_timeout', 100)
+        # Merge mode: the rows of the tables in 'merge_keys' are deduplicated by their key columns for up to
+        # 'merge_window' milliseconds or 'merge_size' rows, then upserted. See MergeBuffer.
+        self.merge_keys = kwargs.get('merge_keys', None)
+        self.merge = kwargs.get('merge', None)
+        self.merge_window = kwargs.get('merge_window', 1000)
+        self.merge_size = kwargs.get('merge_size', 10000)
+        # Buffers of the workers, kept when a worker fails so the rows they hold are written by its next attempt
+        self._buffers = {}
+        # Spool mode: batches which can not be written because the database is unreachable are appended to a
+        # Spool (or a Spool in the given directory) and replayed in order, 'spool_batch' items per transaction,
+        # once the database answers again. Reconnecting is attempted every 'spool_probe' seconds.
+        spool = kwargs.get('spool', None)
+        self.spool = Spool(spool, name=self.name) if isinstance(spool, str) else spool
+        self.spool_batch = kwargs.get('spool_batch', 5000)
+        self.spool_probe = kwargs.get('spool_probe', 5)
+        # Dead-letter sink: the statements or rows failing in a batch are passed to it with their error, the rest
+        # of the batch is committed. Either a DeadLetterFile (or the path of one) or a DeadLetterTable.
+        dead_letter = kwargs.get('dead_letter', None)
+        self.dead_letter = DeadLetterFile(dead_letter) if isinstance(dead_letter, str) else dead_letter
+        self._replay_lock = Lock()
+        self._next_probe = 0.0
+        # A worker is retried while the database is unreachable, at most 'worker_retries' times in
+        # 'worker_retry_window' seconds. Any other error, or an exhausted budget, ends the worker, see _run_worker().
+        self.worker_retries = kwargs.get('worker_retries', 100)
+        self.worker_retry_window = kwargs.get('worker_retry_window', 600)
+        self._worker_results = {}
+        self.metrics = kwargs.get('metrics', None) or getattr(self.pool, 'metrics', None) or Metrics()
+        self.mode = kwargs.get('mode', 'thread')
+        assert self.mode in ('thread', 'process'), "Mode \'%s\' is not supported." % self.mode
+        assert self.spool is None or self.mode == 'thread', "The spool is supported in the thread mode only."
+        assert not self.autoscale or self.mode == 'thread', "Autoscaling is supported in the thread mode only."
+        assert self.partition_key is None or (self.mode == 'thread' and not self.autoscale), \
+            "Partitioning is supported in the thread mode without autoscaling only."
+        for option in ('merge', 'merge_keys', 'insert_order', 'json_columns', 'dead_letter'):
+            assert self.mode == 'thread' or _picklable(getattr(self, option)), \
+                "The '%s' option is passed to the writer processes, it must be picklable, e.g. a module level " \
+                "function instead of a lambda." % option
+        self._scale_lock = Lock()
+        self._retire = 0
+        self._next_worker = 0
+        self._controller = None
+        self._stop_controller = Event()
         self.workers = []
+        self._worker_started = {}
+        self._tables_written = set()
 
         #Queue.__init__(self, size)
-        ctx = mp.get_context()
+        # Writer processes are spawned by default, a forked child would inherit the tunnel, pool reaper and metrics
+        # threads of this process in whatever state they are
+        ctx = kwargs.get('mp_context', None) or mp.get_context('spawn' if self.mode == 'process' else None)
+        self._ctx = ctx
+        # Tables written by the writer processes after every commit, and their results when they exit
+        self._results = ctx.Queue() if self.mode == 'process' else None
+        self._results_reader = None
+        self._process_results = {}
+        self._writer_process = False
         super(InsertQueue, self).__init__(size, ctx=ctx)
+        self.metrics.register_gauge('queue.depth', self.qsize, queue=self.name)
         self._hire_workers()
 
+    def __getstate__(self):
+        # Only the options are passed to the spawned writer processes, they create their own pool
+        options = {key: getattr(self, key) for key in ('num_workers', 'name', 'batch_size', 'batch_timeout', 'mode',
+                                                       'merge_keys', 'merge', 'merge_window', 'merge_size',
+                                                       'insert_order', 'json_columns', 'dead_letter', 'worker_retries',
+                                                       'worker_retry_window', '_results')}
+        return super(InsertQueue, self).__getstate__(), options
+
+    def __setstate__(self, state):
+        state, options = state
+        super(InsertQueue, self).__setstate__(state)
+        self.__dict__.update(options)
+        self.pool = None
+        self.metrics = Metrics()
+        self.spool = None
+        self.autoscale = False
+        self.partition_key = None
+        self._lanes = []
+        self._retire = 0
+        self._scale_lock = Lock()
+        self._replay_lock = Lock()
+        self._next_probe = 0.0
+        self.workers = []
+        self._worker_started = {}
+        self._tables_written = set()
+        self._buffers = {}
+        self._deferred = {}
+        self._worker_results = {}
+        self._results_reader = None
+        self._process_results = {}
+        self._writer_process = False
+
     def _hire_workers(self):
         logger.info("[%s] Queue handler is hiring \'%s\' worker." % (self.name, self.num_workers))
+        if self.mode == 'process':
+            pool_kwargs = self.pool.clone_kwargs()
+            for i in range(self.num_workers):
+                p = self._ctx.Process(target=_process_writer, args=(self, i, type(self.pool), pool_kwargs),
+                                      name="%s-writer-%s" % (self.name, i))
+                p.daemon = True
+                self.workers.append(p)
+                p.start()
+            self._process_results = {}
+            self._results_reader = Thread(target=self._read_results)
+            self._results_reader.daemon = True
+            self._results_reader.start()
+            return
+        if self.partition_key is not None:
+            self._lanes = [queue.Queue(self._maxsize) for _ in range(self.num_workers)]
+            for i, lane in enumerate(self._lanes):
+                self.metrics.register_gauge('queue.lane_depth', lane.qsize, queue=self.name, lane=i)
+            self._round_robin = itertools.cycle(range(self.num_workers))
+            self._dispatcher = Thread(target=self._dispatch)
+            self._dispatcher.daemon = True
+            self._dispatcher.start()
         for i in range(self.num_workers):
-            t = Thread(target=self._worker, args=(i,))
-            self.workers.append(t)
-            t.daemon = True
-            t.start()
+            self._hire_worker()
+        if self.autoscale:
+            self.metrics.register_gauge('queue.workers', lambda: self.num_workers, queue=self.name)
+            self._stop_controller.clear()
+            self._controller = Thread(target=self._autoscale)
+            self._controller.daemon = True
+            self._controller.start()
+
+    def _hire_worker(self):
+        i = self._next_worker
+        self._next_worker += 1
+        t = Thread(target=self._run_worker, args=(i,))
+        self.workers.append(t)
+        t.daemon = True
+        self._worker_started[i] = time.monotonic()
+        self.metrics.register_gauge('queue.throughput', partial(self._throughput, i), queue=self.name, worker=i)
+        t.start()
+
+    def _dispatch(self):
+        """Route the items of the shared queue to the lanes, the stop sentinel is passed to every lane."""
+        while True:
+            item = self.get()
+            if item is None:
+                for lane in self._lanes:
+                    lane.put(None)
+                return
+            for lane, part in self._route(item):
+                self._lanes[lane].put(part)
+
+    def _lane(self, key):
+        if key is None:
+            return next(self._round_robin)
+        return hash(key) % len(self._lanes)
+
+    def _route(self, item):
+        """Lanes of the item, the rows of an INSERT are split by their key."""
+        if callable(self.partition_key):
+            return [(self._lane(self.partition_key(item)), item)]
+        if isinstance(item, InsertRows):
+            columns, rows = item.columns, item.rows
+        elif _insert_table(item) is not None:
+            columns = [c.name for c in item._columns]
+            rows = [[getattr(value, 'value', None) for value in values] for values in item._values]
+        else:
+            if not self._unordered_warned:
+                self._unordered_warned = True
+                logger.warning("[%s] Items other than INSERTs are distributed round-robin, pass a function as the "
+                               "partition key to order them: %s" % (self.name, item))
+            return [(self._lane(None), item)]
+        if self.partition_key not in columns:
+            return [(self._lane(None), item)]
+        index = columns.index(self.partition_key)
+        lanes = OrderedDict()
+        for i, row in enumerate(rows):
+            lanes.setdefault(self._lane(row[index]), []).append(i)
+        if len(lanes) == 1:
+            return [(next(iter(lanes)), item)]
+        parts = []
+        for lane, indexes in lanes.items():
+            if isinstance(item, InsertRows):
+                part = InsertRows(item.table, item.columns, [item.rows[i] for i in indexes], item.conflict)
+            else:
+                part = copy(item)
+                part._values = [item._values[i] for i in indexes]
+            parts.append((lane, part))
+        return parts
+
+    def _should_retire(self):
+        with self._scale_lock:
+            if self._retire > 0:
+                self._retire -= 1
+                return True
+            return False
+
+    def _commit_latency(self):
+        histogram = self.metrics.snapshot()['histograms'].get('queue.commit[queue=%s]' % self.name)
+        return (histogram['count'], histogram['sum']) if histogram else (0, 0.0)
+
+    def _autoscale(self):
+        """Controller adjusting the number of workers to the load, additive increase and multiplicative decrease.
+
+        A worker is hired while more than a batch is waiting in the queue. The workers are halved when a worker
+        failed or the smoothed commit latency exceeds the limit, and one is retired after five idle intervals.
+        """
+        commits, latency_sum = self._commit_latency()
+        errors = self.metrics.counter('queue.errors', queue=self.name)
+        latency = best_latency = None
+        idle = 0
+        while not self._stop_controller.wait(self.autoscale_interval):
+            new_commits, new_latency_sum = self._commit_latency()
+            new_errors = self.metrics.counter('queue.errors', queue=self.name)
+            if new_commits > commits:
+                interval_latency = (new_latency_sum - latency_sum) / (new_commits - commits)
+                latency = interval_latency if latency is None else 0.5 * latency + 0.5 * interval_latency
+                best_latency = latency if best_latency is None else min(best_latency, latency)
+            failed = new_errors > errors
+            commits, latency_sum, errors = new_commits, new_latency_sum, new_errors
+            limit = self.autoscale_latency / 1000.0 if self.autoscale_latency is not None else \
+                (max(2 * best_latency, 0.05) if best_latency is not None else None)
+
+            depth = self.qsize()
+            workers = self.num_workers
+            if failed or (latency is not None and limit is not None and latency > limit):
+                target = max(self.min_workers, workers // 2)
+                idle = 0
+            elif depth > self.batch_size:
+                target = min(self.max_workers, workers + 1)
+                idle = 0
+            elif depth == 0:
+                idle += 1
+                target = max(self.min_workers, workers - 1) if idle >= 5 else workers
+                if idle >= 5:
+                    idle = 0
+            else:
+                target = workers
+            if target != workers:
+                self._scale(target)
+
+    def _scale(self, target):
+        with self._scale_lock:
+            if self._stop_controller.is_set():
+                return
+            logger.info("[%s] Scaling the workers from \'%s\' to \'%s\'." % (self.name, self.num_workers, target))
+            if target < self.num_workers:
+                self._retire += self.num_workers - target
+                self.num_workers = target
+                return
+            self.workers = [t for t in self.workers if t.is_alive()]
+            for _ in range(target - self.num_workers):
+                self._hire_worker()
+            self.num_workers = target
+
+    def _throughput(self, worker):
+        """Items per second written by the worker since it was hired."""
+        written = self.metrics.counter('queue.items', queue=self.name, worker=worker)
+        return written / max(time.monotonic() - self._worker_started[worker], 1e-9)
 
     def fire_workers(self):
         if len(self.workers) == 0:
             # Nothing to do, no workers running
             return
+        if self._controller is not None:
+            with self._scale_lock:
+                self._stop_controller.set()
+            self._controller.join()
+            self._controller = None
         logger.info("[%s] Queue handler is firing \'%s\' worker." % (self.name, self.num_workers))
         result_lst = []
-        for i in range(self.num_workers):
+        if self._dispatcher is not None:
+            # The dispatcher stops every lane
             self.put(None)
+            self._dispatcher.join()
+            self._dispatcher = None
+        else:
+            for i in range(self.num_workers):
+                self.put(None)
+        if self.mode == 'process':
+            result_lst = self._collect_results()
         for t in self.workers:
             t.join()
-            result_lst.append({ 'name': self.name, 'result': True })
+        if self.mode == 'thread':
+            result_lst = [self._worker_results.pop(i) for i in sorted(self._worker_results)]
         self.workers = []
         return result_lst
 
-    @retry(Exception, delay=10)
-    def _worker(self, thread_num):
+    def _read_results(self):
+        """Drop the cached results of the parent as the writer processes commit, and keep their final results."""
+        while True:
+            message = self._results.get()
+            if message is None:
+                return
+            if 'invalidate' in message:
+                self.pool.invalidate_cache(*message['invalidate'])
+            else:
+                self._process_results[message['worker']] = message
+
+    def _collect_results(self):
+        """Wait for the results of the writer processes and merge them into the metrics of this process."""
+        for p in self.workers:
+            p.join()
+        # Every process flushed its messages before exiting, the sentinel is read after them
+        self._results.put(None)
+        self._results_reader.join()
+        self._results_reader = None
+        # The processes without a result died
+        results = self._process_results
+        for result in results.values():
+            self.metrics.increment('queue.items', result['items'], queue=self.name, worker=result['worker'])
+            self.metrics.increment('queue.batches', result['batches'], queue=self.name, worker=result['worker'])
+        return [results.get(i, {'name': self.name, 'worker': i, 'result': False}) for i in range(len(self.workers))]
+
+    def _get_batch(self, timeout=None, get=None):
+        """Block for the first item, then drain the queue until the batch is full or the batch timeout expires.
+
+        Returns the collected items and a flag telling whether the stop sentinel was received. If no item arrives
+        within 'timeout' seconds an empty batch is returned. 'get' reads another queue, e.g. a lane.
+        """
+        get = get or self.get
+        try:
+            d = get(timeout=timeout)
+        except queue.Empty:
+            return [], False
+        if d is None:
+            return [], True
+        batch = [d]
+        deadline = time.monotonic() + self.batch_timeout / 1000.0
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                d = get(timeout=remaining)
+            except queue.Empty:
+                break
+            if d is None:
+                return batch, True
+            batch.append(d)
+        return batch, False
+
+    def _merge_batch(self, write, batch, buffer, stop, worker=None):
+        """Buffer the mergeable items of the batch and write the others, flushing the buffer when it is due.
+
+        The buffer is flushed before any item which can not be merged, so the statements keep their order.
+        """
+        items = []
+        merged = buffer.merged
+        for item in batch:
+            if not buffer.add(item):
+                items.extend(buffer.drain())
+                items.append(item)
+        self.metrics.increment('queue.merged', buffer.merged - merged, queue=self.name, worker=worker)
+        if stop or len(buffer) >= self.merge_size or \
+                (buffer.started is not None and time.monotonic() - buffer.started >= self.merge_window / 1000.0):
+            items.extend(buffer.drain())
+        if items:
+            write(items, worker, count=len(batch))
+        elif batch:
+            self.metrics.increment('queue.items', len(batch), queue=self.name, worker=worker)
+
+    def put_rows(self, table, columns, rows, **kwargs):
+        """Queue rows, a list of value tuples in the order of the columns, inserted into the table."""
+        self.put(InsertRows(table, columns, rows), **kwargs)
+
+    def _write_spooled(self, batch, worker=None, count=None, defer=None):
+        """Write the batch, or append it to the spool if the database is unreachable or the spool is not empty."""
+        if not self.spool.pending() and time.monotonic() >= self._next_probe:
+            try:
+                with self.pool.get_connection() as conn:
+                    self._write_batch(conn, batch, worker, count, defer=defer)
+                return
+            except _UNREACHABLE as err:
+                logger.warning("[%s] Database is unreachable, spooling the writes: %s" % (self.name, err))
+                self._next_probe = time.monotonic() + self.spool_probe
+        self.spool.append(batch)
+        self.metrics.increment('queue.spooled', len(batch), queue=self.name, worker=worker)
+
+    def _replay(self, worker=None, wait=False):
+        """Replay the spooled items in order, storing the spool position in the same transactions.
+
+        If 'wait' is set, e.g. when the worker stops, the replay is attempted without waiting for the next probe.
+        """
+        if (self.spool.loaded and not self.spool.pending()) or (not wait and time.monotonic() < self._next_probe):
+            return
+        if not self._replay_lock.acquire(blocking=wait):
+            # Another worker is replaying
+            return
         try:
             with self.pool.get_connection() as conn:
+                if not self.spool.loaded:
+                    with conn.cursor() as cur:
+                        self.spool.load_position(cur)
+                    conn.commit()
+                replayed = 0
                 while True:
-                    d = self.get()
-                    if d is None:
+                    items, position = self.spool.read(self.spool_batch)
+                    if position == self.spool.position:
                         break
+                    store_position = partial(self._store_position, position)
+                    if items:
+                        self._write_batch(conn, items, worker, before_commit=store_position)
+                    else:
+                        with self.pool.get_cursor(connection=conn, commit=True) as cur:
+                            store_position(cur)
+                    self.spool.advance(position)
+                    replayed += len(items)
+            if replayed:
+                logger.info("[%s] Replayed \'%s\' spooled items." % (self.name, replayed))
+                self.metrics.increment('queue.replayed', replayed, queue=self.name, worker=worker)
+        except _UNREACHABLE as err:
+            logger.warning("[%s] Database is still unreachable: %s" % (self.name, err))
+            self._next_probe = time.monotonic() + self.spool_probe
+            try:
+                self.pool.restart()
+            except Exception as err:
+                logger.error(err)
+        finally:
+            self._replay_lock.release()
+
+    def _store_position(self, position, cursor):
+        sql, params = self.spool.position_statement(position)
+        cursor.execute(sql, params)
+
+    def _batch_timeout(self, buffer):
+        """Seconds to wait for the next batch: until the merge window ends or the next replay is due."""
+        now = time.monotonic()
+        timeouts = []
+        if buffer is not None and buffer.started is not None:
+            timeouts.append(max(buffer.started + self.merge_window / 1000.0 - now, 0))
+        if self.spool is not None and self.spool.pending():
+            timeouts.append(max(self._next_probe - now, 0))
+        if self.autoscale:
+            # Idle workers have to notice when they are retired
+            timeouts.append(self.autoscale_interval)
+        return min(timeouts) if timeouts else None
+
+    def _defer(self, worker, tries, item):
+        self._deferred.setdefault(worker, []).append((item, tries))
+
+    def _write_deferred(self, write, worker, count=None, final=False):
+        """Write the first 'count' rows deferred by the worker again, the rows deferred first go first.
+
+        A row still missing its parent is deferred again, unless it was tried 'defer_tries' times or 'final' is set:
+        then it goes to the dead-letter sink like any other failed row.
+        """
+        deferred = self._deferred.get(worker, [])
+        due = deferred[:count]
+        # The rows tried most often were deferred first
+        for tries in sorted(set(tries for _, tries in due), reverse=True):
+            group = [entry for entry in due if entry[1] == tries]
+            last = final or tries >= self.defer_tries
+            write([item for item, _ in group], worker, count=0,
+                  defer=None if last else partial(self._defer, worker, tries + 1))
+            written = set(id(entry) for entry in group)
+            deferred[:] = [entry for entry in deferred if id(entry) not in written]
+
+    def _write_batch(self, conn, batch, worker=None, count=None, before_commit=None, defer=None):
+        """Write the batch in one transaction, 'count' is the number of queued items it holds if not len(batch).
+
+        'before_commit' is called with the cursor before the transaction is committed. If a statement fails, the
+        batch is rewritten by _isolate_failures(), committing everything but the failing statements or rows.
+        """
+        count = len(batch) if count is None else count
+        if self.insert_order:
+            batch = order_inserts(batch, self.insert_order)
+        start = time.perf_counter()
+        items = coalesce_inserts(batch) if len(batch) > 1 else batch
+        statements = [str(item) for item in items]
+        try:
+            with conn.cursor() as cur:
+                for item in items:
+                    _execute(cur, item, self.json_columns)
+                if before_commit is not None:
+                    before_commit(cur)
+            conn.commit()
+        except _STATEMENT_ERRORS as err:
+            conn.rollback()
+            logger.warning("[%s] Batch of \'%s\' items failed: %s Isolating the failed statements."
+                           % (self.name, len(batch), err))
+            try:
+                self._isolate_failures(conn, items, worker, before_commit, defer)
+            except Exception:
+                conn.rollback()
+                raise
+        except Exception:
+            conn.rollback()
+            raise
+        self._written(statements, count, worker, start)
+
+    def _isolate_failures(self, conn, items, worker=None, before_commit=None, defer=None):
+        """Write the items in one transaction, each statement under a savepoint.
+
+        A failing multi-row INSERT is retried row by row. The rows still failing on a missing foreign key are
+        passed to 'defer' if given, any other failure goes to the dead-letter sink in the same transaction.
+        """
+        failures = []
+        with conn.cursor() as cur:
+            for item in items:
+                err = _savepoint(cur, item, self.json_columns)
+                if err is None:
+                    continue
+                rows = _split_rows(item)
+                if len(rows) == 1:
+                    failures.append((item, err))
+                    continue
+                for row in rows:
+                    row_err = _savepoint(cur, row, self.json_columns)
+                    if row_err is not None:
+                        failures.append((row, row_err))
+
+            letters = []
+            for item, err in failures:
+                if defer is not None and isinstance(err, ForeignKeyViolation):
+                    defer(item)
+                else:
+                    letters.append(self._dead_letter_record(item, err, worker))
+            if letters:
+                self._send_dead_letters(cur, letters, worker)
+            if before_commit is not None:
+                before_commit(cur)
+        conn.commit()
+
+    def _dead_letter_record(self, item, err, worker=None):
+        values = _insert_values(item)
+        return {
+            'time': datetime.now(timezone.utc).isoformat(),
+            'queue': self.name,
+            'worker': worker,
+            'table_name': _insert_table(item),
+            'statement': str(item),
+            'columns': list(values[0]) if values is not None else None,
+            'rows': [list(row) for row in values[1]] if values is not None else None,
+            'error': str(err).strip(),
+            'sqlstate': getattr(err, 'pgcode', None),
+        }
 
-                    with self.pool.get_cursor(connection=conn, commit=True) as cur:
-                        cur.execute(str(d))
+    def _send_dead_letters(self, cursor, letters, worker=None):
+        self.metrics.increment('queue.dead_letters', len(letters), queue=self.name, worker=worker)
+        if self.dead_letter is None:
+            for letter in letters:
+                logger.error("[%s] Dropped the failed statement: %s Error: %s"
+                             % (self.name, letter['statement'], letter['error']))
+            return
+        logger.warning("[%s] Sent \'%s\' failed items to the dead-letter sink." % (self.name, len(letters)))
+        self.dead_letter.put(letters, cursor)
+
+    def _written(self, statements, items, worker, start):
+        self.metrics.observe('queue.commit', time.perf_counter() - start, queue=self.name)
+        self.metrics.increment('queue.items', items, queue=self.name, worker=worker)
+        self.metrics.increment('queue.batches', queue=self.name, worker=worker)
+        self._invalidate(statements)
+
+    def _invalidate(self, statements):
+        """Drop the cached query results of the tables written by the committed statements."""
+        tables = set()
+        for statement in statements:
+            tables.update(written_tables(statement))
+        self._tables_written.update(tables)
+        if tables:
+            self.pool.invalidate_cache(*tables)
+            if self._writer_process:
+                # The parent has its own cache
+                self._results.put({'name': self.name, 'invalidate': sorted(tables)})
+
+    def _run_worker(self, thread_num):
+        """Run the worker, retrying it while the database is unreachable within its retry budget.
+
+        While the database is down the pool fails fast and the retries wait for its circuit breaker. The worker
+        dies on any other error or once its budget is exhausted, it is reported by its result: False with the error.
+        The items left in the lane of a dead worker are dropped, so the dispatcher is not blocked.
+        """
+        result = {'name': self.name, 'worker': thread_num, 'result': False}
+        budget = RetryBudget(ratio=0.0, min_retries=self.worker_retries, window=self.worker_retry_window)
+        try:
+            result['result'] = bool(retry(_UNREACHABLE, tries=None, delay=1, max_delay=30,
+                                          budget=budget)(self._worker)(thread_num))
+        except Exception as err:
+            result['error'] = str(err).strip() or type(err).__name__
+            self.metrics.increment('queue.dead_workers', queue=self.name)
+            logger.error("[%s] Queue handler: \'%s\' died: %s" % (self.name, thread_num, result['error']))
+            # There is no next attempt for the merged and deferred rows
+            dropped = len(self._buffers.pop(thread_num, ())) + len(self._deferred.pop(thread_num, ()))
+            if self._lanes:
+                while self._lanes[thread_num].get() is not None:
+                    dropped += 1
+            if dropped:
+                self.metrics.increment('queue.dropped', dropped, queue=self.name, worker=thread_num)
+                logger.error("[%s] Dropped \'%s\' items of the dead worker \'%s\'." % (self.name, dropped, thread_num))
+        self._worker_results[thread_num] = result
+        return result
+
+    def _worker(self, thread_num):
+        batch = []
+        buffer = None
+        if self.merge_keys:
+            buffer = self._buffers.setdefault(thread_num, MergeBuffer(self.merge_keys, self.merge))
+        try:
+            # With a spool the connection is checked out per batch, so a broken one is replaced after an outage
+            with self.pool.get_connection() if self.spool is None else nullcontext() as conn:
+                write = self._write_spooled if conn is None else partial(self._write_batch, conn)
+                get = self._lanes[thread_num].get if self._lanes else None
+                while True:
+                    batch, stop = self._get_batch(self._batch_timeout(buffer), get)
+                    # A worker stops either for a sentinel or for a retirement requested by the autoscaling
+                    retire = not stop and self._should_retire()
+                    if buffer is None:
+                        if batch:
+                            # The rows deferred before this batch are due, it may have written their parents
+                            pending = len(self._deferred.get(thread_num, ()))
+                            defer = partial(self._defer, thread_num, 1) if self._lanes else None
+                            write(batch, thread_num, defer=defer)
+                            self._write_deferred(write, thread_num, None if stop else pending, final=stop)
+                        elif stop:
+                            self._write_deferred(write, thread_num, final=True)
+                    else:
+                        self._merge_batch(write, batch, buffer, stop or retire, thread_num)
+                    if self.spool is not None:
+                        self._replay(thread_num, wait=stop)
+                    if stop or retire:
+                        break
         except Exception as err:
+            self.metrics.increment('queue.errors', queue=self.name)
+            if isinstance(err, CircuitOpenError):
+                # The database is known to be down, there is nothing to restart
+                raise
             tb = traceback.format_exc()
-            logger.error("Broken Query: %s" % d)
+            logger.error("Broken Query: %s" % "; ".join(str(d) for d in batch))
+            if buffer is not None and len(buffer):
+                logger.warning("[%s] Keeping \'%s\' merged rows of worker \'%s\' for its next attempt."
+                               % (self.name, len(buffer), thread_num))
             logger.error(tb)
-            # TODO: Maybe this can fix it?
-            self.pool.restart()
+            if isinstance(err, _UNREACHABLE):
+                # TODO: Maybe this can fix it?
+                self.pool.restart()
             raise
         else:
+            # The buffer was flushed and the deferred rows were written when the worker stopped
+            self._buffers.pop(thread_num, None)
+            self._deferred.pop(thread_num, None)
             logger.info("[%s] Queue handler: \'%s\' exited safely." % (self.name, thread_num))
-            return None
-
+            return True
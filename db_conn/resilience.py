@@ -0,0 +1,247 @@
+# Common Python library imports
+import random
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+# Pip package imports
+import psycopg2
+from psycopg2.pool import PoolError
+from loguru import logger
+
+# Internal package imports
+from db_conn.utils import TunnelError
+from db_conn.connection.pool import PoolTimeout
+
+
+# Error classes, see classify()
+OUTAGE = 'outage'
+TRANSIENT = 'transient'
+FATAL = 'fatal'
+
+# SQLSTATEs telling that the server can not be used at the moment: connection exception, too many connections,
+# admin or crash shutdown, cannot connect now
+_OUTAGE_SQLSTATES = ('08', '53300', '57P01', '57P02', '57P03')
+# SQLSTATEs of the failures which may pass when the transaction is retried: serialization failure, deadlock,
+# insufficient resources, lock not available, query canceled (e.g. statement timeout)
+_TRANSIENT_SQLSTATES = ('40', '53', '55P03', '57014')
+
+
+class CircuitOpenError(psycopg2.OperationalError):
+    """Raised without calling the database while the circuit breaker is open.
+
+    It is an OperationalError, so the callers handling an unreachable database handle it the same way.
+    'retry_after' is the number of seconds until the breaker lets a call through again.
+    """
+
+    def __init__(self, message, retry_after=0.0):
+        super(CircuitOpenError, self).__init__(message)
+        self.retry_after = retry_after
+
+
+def classify(err):
+    """Classify an error as OUTAGE (the database is unreachable), TRANSIENT (retrying may succeed) or FATAL.
+
+    psycopg2 errors are classified by their SQLSTATE, or their type if they have none: connection failures are
+    outages, integrity, data and programming errors are fatal. Any other exception is transient.
+    """
+    if isinstance(err, CircuitOpenError):
+        return OUTAGE
+    if isinstance(err, PoolTimeout):
+        return TRANSIENT
+    if isinstance(err, PoolError):
+        # The pool was closed
+        return FATAL
+    if isinstance(err, psycopg2.Error):
+        code = getattr(err, 'pgcode', None)
+        if code:
+            if code.startswith(_OUTAGE_SQLSTATES):
+                return OUTAGE
+            if code.startswith(_TRANSIENT_SQLSTATES):
+                return TRANSIENT
+            return FATAL
+        if isinstance(err, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+            return OUTAGE
+        return FATAL
+    if isinstance(err, (TunnelError, OSError)):
+        return OUTAGE
+    return TRANSIENT
+
+
+def decorrelated_jitter(base, cap, previous):
+    """Next sleep of the 'decorrelated jitter' backoff: random between 'base' and three times the previous sleep.
+
+    Unlike a fixed exponential backoff, the callers failing at the same time do not retry in lockstep.
+    """
+    return min(cap, random.uniform(base, max(previous, base) * 3))
+
+
+class RetryBudget(object):
+    """Limit of the retries to a 'ratio' of the calls in the last 'window' seconds, plus 'min_retries'.
+
+    While the database is failing every call would be retried several times, multiplying the load. With the
+    budget the extra load of the retries is bounded and the calls over the budget fail at once.
+    """
+
+    def __init__(self, ratio=0.2, min_retries=10, window=10.0):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self._lock = threading.Lock()
+        self._calls = deque()
+        self._retries = deque()
+
+    def _trim(self, now):
+        for events in (self._calls, self._retries):
+            while events and events[0] <= now - self.window:
+                events.popleft()
+
+    def record_call(self):
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            self._calls.append(now)
+
+    def try_retry(self):
+        """Take a retry from the budget, False if it is exhausted."""
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            if len(self._retries) >= self.min_retries + self.ratio * len(self._calls):
+                return False
+            self._retries.append(now)
+            return True
+
+
+class CircuitBreaker(object):
+    """Fail fast while the database is down, instead of every caller waiting for its own connection timeout.
+
+    After 'failure_threshold' consecutive outage errors (see classify()) the breaker opens and before_call()
+    raises CircuitOpenError. After the reset timeout, starting at 'reset_timeout' seconds and growing with
+    decorrelated jitter up to 'max_reset_timeout', a single probe call is let through: its success closes the
+    breaker, its failure opens it again. Fatal and transient errors do not count.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=1.0, max_reset_timeout=30.0, name='database'):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.name = name
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._timeout = reset_timeout
+        self._opened_until = 0.0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() >= self._opened_until:
+                return self.HALF_OPEN
+            return self._state
+
+    def before_call(self):
+        """Raise CircuitOpenError if the call must not reach the database."""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            now = time.monotonic()
+            if now >= self._opened_until:
+                # Let this call probe the database, the others keep failing fast until it finishes or times out
+                self._state = self.HALF_OPEN
+                self._opened_until = now + self._timeout
+                return
+            retry_after = max(self._opened_until - now, 0.0)
+        raise CircuitOpenError("Circuit breaker of \'%s\' is open, retry in %.2f seconds"
+                               % (self.name, retry_after), retry_after)
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info("Circuit breaker of \'%s\' is closed." % self.name)
+            self._state = self.CLOSED
+            self._failures = 0
+            self._timeout = self.reset_timeout
+
+    def record_failure(self, err):
+        if isinstance(err, CircuitOpenError) or classify(err) != OUTAGE:
+            return
+        with self._lock:
+            if self._state == self.OPEN:
+                # A call started before the breaker opened
+                return
+            self._failures += 1
+            if self._state == self.CLOSED and self._failures < self.failure_threshold:
+                return
+            if self._state == self.HALF_OPEN:
+                self._timeout = decorrelated_jitter(self.reset_timeout, self.max_reset_timeout, self._timeout)
+            self._state = self.OPEN
+            self._opened_until = time.monotonic() + self._timeout
+            logger.warning("Circuit breaker of \'%s\' is open for %.2f seconds: %s"
+                           % (self.name, self._timeout, str(err).strip()))
+
+    def call(self, func, *args, **kwargs):
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as err:
+            self.record_failure(err)
+            raise
+        self.record_success()
+        return result
+
+
+def retry(exceptions=Exception, tries=4, delay=0.1, max_delay=30.0, budget=None, breaker=None, logger=logger):
+    """Retry calling the decorated function with a decorrelated jitter backoff.
+
+    :param exceptions: the exception or tuple of exceptions to retry, fatal psycopg2 errors are never retried
+    :param tries: number of times to try (not retry) before the last error is raised, None to try until success
+    :param delay: shortest delay between the tries in seconds
+    :param max_delay: longest delay between the tries in seconds
+    :param budget: RetryBudget shared by the calls, the error is raised when the budget is exhausted
+    :param breaker: CircuitBreaker guarding the calls, or a function returning it from the call arguments.
+        While it is open the function is not called, the retry waits until the breaker lets a probe through.
+    :param logger: logger to use, None to log nothing
+    """
+    def deco_retry(f):
+
+        @wraps(f)
+        def f_retry(*args, **kwargs):
+            cb = breaker(*args, **kwargs) if callable(breaker) and not isinstance(breaker, CircuitBreaker) \
+                else breaker
+            if budget is not None:
+                budget.record_call()
+            attempt, sleep = 1, delay
+            while True:
+                try:
+                    result = cb.call(f, *args, **kwargs) if cb is not None else f(*args, **kwargs)
+                except exceptions as err:
+                    reason = None
+                    if classify(err) == FATAL:
+                        reason = "fatal error"
+                    elif tries is not None and attempt >= tries:
+                        reason = "%d tries" % attempt
+                    elif budget is not None and not budget.try_retry():
+                        reason = "retry budget exhausted"
+                    if reason is not None:
+                        if logger:
+                            logger.error("%s, Retrying failed (%s)." % (str(err).strip(), reason))
+                        raise
+                    sleep = decorrelated_jitter(delay, max_delay, sleep)
+                    # No point in trying before the breaker lets a call through
+                    sleep = max(sleep, min(getattr(err, 'retry_after', 0.0), max_delay))
+                    if logger:
+                        logger.warning("%s, Retrying in %.2f seconds..." % (str(err).strip(), sleep))
+                    time.sleep(sleep)
+                    attempt += 1
+                else:
+                    return result
+
+        return f_retry  # true decorator
+
+    return deco_retry
@@ -0,0 +1,210 @@
+# Common Python library imports
+import mmap
+import os
+import pickle
+import re
+import struct
+import threading
+import zlib
+
+# Pip package imports
+from loguru import logger
+
+
+# Every record is its payload length and CRC32 followed by the pickled list of queue items
+_HEADER = struct.Struct('!II')
+_FILE_NAME = re.compile(r'^(?P<name>.+)\.(?P<generation>\d+)\.spool$')
+# The next generation of a spool, kept when all of its files were replayed and removed
+_GENERATION_FILE = '%s.generation'
+
+# Replay position of the spools, updated in the transaction of the replayed items
+SPOOL_TABLE = 'db_conn_spool'
+_CREATE_TABLE = 'CREATE TABLE IF NOT EXISTS "%s" (name TEXT PRIMARY KEY, generation INTEGER NOT NULL, ' \
+                'position BIGINT NOT NULL)' % SPOOL_TABLE
+_SELECT_POSITION = 'SELECT generation, position FROM "%s" WHERE name=%%s' % SPOOL_TABLE
+_UPSERT_POSITION = 'INSERT INTO "%s" (name, generation, position) VALUES (%%s, %%s, %%s) ' \
+                   'ON CONFLICT (name) DO UPDATE SET generation=EXCLUDED.generation, position=EXCLUDED.position' \
+                   % SPOOL_TABLE
+
+
+class Spool(object):
+    """Append-only local log of queue items, absorbing the writes while the database is unreachable.
+
+    The items are appended to '<name>.<generation>.spool' files in the directory, read back through mmap and
+    replayed in order. The replay position is stored in the database in the transaction writing the replayed
+    items (see position_statement()), so after a crash the replay continues exactly where the last commit left
+    off. Every process start appends to a new generation, a torn record at the end of a file is skipped.
+    Generation numbers are never reused, the stored position of a removed file must not match a new one.
+    """
+
+    def __init__(self, directory, name='spool', fsync=True):
+        self.directory = directory
+        self.name = name
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        generations = self._generations()
+        self._active = max((max(generations) + 1) if generations else 0, self._next_generation())
+        self._active_size = 0
+        self._file = None
+        # Replay position, loaded from the database by load_position()
+        self._position = (min(generations), 0) if generations else (self._active, 0)
+        self._loaded = False
+
+    def _path(self, generation):
+        return os.path.join(self.directory, '%s.%d.spool' % (self.name, generation))
+
+    def _generations(self):
+        generations = []
+        for file_name in os.listdir(self.directory):
+            match = _FILE_NAME.match(file_name)
+            if match and match.group('name') == self.name:
+                generations.append(int(match.group('generation')))
+        return sorted(generations)
+
+    def _next_generation(self):
+        try:
+            with open(os.path.join(self.directory, _GENERATION_FILE % self.name)) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _reserve(self, generation):
+        # Written before the file of the generation is created, so a restart starts after it
+        path = os.path.join(self.directory, _GENERATION_FILE % self.name)
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(generation + 1))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def _size(self, generation):
+        if generation == self._active:
+            return self._active_size
+        try:
+            return os.path.getsize(self._path(generation))
+        except FileNotFoundError:
+            return 0
+
+    @property
+    def position(self):
+        return self._position
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def append(self, items):
+        """Append the items as one record, synced to the disk if 'fsync' is set."""
+        payload = pickle.dumps(list(items), protocol=pickle.HIGHEST_PROTOCOL)
+        record = _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if self._file is None:
+                self._reserve(self._active)
+                self._file = open(self._path(self._active), 'ab')
+            self._file.write(record)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._active_size += len(record)
+
+    def pending(self):
+        """True if there are items which were not replayed yet."""
+        with self._lock:
+            generation, position = self._position
+            if generation == self._active:
+                return position < self._active_size
+            return self._active_size > 0 or any(
+                self._size(g) > (position if g == generation else 0)
+                for g in self._generations() if generation <= g < self._active)
+
+    def load_position(self, cursor):
+        """Read the replay position stored in the database, dropping the files which were fully replayed."""
+        cursor.execute(_CREATE_TABLE)
+        cursor.execute(_SELECT_POSITION, (self.name,))
+        row = cursor.fetchone()
+        with self._lock:
+            if row is not None:
+                stored = (row[0], row[1])
+                if stored[0] >= self._active and self._file is None:
+                    # The files of the stored generation are gone, e.g. the generation file was lost
+                    self._active = stored[0] + 1
+                    self._position = (self._active, 0)
+                elif stored > self._position:
+                    self._position = stored
+            self._loaded = True
+        self._remove_replayed()
+
+    def position_statement(self, position):
+        """SQL and parameters storing the replay position, executed in the transaction of the replayed items."""
+        return _UPSERT_POSITION, (self.name, position[0], position[1])
+
+    def read(self, max_items=5000):
+        """Read the items following the replay position, from a single file.
+
+        Returns the items and the position after them, to be passed to advance() once they are committed.
+        """
+        with self._lock:
+            active, active_size = self._active, self._active_size
+        generation, position = self._position
+        while True:
+            size = active_size if generation == active else self._size(generation)
+            if position < size:
+                break
+            if generation >= active:
+                return [], (generation, position)
+            generation, position = generation + 1, 0
+
+        items = []
+        torn = False
+        with open(self._path(generation), 'rb') as f:
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as data:
+                while position < size and len(items) < max_items:
+                    header_end = position + _HEADER.size
+                    if header_end > size:
+                        torn = True
+                        break
+                    length, crc = _HEADER.unpack(data[position:header_end])
+                    payload = data[header_end:header_end + length]
+                    if len(payload) < length or zlib.crc32(payload) != crc:
+                        torn = True
+                        break
+                    items.extend(pickle.loads(payload))
+                    position = header_end + length
+        if torn:
+            # Torn record left by a crash while appending, nothing after it can be read
+            logger.warning("Skipping the torn end of the spool file \'%s\' at %s." % (self._path(generation), position))
+            position = size
+        return items, (generation, position)
+
+    def advance(self, position):
+        """Set the replay position after the items read up to it were committed."""
+        with self._lock:
+            self._position = position
+            if position == (self._active, self._active_size) and self._active_size > 0:
+                # Everything was replayed, the next items go to a new file and the old one can be removed
+                self._file.close()
+                self._file = None
+                self._active += 1
+                self._active_size = 0
+                self._position = (self._active, 0)
+        self._remove_replayed()
+
+    def _remove_replayed(self):
+        with self._lock:
+            generation, position = self._position
+            replayed = [g for g in self._generations() if g < generation or
+                        (g == generation and g != self._active and position >= self._size(g))]
+        for g in replayed:
+            try:
+                os.remove(self._path(g))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
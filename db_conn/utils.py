@@ -1,7 +1,10 @@
 # Common Python library imports
+import itertools
 import os
+import socket
+import struct
+import threading
 import time
-from functools import wraps
 
 # Pip package imports
 from sshtunnel import SSHTunnelForwarder
@@ -9,7 +12,11 @@ from loguru import logger
 
 
 def retry(ExceptionToCheck, tries=4, delay=1, backoff=2, logger=logger):
-    """Retry calling the decorated function using an exponential backoff.
+    """Retry calling the decorated function using a jittered exponential backoff.
+
+    Delegates to db_conn.resilience.retry(): the delays are drawn with decorrelated jitter, fatal psycopg2
+    errors are not retried, the retries of the decorated function share a RetryBudget and the last error is
+    raised.
 
     :param ExceptionToCheck: the exception to check. may be a tuple of
         exceptions to check
@@ -18,33 +25,54 @@ def retry(ExceptionToCheck, tries=4, delay=1, backoff=2, logger=logger):
     :type tries: int
     :param delay: initial delay between retries in seconds
     :type delay: int
-    :param backoff: backoff multiplier e.g. value of 2 will double the delay
-        each retry
+    :param backoff: backoff multiplier, the delays grow up to delay * backoff ** (tries - 1) seconds
     :type backoff: int
-    :param logger: logger to use. If None, print
+    :param logger: logger to use. If None, nothing is logged
     :type logger: logging.Logger instance
     """
-    def deco_retry(f):
+    from db_conn import resilience
+    return resilience.retry(ExceptionToCheck, tries=tries, delay=delay, max_delay=delay * backoff ** max(tries - 1, 0),
+                            budget=resilience.RetryBudget(), logger=logger)
+
+
+class TunnelError(Exception):
+    pass
+
+
+# Sent by the clients to ask for SSL, every PostgreSQL server answers it with a single 'S' or 'N' byte
+_SSL_REQUEST = struct.pack('!ii', 8, 80877103)
+
+
+def probe_postgres(address, timeout=1.0):
+    """Open a TCP connection to the address and do the first step of the PostgreSQL handshake.
+
+    Raises OSError if the port does not accept connections or the peer does not answer like a PostgreSQL server.
+    """
+    with socket.create_connection(address, timeout=timeout) as sock:
+        sock.sendall(_SSL_REQUEST)
+        answer = sock.recv(1)
+    if answer not in (b'S', b'N'):
+        raise OSError("Unexpected answer to the SSL request: %r" % answer)
 
-        @wraps(f)
-        def f_retry(*args, **kwargs):
-            mtries, mdelay = tries, delay
-            while mtries > 1:
-                try:
-                    return f(*args, **kwargs)
-                except ExceptionToCheck as e:
-                    msg = "%s, Retrying in %d seconds..." % (str(e), mdelay)
-                    if logger:
-                        logger.warning(msg)
-                    time.sleep(mdelay)
-                    mtries -= 1
-                    mdelay *= backoff
-            logger.error("%s, Retrying failed.")
-            return None
 
-        return f_retry  # true decorator
+def wait_for_postgres(address, timeout=30, interval=0.05, max_interval=0.5):
+    """Poll the address with probe_postgres() until it succeeds, backing off from 'interval' to 'max_interval'.
 
-    return deco_retry
+    Raises TunnelError if the server is not reachable within 'timeout' seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        try:
+            probe_postgres(address, timeout=max(min(remaining, 1.0), 0.01))
+            return
+        except OSError as err:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TunnelError("Database at \'%s:%s\' is not reachable after %s seconds: %s"
+                                  % (address[0], address[1], timeout, err))
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, max_interval)
 
 
 def get_nested(data, *args, **kwargs):
@@ -68,6 +96,10 @@ class Singleton(type):
         #else:
 #            cls._instances[cls].__init__(*args, **kwargs)
         return cls._instances[cls]
+
+    def reset_instance(cls):
+        """Forget the instance of the class, e.g. the one inherited by a forked process, without closing it."""
+        return cls._instances.pop(cls, None)
     """
     @staticmethod
     def getInstance():
@@ -85,6 +117,8 @@ class Tunnel(SSHTunnelForwarder):
         'ssh_password': '',
         'remote_bind_address':('127.0.0.1', 5432),
         'local_bind_address': ('127.0.0.1', 8080),  # could be any available port
+        # Seconds to wait for the forwarded database after start
+        'ready_timeout': 30,
     }
 
     def __init__(self, *args, **kwargs):
@@ -93,6 +127,7 @@ class Tunnel(SSHTunnelForwarder):
 
         username = os.environ.get('SSH_USERNAME', kwargs.get('username', get_nested(config, 'ssh_username')))
         password = os.environ.get('SSH_PASSWORD', kwargs.get('password', get_nested(config, 'ssh_password')))
+        self.ready_timeout = config.get('ready_timeout', 30)
 
         super(Tunnel, self).__init__(
             get_nested(config, 'ssh_address_or_host'),
@@ -108,6 +143,115 @@ class Tunnel(SSHTunnelForwarder):
     def __del__(self):
         self.close()
 
+    def wait_ready(self, timeout=None):
+        """Block until the database answers through the forwarded local port."""
+        if not self.is_active:
+            raise TunnelError("Tunnel to \'%s:%s\' could not be started" % (self.ssh_host, self.ssh_port))
+        wait_for_postgres(self.local_bind_addresses[0], timeout=self.ready_timeout if timeout is None else timeout)
+
+class TunnelGroup(object):
+    """Several tunnels to the same database, forwarded on consecutive local ports from 'local_bind_address'.
+
+    Every tunnel is a separate SSH connection, so the connections spread over them are not limited by the
+    bandwidth of a single SSH channel. next_address() picks the local address for a new database connection
+    with the 'round_robin' or the 'least_loaded' strategy, the load being the open connections of the tunnel.
+    Tunnels which went down are restarted on their own, the others keep serving their connections.
+    """
+
+    config = {
+        'tunnels': 4,
+        'strategy': 'round_robin',
+    }
+
+    def __init__(self, *args, **kwargs):
+
+        config = { **TunnelGroup.config, **Tunnel.config, **kwargs.get('config', {})}
+        assert config['strategy'] in ('round_robin', 'least_loaded'), \
+            "Strategy '%s' is not supported." % config['strategy']
+        self.strategy = config['strategy']
+        factory = kwargs.get('tunnel_factory', Tunnel)
+
+        # Without explicit credentials the tunnels use the ones of the config
+        credentials = {key: kwargs[key] for key in ('username', 'password') if kwargs.get(key) is not None}
+        host, port = get_nested(config, 'local_bind_address')
+        self.tunnels = []
+        for i in range(config['tunnels']):
+            tunnel_config = {**config, 'local_bind_address': (host, port + i if port else 0)}
+            self.tunnels.append(factory(config=tunnel_config, **credentials))
+        self._lock = threading.Lock()
+        self._connections = [[] for _ in self.tunnels]
+        self._next = itertools.cycle(range(len(self.tunnels)))
+
+    @property
+    def is_active(self):
+        return any(tunnel.is_active for tunnel in self.tunnels)
+
+    @property
+    def local_bind_addresses(self):
+        return [tunnel.local_bind_addresses[0] for tunnel in self.tunnels]
+
+    def start(self):
+        for tunnel in self.tunnels:
+            tunnel.start()
+
+    def stop(self):
+        for tunnel in self.tunnels:
+            tunnel.stop()
+
+    def wait_ready(self, timeout=None):
+        for tunnel in self.tunnels:
+            tunnel.wait_ready(timeout)
+
+    def restart(self):
+        """Restart the tunnels which are down or not forwarding to the database."""
+        for i, tunnel in enumerate(self.tunnels):
+            if self._is_alive(tunnel):
+                continue
+            logger.warning("Tunnel '%s' of the group is down, restarting it." % i)
+            tunnel.restart()
+
+    @staticmethod
+    def _is_alive(tunnel):
+        if not tunnel.is_active:
+            return False
+        try:
+            probe_postgres(tunnel.local_bind_addresses[0])
+        except OSError:
+            return False
+        return True
+
+    def _load(self, i):
+        # Closed connections are forgotten here
+        self._connections[i] = [conn for conn in self._connections[i] if not conn.closed]
+        return len(self._connections[i])
+
+    def next_address(self):
+        """Local address of the tunnel to open the next database connection on."""
+        with self._lock:
+            active = [i for i, tunnel in enumerate(self.tunnels) if tunnel.is_active]
+            if not active:
+                raise TunnelError("None of the tunnels of the group are active")
+            if self.strategy == 'least_loaded':
+                index = min(active, key=self._load)
+            else:
+                index = next(i for i in self._next if i in active)
+            return self.tunnels[index].local_bind_addresses[0]
+
+    def track(self, address, connection):
+        """Register a connection opened on the address, its load counts until it is closed."""
+        with self._lock:
+            for i, tunnel in enumerate(self.tunnels):
+                if tunnel.local_bind_addresses[0] == address:
+                    # Forget the closed connections, with round-robin nothing else would prune them
+                    self._load(i)
+                    self._connections[i].append(connection)
+                    return
+
+    def stats(self):
+        with self._lock:
+            return {address: self._load(i) for i, address in enumerate(self.local_bind_addresses)}
+
+
 def listify(args):
     """Return args as a list.
     If already a list - returned as is.
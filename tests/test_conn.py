@@ -1,4 +1,5 @@
 import os
+import psycopg2
 import pytest
 import db_conn as conn
 
@@ -56,3 +57,538 @@ def test_pool_connection_pandas_query(setup_tunnel):
         db = get_connection_pool(setup_tunnel)
         df = db.sql_query("select match_id from matches limit 1;")
         assert len(df.index) == 1
+
+def test_pool_connection_chunked_query(setup_tunnel):
+    db = get_connection_pool(setup_tunnel)
+    chunks = list(db.sql_query_chunks("select match_id from matches limit 5;", chunk_size=2, dataframe=False))
+    assert [len(c) for c in chunks] == [2, 2, 1]
+
+def test_pool_connection_copy_query(setup_tunnel):
+    db = get_connection_pool(setup_tunnel)
+    query = "select match_id, full_date from matches order by match_id limit 10;"
+    df = db.sql_query_copy(query)
+    expected = db.sql_query(query)
+    assert df['match_id'].to_list() == expected['match_id'].to_list()
+    assert str(df['full_date'].dtype).startswith('datetime64')
+
+def test_copy_csv_parses_numeric_like_sql_query():
+    import io
+    from collections import namedtuple
+    from db_conn.connection.postgresql import _read_copy_csv
+    Column = namedtuple('Column', 'name type_code')
+    description = [Column('match_id', 23), Column('odds', 1700), Column('rating', 701)]
+    df = _read_copy_csv(io.StringIO('1,1.25,6.5\n2,\\N,7\n'), description, None)
+    # pandas.read_sql_query coerces the Decimal values of sql_query to floats as well
+    assert str(df['odds'].dtype) == 'float64' and df['odds'][0] == 1.25 and df['odds'].isna()[1]
+    assert str(df['rating'].dtype) == 'float64'
+
+
+def test_prepared_statement_placeholders():
+    from db_conn.connection.prepared import to_positional
+    assert to_positional('SELECT * FROM t WHERE a=%s AND b LIKE \'x%%\' AND c=ANY(%s)') == \
+        'SELECT * FROM t WHERE a=$1 AND b LIKE \'x%\' AND c=ANY($2)'
+
+def test_single_connection_prepared_query(setup_tunnel):
+    db = conn.psql.Connection(config={**DB_CONFIGURATION, 'prepared_statements': 16}, tunnel=setup_tunnel)
+    for _ in range(3):
+        df = db.sql_query(conn.query.sc_soccer.get_last_match_date())
+        assert len(df.index) == 1
+    assert len(db._prepared) == 1
+
+def test_pool_connection_parallel_combined_data(setup_tunnel):
+    db = get_connection_pool(setup_tunnel)
+    match_ids = db.sql_query("select match_id from matches limit 10;")['match_id'].to_list()
+    serial = conn.query.sc_soccer.get_combined_data(db, match_ids=match_ids)
+    parallel = conn.query.sc_soccer.get_combined_data(db, match_ids=match_ids, parallel=True, chunk_size=3)
+    assert sorted(serial['match_id'].to_list()) == sorted(parallel['match_id'].to_list())
+
+def test_pool_connection_dimension_cache(setup_tunnel):
+    db = get_connection_pool(setup_tunnel)
+    dimensions = conn.query.sc_soccer.DimensionCache(db, ttl=None)
+    match_ids = db.sql_query("select match_id from matches limit 5;")['match_id'].to_list()
+    joined = db.sql_query(conn.query.sc_soccer.get_all_match_data(match_ids=match_ids))
+    cached = dimensions.enrich(db.sql_query(conn.query.sc_soccer.get_all_match_data(match_ids=match_ids,
+                                                                                   dimensions=dimensions)))
+    assert sorted(joined['home_team_slug'].to_list()) == sorted(cached['home_team_slug'].to_list())
+
+def test_result_cache_invalidation():
+    from db_conn.connection.cache import ResultCache
+    cache = ResultCache(size=2, ttl=None)
+    matches_key = ResultCache.key('SELECT * FROM "matches" "m"  JOIN "teams" "t" ON 1=1;')
+    players_key = ResultCache.key('SELECT * FROM "players" WHERE sc_player_id=%s', (1,))
+    cache.set(matches_key, 'matches')
+    cache.set(players_key, 'players')
+    assert cache.get(ResultCache.key('SELECT * FROM "matches" "m" JOIN "teams" "t" ON 1=1')) == 'matches'
+    cache.invalidate('teams')
+    assert cache.get(matches_key) is None
+    assert cache.get(players_key) == 'players'
+    # Results fetched while a table was written are not stored
+    generation = cache.generation
+    cache.invalidate('players')
+    cache.set(matches_key, 'stale', generation)
+    assert cache.get(matches_key) is None
+    # Whitespace inside the literals is significant
+    assert ResultCache.key("SELECT * FROM players WHERE full_name='a  b'") != \
+        ResultCache.key("SELECT * FROM players WHERE full_name='a b'")
+
+
+def test_referenced_and_written_tables():
+    from db_conn.connection.cache import referenced_tables, written_tables
+    assert referenced_tables('SELECT * FROM "matches" "m", "teams" AS "t", public.players p '
+                             'JOIN "odds" "o" ON 1=1 WHERE x IN (SELECT 1 FROM seasons, stadiums)') == \
+        {'matches', 'teams', 'players', 'odds', 'seasons', 'stadiums'}
+    assert written_tables('TRUNCATE TABLE lineups, "player_lineups" CASCADE') == {'lineups', 'player_lineups'}
+    assert written_tables('INSERT INTO "player_stats" ("match_id") VALUES (1)') == {'player_stats'}
+
+def test_half_open_breaker_closes_on_a_round_trip():
+    import time
+    from contextlib import contextmanager
+    from types import SimpleNamespace
+    from db_conn.connection.pool import BlockingConnectionPool
+    from db_conn.metrics import Metrics
+    from db_conn.resilience import CircuitBreaker
+
+    database = SimpleNamespace(down=False)
+
+    class FakeConnection(object):
+        closed = False
+        info = SimpleNamespace(transaction_status=psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
+        @contextmanager
+        def cursor(self):
+            if database.down:
+                raise psycopg2.OperationalError("server closed the connection unexpectedly")
+            yield SimpleNamespace(execute=lambda sql: None)
+
+        def rollback(self):
+            pass
+
+        def close(self):
+            self.closed = True
+
+    # The connection is handed out without a health check
+    pool = object.__new__(conn.psql.ConnectionPool)
+    pool._connection = BlockingConnectionPool(FakeConnection, minconn=1, maxconn=1, check_interval=None)
+    pool.metrics = Metrics()
+    pool.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01, max_reset_timeout=0.01)
+    database.down = True
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.get_connection() as connection:
+            with connection.cursor():
+                pass
+    assert pool.breaker.state == CircuitBreaker.OPEN
+    time.sleep(0.02)
+    # The probe pings the idle connection, the database is still down
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.get_connection():
+            pass
+    assert pool.breaker.state == CircuitBreaker.OPEN and pool._connection.stats()['size'] == 0
+    database.down = False
+    time.sleep(0.02)
+    with pool.get_connection():
+        assert pool.breaker.state == CircuitBreaker.CLOSED
+    pool._connection.closeall()
+
+def test_pool_connection_blocking_checkout(setup_tunnel):
+    from db_conn.connection.pool import BlockingConnectionPool, PoolTimeout
+    # Opens the tunnel
+    get_connection_pool(setup_tunnel)
+    pool = BlockingConnectionPool(lambda: psycopg2.connect(user=DB_CONFIGURATION['db_username'],
+                                                           password=DB_CONFIGURATION['db_password'],
+                                                           host=DB_CONFIGURATION['db_address'][0],
+                                                           port=DB_CONFIGURATION['db_address'][1],
+                                                           database=DB_CONFIGURATION['db_name']),
+                                  minconn=1, maxconn=1, timeout=0.1)
+    connection = pool.getconn()
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+    pool.putconn(connection)
+    assert pool.getconn() is connection
+    assert pool.stats()['in_use'] == 1
+    pool.closeall()
+
+
+def test_pool_reaper_serves_waiters_first():
+    import threading
+    import time
+    from types import SimpleNamespace
+    from db_conn.connection.pool import BlockingConnectionPool
+
+    class FakeConnection(object):
+        closed = False
+        info = SimpleNamespace(transaction_status=psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
+        def close(self):
+            self.closed = True
+
+    opening = threading.Event()
+    opened = threading.Event()
+
+    def factory():
+        if opening.is_set():
+            opened.wait(5)
+        return FakeConnection()
+
+    pool = BlockingConnectionPool(factory, minconn=1, maxconn=1, timeout=2, max_lifetime=0.01, reap_interval=0)
+    time.sleep(0.02)
+    opening.set()
+    # The expired connection is replaced while a caller waits for it
+    reaper = threading.Thread(target=pool.reap)
+    reaper.start()
+    while pool.stats()['size'] == 0 or pool.stats()['idle'] == 1:
+        time.sleep(0.001)
+    pool.max_lifetime = None
+    result = {}
+    caller = threading.Thread(target=lambda: result.update(conn=pool.getconn()))
+    caller.start()
+    while not pool.stats()['waiting']:
+        time.sleep(0.001)
+    opened.set()
+    reaper.join()
+    caller.join()
+    assert isinstance(result['conn'], FakeConnection)
+    assert pool.stats() == {'size': 1, 'idle': 0, 'in_use': 1, 'waiting': 0, 'max': 1}
+    pool.closeall()
+
+def test_metrics_snapshot_and_hooks():
+    from db_conn.metrics import Metrics
+    metrics = Metrics(buckets=(0.1, 1.0))
+    recorded = []
+    metrics.add_hook(lambda kind, name, value, labels: recorded.append((kind, name, value)))
+    metrics.increment('queue.items', 3, worker=0)
+    metrics.increment('queue.items', 2, worker=0)
+    metrics.register_gauge('queue.depth', lambda: 7, queue='q')
+    for value in (0.05, 0.05, 0.5, 2.0):
+        metrics.observe('query.execute', value)
+    snapshot = metrics.snapshot()
+    assert snapshot['counters']['queue.items[worker=0]'] == 5
+    assert metrics.counter('queue.items', worker=0) == 5
+    assert snapshot['gauges']['queue.depth[queue=q]'] == 7
+    histogram = snapshot['histograms']['query.execute']
+    assert histogram['count'] == 4
+    assert histogram['buckets'] == {0.1: 2, 1.0: 1, float('inf'): 1}
+    assert histogram['p50'] == 0.1
+    assert histogram['max'] == 2.0
+    assert recorded[0] == ('counter', 'queue.items', 3)
+
+def test_slow_query_log_shapes():
+    from db_conn.connection.slowlog import SlowQueryLog, query_shape
+    assert query_shape('SELECT * FROM "m" WHERE "id"=12 AND "name"=\'it\'\'s\'') == \
+        query_shape('SELECT * FROM "m" WHERE "id"=%s AND "name"=%s')
+    assert query_shape('INSERT INTO "t" VALUES (1,\'a\'),(2,\'b\')') == 'INSERT INTO "t" VALUES (...)'
+    log = SlowQueryLog(threshold=100, size=2, samples=2)
+    log.record('SELECT 1', None, 0.01)
+    assert log.entries() == []
+    for i in range(3):
+        log.record('SELECT * FROM "m" WHERE "id"=%s' % i, None, 0.2)
+    log.record('SELECT * FROM "t"', None, 0.5)
+    log.record('SELECT * FROM "p"', None, 0.3)
+    entries = log.entries()
+    # The least recently recorded shape was evicted
+    assert [entry['shape'] for entry in entries] == ['SELECT * FROM "t"', 'SELECT * FROM "p"']
+    log.record('SELECT * FROM "t"', None, 0.5)
+    assert log.entries()[0]['count'] == 2
+    assert len(log.entries()[0]['samples']) == 2
+
+
+def test_slow_query_explain_is_throttled():
+    import threading
+    from db_conn.connection.slowlog import SlowQueryLog
+
+    explained = []
+    release = threading.Event()
+
+    class FakeCursor(object):
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def execute(self, sql, params=None):
+            explained.append(sql)
+            release.wait(5)
+
+        def fetchall(self):
+            return [('Seq Scan on m',)]
+
+    class FakeConnection(object):
+        closed = False
+
+        def cursor(self):
+            return FakeCursor()
+
+        def rollback(self):
+            pass
+
+        def close(self):
+            pass
+
+    log = SlowQueryLog(threshold=100, connect=FakeConnection, explain_interval=60)
+    # Recorded while the first explain is running, dropped
+    log.record('SELECT * FROM "m" WHERE "id"=1', None, 0.2)
+    log.record('SELECT * FROM "t"', None, 0.2)
+    release.set()
+    log.close()
+    # Explained within the interval, dropped as well
+    log = SlowQueryLog(threshold=100, connect=FakeConnection, explain_interval=60)
+    for i in range(3):
+        log.record('SELECT * FROM "m" WHERE "id"=%s' % i, None, 0.2)
+        log._executor.submit(lambda: None).result()
+    log.close()
+    assert explained == ['EXPLAIN (ANALYZE, BUFFERS) SELECT * FROM "m" WHERE "id"=1',
+                         'EXPLAIN (ANALYZE, BUFFERS) SELECT * FROM "m" WHERE "id"=0']
+
+
+def test_prepared_statements_are_recorded_as_their_sql():
+    from contextlib import contextmanager
+    from types import SimpleNamespace
+    from db_conn.connection.prepared import PreparedStatementCache
+
+    class FakeCursor(object):
+        connection = SimpleNamespace(get_backend_pid=lambda: 1)
+
+        def __init__(self):
+            self.executed = []
+            self.recorded = None
+
+        @contextmanager
+        def record_as(self, query, vars=None):
+            self.recorded = (query, vars)
+            yield self
+            self.recorded = None
+
+        def execute(self, query, vars=None):
+            self.executed.append((query, self.recorded))
+
+    cursor = FakeCursor()
+    sql = 'SELECT * FROM "players" WHERE "sc_player_id"=%s AND "full_name" LIKE \'M%%\''
+    PreparedStatementCache().execute(cursor, sql, (10,))
+    assert cursor.executed == [
+        ('PREPARE db_conn_stmt_0 AS SELECT * FROM "players" WHERE "sc_player_id"=$1 AND "full_name" LIKE \'M%\'', None),
+        ('EXECUTE db_conn_stmt_0 (%s)', (sql, (10,))),
+    ]
+
+def test_wait_for_postgres():
+    import socket
+    import threading
+    import time
+    from db_conn.utils import TunnelError, wait_for_postgres
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    address = server.getsockname()
+
+    def answer():
+        client, _ = server.accept()
+        client.recv(8)
+        client.sendall(b'N')
+        client.close()
+
+    thread = threading.Thread(target=answer)
+    thread.start()
+    wait_for_postgres(address, timeout=5)
+    thread.join()
+    server.close()
+    # Nothing listens on the port anymore
+    start = time.monotonic()
+    with pytest.raises(TunnelError):
+        wait_for_postgres(address, timeout=0.3)
+    assert time.monotonic() - start < 2
+
+def test_db_session_reuses_the_session():
+
+    @conn.psql.db_session(os.environ.get('SSH_USERNAME'), os.environ.get('SSH_PASSWORD'))
+    def backend_pid(cursor=None, connection=None):
+        cursor.execute("select pg_backend_pid();")
+        return cursor.fetchone()[0]
+
+    assert backend_pid() == backend_pid()
+    assert len(conn.psql._sessions) == 1
+    conn.psql.close_sessions()
+
+
+def test_db_session_stops_the_tunnel_of_a_failed_session(monkeypatch):
+    from db_conn.utils import TunnelError
+    tunnels = []
+
+    class FailingTunnel(object):
+        config = conn.utils.Tunnel.config
+
+        def __init__(self, **kwargs):
+            self.stopped = False
+            tunnels.append(self)
+
+        def start(self):
+            pass
+
+        def wait_ready(self):
+            # Other sessions can be opened meanwhile
+            assert not conn.psql._sessions_lock.locked()
+            raise TunnelError("not ready")
+
+        def stop(self):
+            self.stopped = True
+
+    monkeypatch.setattr(conn.psql, 'Tunnel', FailingTunnel)
+    with pytest.raises(TunnelError):
+        conn.psql.get_session('user', 'password')
+    assert tunnels[0].stopped
+    assert conn.psql._sessions == {}
+
+class FakeTunnel(object):
+
+    def __init__(self, config=None, **kwargs):
+        self.local_bind_addresses = [config['local_bind_address']]
+        self.is_active = True
+
+
+class FakeConnection(object):
+    closed = False
+
+
+def test_tunnel_group_assignment():
+    config = {**SSH_CONFIGURATION, 'tunnels': 3}
+    group = conn.utils.TunnelGroup(config=config, tunnel_factory=FakeTunnel)
+    assert group.local_bind_addresses == [('127.0.0.1', 8080), ('127.0.0.1', 8081), ('127.0.0.1', 8082)]
+    assert [group.next_address()[1] for _ in range(4)] == [8080, 8081, 8082, 8080]
+    # Inactive tunnels are skipped
+    group.tunnels[1].is_active = False
+    assert [group.next_address()[1] for _ in range(3)] == [8082, 8080, 8082]
+
+    group = conn.utils.TunnelGroup(config={**config, 'strategy': 'least_loaded'}, tunnel_factory=FakeTunnel)
+    connections = []
+    for _ in range(5):
+        address = group.next_address()
+        connections.append(FakeConnection())
+        group.track(address, connections[-1])
+    assert sorted(group.stats().values()) == [1, 2, 2]
+    # Closed connections do not count into the load
+    connections[0].closed = True
+    connections[3].closed = True
+    assert group.next_address() == ('127.0.0.1', 8080)
+
+
+def test_tunnel_group_credentials_and_pruning(monkeypatch):
+    monkeypatch.delenv('SSH_USERNAME', raising=False)
+    monkeypatch.delenv('SSH_PASSWORD', raising=False)
+    config = {'ssh_address_or_host': ('127.0.0.1', 22), 'ssh_username': 'user', 'ssh_password': 'secret', 'tunnels': 2}
+    # The credentials of the config are used unless they are given explicitly
+    group = conn.utils.TunnelGroup(config=config)
+    assert [(t.ssh_username, t.ssh_password) for t in group.tunnels] == [('user', 'secret')] * 2
+    group = conn.utils.TunnelGroup(config=config, username='other', password='pass')
+    assert [(t.ssh_username, t.ssh_password) for t in group.tunnels] == [('other', 'pass')] * 2
+
+    group = conn.utils.TunnelGroup(config={**SSH_CONFIGURATION, 'tunnels': 2}, tunnel_factory=FakeTunnel)
+    for _ in range(100):
+        connection = FakeConnection()
+        group.track(group.next_address(), connection)
+        connection.closed = True
+    assert max(len(connections) for connections in group._connections) == 1
+
+def test_async_pool_concurrent_queries(setup_tunnel):
+    import asyncio
+    from db_conn.connection.aio import AsyncConnectionPool
+
+    async def run():
+        async with AsyncConnectionPool(config={**DB_CONFIGURATION, 'max_connection': 4}, tunnel=setup_tunnel) as pool:
+            dfs = await pool.sql_query_many(["select %d as i, pg_sleep(0.05);" % i for i in range(20)])
+            assert [df['i'][0] for df in dfs] == list(range(20))
+            assert pool.stats()['size'] <= 4
+
+    asyncio.run(run())
+
+
+class FakeAsyncConnection(object):
+    """Asynchronous connection and its cursor, answering when a byte is sent to the other end of its socket."""
+
+    def __init__(self):
+        import socket
+        self.socket, self.server = socket.socketpair()
+        self.socket.setblocking(False)
+        self.cancelled = []
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def poll(self):
+        try:
+            self.socket.recv(1)
+        except BlockingIOError:
+            return psycopg2.extensions.POLL_READ
+        return psycopg2.extensions.POLL_OK
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, vars=None):
+        pass
+
+    def cancel(self):
+        import threading
+        self.cancelled.append(threading.get_ident())
+
+    def close(self):
+        self.socket.close()
+        self.server.close()
+
+
+def test_async_wait_and_cancel():
+    import asyncio
+    import threading
+    from db_conn.connection.aio import AsyncCursor, wait
+
+    async def run():
+        connection = FakeAsyncConnection()
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.01, connection.server.send, b'x')
+        await asyncio.wait_for(wait(connection), 5)
+
+        task = asyncio.ensure_future(AsyncCursor(connection).execute("select pg_sleep(10);"))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # The cancel request is sent without blocking the loop
+        assert len(connection.cancelled) == 1 and connection.cancelled[0] != threading.get_ident()
+        connection.close()
+
+    asyncio.run(run())
+
+
+def test_retry_with_circuit_breaker():
+    from db_conn import resilience
+    from db_conn.utils import retry
+    assert resilience.classify(psycopg2.OperationalError("could not connect")) == resilience.OUTAGE
+    assert resilience.classify(psycopg2.IntegrityError()) == resilience.FATAL
+    assert resilience.classify(ValueError()) == resilience.TRANSIENT
+
+    calls = []
+
+    @retry(psycopg2.Error, tries=3, delay=0.001)
+    def failing(err):
+        calls.append(err)
+        raise err
+
+    # The last failure is raised, fatal errors are not retried
+    with pytest.raises(psycopg2.OperationalError):
+        failing(psycopg2.OperationalError("server closed the connection"))
+    assert len(calls) == 3
+    with pytest.raises(psycopg2.IntegrityError):
+        failing(psycopg2.IntegrityError())
+    assert len(calls) == 4
+
+    import time
+    breaker = resilience.CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    for _ in range(2):
+        breaker.record_failure(psycopg2.OperationalError("could not connect"))
+    with pytest.raises(resilience.CircuitOpenError):
+        breaker.before_call()
+    time.sleep(0.06)
+    # A single probe is let through, its success closes the breaker
+    breaker.before_call()
+    with pytest.raises(resilience.CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == resilience.CircuitBreaker.CLOSED
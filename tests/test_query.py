@@ -0,0 +1,96 @@
+import db_conn as conn
+from db_conn.query.sc_soccer.bulk import _CopyStream, _column_encoders
+
+
+def test_copy_stream_encoding():
+    encoders = _column_encoders('lineups', ('match_id', 'team_id', 'formation', 'manager_id'))
+    stream = _CopyStream([(1, 2, ['4', '4-2', 'a"b'], None)], encoders)
+    assert stream.read() == '1\t2\t{"4","4-2","a\\\\"b"}\t\\N\n'
+    assert stream.row_count == 1
+
+    encoders = _column_encoders('player_stats', ('sc_player_id', 'sc_stat', 'has_sc_stat'))
+    stream = _CopyStream([(7, {'text': 'a\tb'}, True)], encoders)
+    assert stream.read(5) == '7\t{"t'
+    assert stream.read() == 'ext": "a\\\\tb"}\tt\n'
+
+
+def test_bound_query_placeholders():
+    q = conn.query.sc_soccer.get_all_match_data(season='19/20', match_ids=[1, 2, 3])
+    sql, params = q.compile()
+    assert params == ('19/20', [1, 2, 3])
+    assert "\"s\".\"season_year\"=%s" in sql
+    assert "\"m\".\"match_id\"=ANY(%s)" in sql
+    # The statement text does not depend on the bound values
+    assert conn.query.sc_soccer.get_all_match_data(season='20/21', match_ids=list(range(1000))).sql == sql
+
+
+def test_bound_query_inline_rendering():
+    q = conn.query.sc_soccer.get_player_lineups([5, 6], substitute=True)
+    assert "\"pl\".\"match_id\"=ANY(ARRAY[5,6])" in str(q)
+    assert "\"pl\".\"substitute\"=true" in str(q)
+    assert str(q.limit(1)).endswith('LIMIT 1')
+
+
+def test_bound_query_escapes_literal_percent():
+    from pypika import Query, Table
+    from db_conn.query.bind import Binder
+    players = Table('players')
+    b = Binder()
+    q = b.bind(Query.from_(players).select(players.sc_player_id).where(players.full_name.like('Mes%'))
+               .where(players.sc_player_id == b(10)))
+    sql, params = q.compile()
+    assert sql == 'SELECT "sc_player_id" FROM "players" WHERE "full_name" LIKE \'Mes%%\' AND "sc_player_id"=%s'
+    assert params == (10,)
+    # Forwarded builder calls keep the bound values
+    assert q.where(players.full_name.like('%i')).compile()[0].endswith('LIKE \'%%i\'')
+
+
+def test_flatten_player_lineups():
+    import pandas as pd
+    from db_conn.query.sc_soccer.complex import flatten_player_lineups
+
+    lineups = pd.DataFrame({'match_id': [1, 1, 1, 2], 'team_id': [5, 6, 5, 7], 'sc_player_id': [10, 11, 12, 13]})
+    matches = pd.DataFrame({'match_id': [1, 2], 'home_team_id': [6, 8]})
+    df = flatten_player_lineups(lineups, matches).set_index('match_id')
+    assert list(df.columns) == ['home_sc_player_id_0', 'away_sc_player_id_0', 'away_sc_player_id_1']
+    assert df.loc[1].to_list() == [11, 10, 12]
+    assert df.loc[2, 'away_sc_player_id_0'] == 13
+
+
+def test_dimension_cache_loads_once_and_keeps_column_names():
+    import threading
+    import time
+    import pandas as pd
+
+    class FakeConnection(object):
+
+        def __init__(self):
+            self.queries = []
+
+        def sql_query(self, query):
+            self.queries.append(str(query))
+            time.sleep(0.01)
+            return {
+                'teams': pd.DataFrame({'team_id': [1, 2], 'team_name': ['Home', 'Away'], 'team_slug': ['home', 'away'],
+                                       'team_short': ['H', 'A']}),
+                'seasons': pd.DataFrame({'season_id': [5], 'season_year': ['19/20']}),
+                'tournaments': pd.DataFrame({'tournament_id': [6], 'tournament_slug': ['cup']}),
+                'referees': pd.DataFrame({'referee_id': [7], 'referee_name': ['Ref']}),
+                'stadiums': pd.DataFrame({'stadium_id': [8], 'name': ['Arena']}),
+            }[query.get_sql().split('"')[1]]
+
+    db = FakeConnection()
+    dimensions = conn.query.sc_soccer.DimensionCache(db, ttl=None)
+    threads = [threading.Thread(target=dimensions.team_ids, args=('home',)) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(db.queries) == 5
+
+    # e.g. the name column of the lineup managers
+    matches = pd.DataFrame({'match_id': [3], 'season_id': [5], 'tournament_id': [6], 'referee_id': [7],
+                            'stadium_id': [8], 'home_team_id': [1], 'away_team_id': [2], 'name': ['Manager']})
+    df = dimensions.enrich(matches)
+    assert df['name'].to_list() == ['Manager'] and df['name_stadiums'].to_list() == ['Arena']
+    assert df[['home_team_name', 'away_team_name', 'season_year']].values.tolist() == [['Home', 'Away', '19/20']]
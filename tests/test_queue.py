@@ -0,0 +1,548 @@
+import pickle
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import pytest
+from psycopg2.errors import ForeignKeyViolation
+from pypika import PostgreSQLQuery, Query, Table
+
+from db_conn.metrics import Metrics
+from db_conn.queue import InsertQueue, InsertRows, MergeBuffer, coalesce_inserts, order_inserts
+
+player_stats = Table('player_stats')
+matches = Table('matches')
+
+
+def test_coalesce_inserts_folds_same_table():
+    items = [
+        Query.into(player_stats).columns('sc_player_id', 'match_id').insert(1, 10),
+        Query.into(player_stats).columns('sc_player_id', 'match_id').insert(2, 10),
+        Query.into(matches).columns('match_id').insert(10),
+    ]
+    result = coalesce_inserts(items)
+    assert len(result) == 2
+    assert str(result[0]) == 'INSERT INTO "player_stats" ("sc_player_id","match_id") VALUES (1,10),(2,10)'
+    assert str(result[1]) == 'INSERT INTO "matches" ("match_id") VALUES (10)'
+    # The original queries must stay untouched
+    assert str(items[0]) == 'INSERT INTO "player_stats" ("sc_player_id","match_id") VALUES (1,10)'
+
+
+def test_coalesce_inserts_keeps_interleaved_tables_in_order():
+    items = [
+        Query.into(matches).columns('match_id').insert(1),
+        Query.into(player_stats).columns('sc_player_id', 'match_id').insert(7, 2),
+        Query.into(matches).columns('match_id').insert(2),
+        Query.into(matches).columns('match_id').insert(3),
+    ]
+    # The player_stats row needs the second match, which must not be written before the first one
+    assert [str(item) for item in coalesce_inserts(items)] == [
+        'INSERT INTO "matches" ("match_id") VALUES (1)',
+        'INSERT INTO "player_stats" ("sc_player_id","match_id") VALUES (7,2)',
+        'INSERT INTO "matches" ("match_id") VALUES (2),(3)',
+    ]
+
+
+def test_coalesce_inserts_passes_through_other_items():
+    items = [
+        "DELETE FROM matches",
+        Query.into(matches).columns('match_id').insert(1),
+        Query.into(matches).columns('match_id', 'season_id').insert(2, 3),
+    ]
+    result = coalesce_inserts(items)
+    assert len(result) == 3
+    assert result[0] == "DELETE FROM matches"
+
+
+def test_coalesce_inserts_does_not_move_inserts_across_other_statements():
+    items = [
+        Query.into(player_stats).columns('sc_player_id', 'match_id').insert(1, 10),
+        "DELETE FROM player_stats WHERE match_id=10",
+        Query.into(player_stats).columns('sc_player_id', 'match_id').insert(2, 10),
+        Query.into(player_stats).columns('sc_player_id', 'match_id').insert(3, 10),
+    ]
+    result = coalesce_inserts(items)
+    assert [str(item) for item in result] == [
+        'INSERT INTO "player_stats" ("sc_player_id","match_id") VALUES (1,10)',
+        "DELETE FROM player_stats WHERE match_id=10",
+        'INSERT INTO "player_stats" ("sc_player_id","match_id") VALUES (2,10),(3,10)',
+    ]
+
+
+def test_coalesce_inserts_folds_row_payloads():
+    items = [
+        InsertRows(player_stats, ('sc_player_id', 'match_id'), [(1, 10)]),
+        InsertRows('player_stats', ('sc_player_id', 'match_id'), [(2, 10), (4, 10)]),
+        Query.into(player_stats).columns('sc_player_id', 'match_id').insert(3, 10),
+    ]
+    result = coalesce_inserts(items)
+    assert len(result) == 2
+    assert isinstance(result[0], InsertRows)
+    assert result[0].rows == [(1, 10), (2, 10), (4, 10)]
+    assert str(result[0]) == 'INSERT INTO "player_stats" ("sc_player_id","match_id") VALUES %s'
+    assert [item.rows for item in result[0].split()] == [[(1, 10)], [(2, 10)], [(4, 10)]]
+
+
+def test_coalesce_inserts_folds_upserts_of_the_same_key():
+    columns = ('sc_player_id', 'match_id', 'rating')
+    items = [
+        InsertRows(player_stats, columns, [(1, 10, 6.5), (2, 10, 7.0)], conflict=('sc_player_id', 'match_id')),
+        InsertRows(player_stats, columns, [(1, 10, 8.0)], conflict=('sc_player_id', 'match_id')),
+        InsertRows(player_stats, columns[:2], [(3, 10)], conflict=('sc_player_id', 'match_id')),
+        InsertRows(player_stats, columns[:2], [(3, 10)], conflict=('sc_player_id', 'match_id')),
+    ]
+    result = coalesce_inserts(items)
+    # A statement can not upsert the same key twice
+    assert [item.rows for item in result] == [[(1, 10, 8.0), (2, 10, 7.0)], [(3, 10)]]
+
+
+def test_row_payload_pickles_compactly():
+    rows = [(i, 10) for i in range(100)]
+    payload = InsertRows(player_stats, ('sc_player_id', 'match_id'), rows)
+    restored = pickle.loads(pickle.dumps(payload))
+    assert (restored.table, restored.columns, restored.rows) == ('player_stats', ('sc_player_id', 'match_id'), rows)
+    queries = [Query.into(player_stats).columns('sc_player_id', 'match_id').insert(*row) for row in rows]
+    assert len(pickle.dumps(payload)) * 10 < len(pickle.dumps(queries))
+
+
+def test_order_inserts_puts_parent_tables_first():
+    items = [
+        InsertRows(player_stats, ('sc_player_id', 'match_id'), [(1, 10)]),
+        Query.into(matches).columns('match_id').insert(10),
+        "UPDATE matches SET home_score=1",
+        Query.into(player_stats).columns('sc_player_id', 'match_id').insert(2, 11),
+        Query.into(Table('odds')).columns('match_id').insert(11),
+        Query.into(matches).columns('match_id').insert(11),
+    ]
+    result = order_inserts(items, ['matches', 'player_stats'])
+    # Nothing moves across the update, tables missing from the order go last
+    assert [str(item) for item in result] == [
+        'INSERT INTO "matches" ("match_id") VALUES (10)',
+        'INSERT INTO "player_stats" ("sc_player_id","match_id") VALUES %s',
+        "UPDATE matches SET home_score=1",
+        'INSERT INTO "matches" ("match_id") VALUES (11)',
+        'INSERT INTO "player_stats" ("sc_player_id","match_id") VALUES (2,11)',
+        'INSERT INTO "odds" ("match_id") VALUES (11)',
+    ]
+
+
+def test_merge_buffer_deduplicates_by_key():
+    buffer = MergeBuffer({'player_stats': ('sc_player_id', 'match_id')})
+    assert buffer.add(Query.into(player_stats).columns('sc_player_id', 'match_id', 'rating').insert(1, 10, 6.5))
+    assert buffer.add(InsertRows(player_stats, ('sc_player_id', 'match_id', 'rating'), [(2, 10, 7.0), (1, 10, 8.0)]))
+    # Unknown tables, raw SQL and queries without named columns are not merged
+    assert not buffer.add(Query.into(matches).columns('match_id').insert(10))
+    assert not buffer.add("DELETE FROM player_stats")
+    assert not buffer.add(Query.into(player_stats).insert(3, 10, 5.0))
+    assert len(buffer) == 2 and buffer.merged == 1
+    payloads = buffer.drain()
+    assert len(payloads) == 1 and len(buffer) == 0
+    assert payloads[0].rows == [(1, 10, 8.0), (2, 10, 7.0)]
+    assert str(payloads[0]) == 'INSERT INTO "player_stats" ("sc_player_id","match_id","rating") VALUES %s ' \
+                               'ON CONFLICT ("sc_player_id","match_id") DO UPDATE SET "rating"=EXCLUDED."rating"'
+
+
+def test_merge_buffer_custom_merge():
+    buffer = MergeBuffer({'player_stats': ('sc_player_id', 'match_id')},
+                         merge={'player_stats': lambda old, new: {**new, 'rating': max(old['rating'], new['rating'])}})
+    buffer.add(InsertRows(player_stats, ('sc_player_id', 'match_id', 'rating'), [(1, 10, 8.0), (1, 10, 6.5)]))
+    assert buffer.drain()[0].rows == [(1, 10, 8.0)]
+    buffer.add(InsertRows(player_stats, ('sc_player_id', 'match_id'), [(1, 10)]))
+    assert str(buffer.drain()[0]).endswith('ON CONFLICT ("sc_player_id","match_id") DO NOTHING')
+
+
+def test_insert_rows_writes_json_columns_as_json(monkeypatch):
+    import db_conn.queue
+    from psycopg2.extras import Json
+    executed = []
+    monkeypatch.setattr(db_conn.queue, 'execute_values', lambda cursor, sql, rows, page_size: executed.append(rows))
+    payload = InsertRows(player_stats, ('sc_player_id', 'sc_stat', 'positions'),
+                         [(1, [{'rating': 7.0}], ['F', 'M']), (2, '{"rating": 6.5}', None), (3, None, ['D'])])
+    payload.execute(None, json_columns=('sc_stat',))
+    rows = executed[0]
+    assert isinstance(rows[0][1], Json) and rows[0][1].adapted == [{'rating': 7.0}]
+    # Serialized documents, NULLs and the other list columns are passed as they are
+    assert [row[1:] for row in rows[1:]] == [('{"rating": 6.5}', None), (None, ['D'])]
+    assert rows[0][2] == ['F', 'M']
+
+
+class FakeCursor(object):
+
+    def __init__(self, row=None):
+        self.row = row
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchone(self):
+        return self.row
+
+
+def test_spool_replays_in_order(tmp_path):
+    from db_conn.spool import Spool
+    spool = Spool(str(tmp_path), name='q')
+    assert not spool.pending()
+    spool.append(['a', 'b'])
+    spool.append(['c'])
+    assert spool.pending()
+    items, position = spool.read(max_items=2)
+    assert items == ['a', 'b']
+    spool.advance(position)
+    items, position = spool.read()
+    assert items == ['c']
+    spool.advance(position)
+    assert not spool.pending()
+    # Fully replayed files are removed, new items go to the next generation
+    spool.append(['d'])
+    assert [p.name for p in tmp_path.iterdir() if p.suffix == '.spool'] == ['q.1.spool']
+    spool.close()
+
+
+def test_spool_resumes_from_the_stored_position(tmp_path):
+    from db_conn.spool import Spool
+    spool = Spool(str(tmp_path), name='q')
+    spool.append(['a'])
+    spool.append(['b'])
+    _, position = spool.read(max_items=1)
+    spool.close()
+    # Simulate a crash in the middle of appending a record
+    with open(str(tmp_path / 'q.0.spool'), 'ab') as f:
+        f.write(b'\x00\x00\x01')
+
+    spool = Spool(str(tmp_path), name='q')
+    spool.load_position(FakeCursor(position))
+    items, position = spool.read()
+    assert items == ['b']
+    # The torn record is skipped
+    assert position == (0, (tmp_path / 'q.0.spool').stat().st_size)
+
+
+def test_spool_does_not_reuse_replayed_generations(tmp_path):
+    from db_conn.spool import Spool
+    spool = Spool(str(tmp_path), name='q')
+    spool.append(['a'])
+    _, stored = spool.read()
+    spool.advance(stored)
+    spool.close()
+    assert not any(p.name.endswith('.spool') for p in tmp_path.iterdir())
+
+    # The database is unreachable at the restart, items are spooled before the position is loaded
+    spool = Spool(str(tmp_path), name='q')
+    spool.append(['b'])
+    spool.load_position(FakeCursor(stored))
+    assert spool.pending()
+    assert spool.read()[0] == ['b']
+    spool.close()
+
+    # Without the generation file the stored position still moves the new items to a later generation
+    for p in tmp_path.iterdir():
+        p.unlink()
+    spool = Spool(str(tmp_path), name='q')
+    spool.load_position(FakeCursor((0, stored[1])))
+    spool.append(['c'])
+    assert spool.pending()
+    assert spool.read()[0] == ['c']
+    spool.close()
+
+
+def test_dead_letter_file_appends_json_lines(tmp_path):
+    from datetime import date
+    from db_conn.deadletter import DeadLetterFile
+    sink = DeadLetterFile(str(tmp_path / 'dead' / 'q.jsonl'))
+    sink.put([{'table_name': 'matches', 'rows': [[1, date(2020, 5, 1)]], 'error': 'bad'}])
+    # The sink is passed to the writer processes
+    pickle.loads(pickle.dumps(sink)).put([{'table_name': 'odds', 'rows': None, 'error': 'worse'}])
+    assert sink.read() == [{'table_name': 'matches', 'rows': [[1, '2020-05-01']], 'error': 'bad'},
+                           {'table_name': 'odds', 'rows': None, 'error': 'worse'}]
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out waiting for the queue."
+        time.sleep(0.005)
+
+
+class StubCursor(object):
+    """Records the statements with their thread, the player_stats rows of a StubPool with 'matches' need their match."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def mogrify(self, template, args):
+        return (template.decode() % tuple(args)).encode()
+
+    def execute(self, sql, params=None):
+        pool, connection = self.connection.pool, self.connection
+        if isinstance(sql, bytes):
+            sql = sql.decode()
+        pool.executed.append((threading.current_thread(), sql))
+        if sql.startswith('INSERT INTO "matches"'):
+            connection.matches.update(int(m) for m in re.findall(r'\((\d+)\)', sql))
+        elif sql.startswith('INSERT INTO "player_stats"'):
+            rows = [(int(p), int(m)) for p, m in re.findall(r'\((\d+),(\d+)\)', sql)]
+            if pool.matches is not None and any(m not in pool.matches | connection.matches for _, m in rows):
+                raise ForeignKeyViolation('insert or update on table "player_stats" violates foreign key constraint')
+            connection.rows.extend(rows)
+
+
+class StubConnection(object):
+    encoding = 'UTF8'
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.matches = set()
+        self.rows = []
+
+    @contextmanager
+    def cursor(self):
+        yield StubCursor(self)
+
+    def commit(self):
+        time.sleep(self.pool.latency)
+        if self.pool.failures:
+            self.pool.failures -= 1
+            self.rollback()
+            raise self.pool.failure
+        if self.pool.matches is not None:
+            self.pool.matches.update(self.matches)
+        self.pool.rows.extend(self.rows)
+        self.rollback()
+
+    def rollback(self):
+        self.matches = set()
+        self.rows = []
+
+
+class StubPool(object):
+    """Pool of connections committing in 'latency' seconds, the first 'failures' commits raise 'failure'."""
+
+    def __init__(self, latency=0.0, matches=None, failures=0, config=None):
+        self.latency = latency
+        self.matches = matches
+        self.failures = failures
+        self.failure = psycopg2.OperationalError('server closed the connection unexpectedly')
+        self.metrics = Metrics()
+        self.executed = []
+        self.rows = []
+        self.invalidated = []
+
+    def clone_kwargs(self):
+        return {'config': {}, 'latency': self.latency, 'matches': self.matches}
+
+    @contextmanager
+    def get_connection(self):
+        yield StubConnection(self)
+
+    def invalidate_cache(self, *tables):
+        self.invalidated.extend(tables)
+
+    def restart(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_autoscale_hires_and_retires_workers():
+    pool = StubPool(latency=0.005)
+    q = InsertQueue(pool=pool, name='scale', autoscale=True, min_workers=1, max_workers=4, autoscale_interval=0.01,
+                    autoscale_latency=100, batch_size=1, batch_timeout=1)
+    targets = []
+    scale = q._scale
+    q._scale = lambda target: (targets.append(target), scale(target))
+    threads = set(q.workers)
+    try:
+        # A backlog hires one worker per interval
+        for i in range(1000):
+            q.put("SELECT %d" % i)
+        wait_for(lambda: q.num_workers == 4)
+        assert targets[:3] == [2, 3, 4]
+        threads.update(q.workers)
+
+        # Slow commits halve the workers, the retired ones exit once they take their retirement
+        pool.latency = 0.3
+        wait_for(lambda: q.num_workers == 1)
+        assert targets[3] == 2
+        # Additive increase, multiplicative decrease
+        assert all(new in (old + 1, old // 2) for old, new in zip([1] + targets, targets))
+        alive = [t for t in threads if t.is_alive()]
+        assert len(alive) >= q.num_workers + q._retire
+        wait_for(lambda: q._retire == 0 and sum(t.is_alive() for t in threads) == 1)
+    finally:
+        pool.latency = 0.0
+        threads.update(q.workers)
+        q.fire_workers()
+    assert not any(t.is_alive() for t in threads)
+    assert q._controller is None
+
+
+def test_merged_rows_survive_a_failed_write(monkeypatch):
+    import db_conn.resilience
+    monkeypatch.setattr(db_conn.resilience, 'decorrelated_jitter', lambda base, cap, previous: 0.01)
+    pool = StubPool(failures=1)
+    q = InsertQueue(pool=pool, name='merge', merge_keys={'player_stats': ('sc_player_id', 'match_id')},
+                    merge_window=60000, batch_size=2, batch_timeout=1000)
+    # The update is written at once and fails, the row stays in the buffer
+    q.put("UPDATE matches SET home_score=1")
+    q.put(Query.into(player_stats).columns('sc_player_id', 'match_id').insert(1, 10))
+    wait_for(lambda: q.metrics.counter('queue.errors', queue='merge'))
+    q.fire_workers()
+    assert pool.rows == [(1, 10)]
+    assert str(pool.executed[-1][1]).endswith('ON CONFLICT ("sc_player_id","match_id") DO NOTHING')
+
+
+def test_worker_dies_on_a_bug_and_reports_it():
+    pool = StubPool(failures=1)
+    pool.failure = TypeError("unsupported operand")
+    q = InsertQueue(pool=pool, name='bug', max_workers=2, batch_size=1)
+    q.put(Query.into(player_stats).columns('sc_player_id', 'match_id').insert(1, 10))
+    wait_for(lambda: q.metrics.counter('queue.dead_workers', queue='bug'))
+    q.put(Query.into(player_stats).columns('sc_player_id', 'match_id').insert(2, 10))
+    results = q.fire_workers()
+    # Not retried, the other worker keeps writing
+    assert sorted((result['result'], result.get('error')) for result in results) == [
+        (False, 'unsupported operand'), (True, None)]
+    assert q.metrics.counter('queue.errors', queue='bug') == 1
+    assert pool.rows == [(2, 10)]
+
+
+def test_worker_retries_outages_within_its_budget(monkeypatch):
+    import db_conn.resilience
+    monkeypatch.setattr(db_conn.resilience, 'decorrelated_jitter', lambda base, cap, previous: 0.01)
+    pool = StubPool(failures=10)
+    q = InsertQueue(pool=pool, name='outage', partition_key='match_id', max_workers=1, batch_size=1,
+                    worker_retries=2)
+    for player in range(5):
+        q.put(Query.into(player_stats).columns('sc_player_id', 'match_id').insert(player, 10))
+    wait_for(lambda: q.metrics.counter('queue.dead_workers', queue='outage'))
+    # Every try takes a batch, the rest of the lane of the dead worker is drained so the dispatcher does not block
+    results = q.fire_workers()
+    assert [result['result'] for result in results] == [False]
+    assert q.metrics.counter('queue.errors', queue='outage') == 3 and pool.failures == 7
+    assert q.metrics.counter('queue.dropped', queue='outage', worker=0) == 2
+
+
+def test_route_splits_inserts_by_partition_key():
+    q = InsertQueue(pool=StubPool(), name='lanes', partition_key='match_id', max_workers=3)
+    try:
+        upsert = PostgreSQLQuery.into(player_stats).columns('sc_player_id', 'match_id').insert(1, 10).insert(2, 11) \
+            .on_conflict('sc_player_id', 'match_id').do_nothing()
+        assert [(lane, str(part)) for lane, part in q._route(upsert)] == [
+            (q._lane(10), 'INSERT INTO "player_stats" ("sc_player_id","match_id") VALUES (1,10) '
+                          'ON CONFLICT ("sc_player_id", "match_id") DO NOTHING'),
+            (q._lane(11), 'INSERT INTO "player_stats" ("sc_player_id","match_id") VALUES (2,11) '
+                          'ON CONFLICT ("sc_player_id", "match_id") DO NOTHING'),
+        ]
+        payload = InsertRows(player_stats, ('sc_player_id', 'match_id'), [(1, 10), (2, 11), (3, 10)])
+        assert [(lane, part.rows) for lane, part in q._route(payload)] == [
+            (q._lane(10), [(1, 10), (3, 10)]), (q._lane(11), [(2, 11)])]
+        row = Query.into(matches).columns('match_id').insert(10)
+        assert q._route(row) == [(q._lane(10), row)]
+        # Updates can not be ordered by a column, they are distributed round-robin
+        assert not q._unordered_warned
+        lanes = [q._route(Query.update(matches).set('home_score', 1).where(matches.match_id == 10))[0][0]
+                 for _ in range(3)]
+        assert sorted(lanes) == [0, 1, 2] and q._unordered_warned
+    finally:
+        q.fire_workers()
+
+
+def test_lanes_write_the_items_of_a_key_in_order():
+    pool = StubPool()
+    q = InsertQueue(pool=pool, name='lanes', partition_key='match_id', max_workers=3, batch_size=5)
+    for player in range(60):
+        query = Query if player % 2 else PostgreSQLQuery
+        item = query.into(player_stats).columns('sc_player_id', 'match_id').insert(player, player % 4)
+        q.put(item if player % 2 else item.on_conflict('sc_player_id', 'match_id').do_nothing())
+    q.fire_workers()
+    threads, players = {}, {}
+    for thread, sql in pool.executed:
+        for player, match in re.findall(r'\((\d+),(\d+)\)', sql):
+            threads.setdefault(int(match), set()).add(thread)
+            players.setdefault(int(match), []).append(int(player))
+    assert all(len(workers) == 1 for workers in threads.values())
+    assert players == {match: list(range(match, 60, 4)) for match in range(4)}
+
+
+def test_lanes_retry_the_rows_missing_their_parent():
+    pool = StubPool(matches=set())
+    q = InsertQueue(pool=pool, name='lanes', partition_key='match_id', max_workers=2, batch_size=1)
+    q.put(Query.into(player_stats).columns('sc_player_id', 'match_id').insert(1, 10))
+    q.put(Query.into(matches).columns('match_id').insert(10))
+    q.fire_workers()
+    # The row is deferred until the next batch of its lane wrote the match
+    assert pool.rows == [(1, 10)] and pool.matches == {10}
+    assert not any(name.startswith('queue.dead_letters') for name in q.metrics.snapshot()['counters'])
+
+
+def test_lanes_dead_letter_the_rows_still_missing_their_parent(tmp_path):
+    from db_conn.deadletter import DeadLetterFile
+    pool = StubPool(matches=set())
+    sink = DeadLetterFile(str(tmp_path / 'dead.jsonl'))
+    q = InsertQueue(pool=pool, name='lanes', partition_key='match_id', max_workers=1, batch_size=1, defer_tries=4,
+                    dead_letter=sink)
+    q.put(Query.into(player_stats).columns('sc_player_id', 'match_id').insert(1, 10))
+    q.put(Query.into(player_stats).columns('sc_player_id', 'match_id').insert(2, 99))
+    for match in (20, 21, 10):
+        q.put(Query.into(matches).columns('match_id').insert(match))
+    q.fire_workers()
+    # The first row is written four batches later, the second one never finds its match
+    assert pool.rows == [(1, 10)]
+    assert [letter['rows'] for letter in sink.read()] == [[[2, 99]]]
+
+
+def test_lanes_keep_the_deferred_rows_when_a_write_fails(monkeypatch):
+    import db_conn.resilience
+    monkeypatch.setattr(db_conn.resilience, 'decorrelated_jitter', lambda base, cap, previous: 0.01)
+    pool = StubPool(matches=set())
+    q = InsertQueue(pool=pool, name='lanes', partition_key='match_id', max_workers=1, batch_size=1)
+    q.put(Query.into(player_stats).columns('sc_player_id', 'match_id').insert(1, 10))
+    wait_for(lambda: q._deferred.get(0))
+    pool.failures = 1
+    q.put(Query.into(matches).columns('match_id').insert(20))
+    wait_for(lambda: q.metrics.counter('queue.errors', queue='lanes'))
+    q.put(Query.into(matches).columns('match_id').insert(10))
+    q.fire_workers()
+    assert pool.rows == [(1, 10)] and pool.matches == {10}
+
+
+def test_failed_rows_go_to_the_dead_letters_and_the_others_commit(tmp_path):
+    from db_conn.deadletter import DeadLetterFile
+    pool = StubPool(matches={10})
+    sink = DeadLetterFile(str(tmp_path / 'dead.jsonl'))
+    q = InsertQueue(pool=pool, name='dead', dead_letter=sink, batch_size=10, batch_timeout=500)
+    for player, match in ((1, 10), (2, 99), (3, 10)):
+        q.put(Query.into(player_stats).columns('sc_player_id', 'match_id').insert(player, match))
+    q.put(PostgreSQLQuery.into(player_stats).columns('sc_player_id', 'match_id').insert(4, 10).insert(5, 98)
+          .on_conflict('sc_player_id', 'match_id').do_nothing())
+    q.fire_workers()
+    assert sorted(pool.rows) == [(1, 10), (3, 10), (4, 10)]
+    letters = sink.read()
+    assert [(letter['table_name'], letter['columns'], letter['rows']) for letter in letters] == [
+        ('player_stats', ['sc_player_id', 'match_id'], [[2, 99]]),
+        ('player_stats', ['sc_player_id', 'match_id'], [[5, 98]]),
+    ]
+    assert letters[1]['statement'].endswith('ON CONFLICT ("sc_player_id", "match_id") DO NOTHING')
+
+
+def test_process_mode_reports_results_and_written_tables():
+    pool = StubPool()
+    q = InsertQueue(pool=pool, name='proc', mode='process', max_workers=2, batch_size=10)
+    for match in range(40):
+        q.put(Query.into(matches).columns('match_id').insert(match))
+    # The parent cache is invalidated while the writer processes run
+    wait_for(lambda: pool.invalidated, timeout=30)
+    results = q.fire_workers()
+    assert [result['result'] for result in results] == [True, True]
+    assert sum(result['items'] for result in results) == 40
+    assert sum(q.metrics.counter('queue.items', queue='proc', worker=i) for i in range(2)) == 40
+    assert set(pool.invalidated) == {'matches'}
+
+
+def test_process_mode_rejects_unpicklable_options():
+    with pytest.raises(AssertionError, match='merge'):
+        InsertQueue(pool=StubPool(), mode='process', merge_keys={'matches': ('match_id',)},
+                    merge=lambda old, new: new)